@@ -0,0 +1,142 @@
+"""
+Synthetic inputs and helpers shared by the benchmark suite.
+
+Grids are rotated pole grids with the spacing and extent of the native
+CanRCM4 grid (155 x 130 cells) refined by a scale factor, so that the
+1x, 5x and 10x grids match the resolutions used in the pipeline.
+Stations are drawn uniformly over a box covering populated Canada.
+"""
+
+from climpyrical.data import gen_dataset
+from climpyrical.gridding import transform_coords
+
+import tracemalloc
+import pytest
+import numpy as np
+import pandas as pd
+
+GRID_SCALES = [1, 5, pytest.param(10, marks=pytest.mark.slow)]
+STATION_COUNTS = [100, 1000, pytest.param(5000, marks=pytest.mark.slow)]
+
+ROTATED_CRS = {
+    "proj": "ob_tran",
+    "o_proj": "longlat",
+    "lon_0": -97,
+    "o_lat_p": 42.5,
+    "a": 6378137,
+    "to_meter": 0.0174532925199,
+    "no_defs": True,
+}
+
+_GRIDS = {}
+
+
+def synthetic_grid(scale):
+    """Generates a rotated pole design value field on the native
+    CanRCM4 grid refined scale times in each direction. Cells far
+    from the centre of the domain are NaN to mimic the ocean. Grids are
+    kept in memory since the larger grids are expensive to build.
+    Args:
+        scale (int): refinement factor of the native grid
+    Returns:
+        xarray.Dataset with rlat, rlon, lat and lon
+    """
+    if scale not in _GRIDS:
+        dx = 0.44 / scale
+        rlon = np.linspace(-33.88, 33.88, 155 * scale)
+        rlat = np.linspace(-28.38, -28.38 + dx * (130 * scale - 1), 130 * scale)
+        rrlon, rrlat = np.meshgrid(rlon, rlat)
+        lon, lat = transform_coords(
+            rrlon.flatten(),
+            rrlat.flatten(),
+            source_crs=ROTATED_CRS,
+            target_crs={"init": "epsg:4326"},
+        )
+
+        field = 2.0 + np.sin(rrlon / 5.0) * np.cos(rrlat / 7.0)
+        field[(rrlon**2 / 1100.0 + rrlat**2 / 900.0) > 1.0] = np.nan
+
+        _GRIDS[scale] = gen_dataset(
+            "dv",
+            field,
+            rlat,
+            rlon,
+            lat.reshape(rrlon.shape),
+            lon.reshape(rrlon.shape),
+            "kPa",
+        )
+
+    return _GRIDS[scale]
+
+
+def synthetic_stations(n, seed=0):
+    """Generates n stations with regular and rotated coordinates,
+    a design value and a ratio to a model value.
+    Args:
+        n (int): number of stations
+        seed (int): random seed
+    Returns:
+        pandas.DataFrame of stations
+    """
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(-130.0, -60.0, n)
+    lat = rng.uniform(43.0, 65.0, n)
+    rlon, rlat = transform_coords(lon, lat)
+
+    return pd.DataFrame(
+        {
+            "station_name": [f"station {i}" for i in range(n)],
+            "lon": lon,
+            "lat": lat,
+            "rlon": rlon,
+            "rlat": rlat,
+            "elev (m)": rng.uniform(0.0, 2000.0, n),
+            "dv (kPa)": rng.uniform(1.0, 3.0, n),
+            "ratio": rng.uniform(0.8, 1.2, n),
+        }
+    )
+
+
+def synthetic_polygon(n_vertices=5000, seed=0):
+    """Generates a rotated pole polygon with a rough coastline,
+    roughly the size and complexity of the simplified Canada outline.
+    Args:
+        n_vertices (int): number of vertices in the exterior
+        seed (int): random seed
+    Returns:
+        geopandas.GeoSeries with one polygon
+    """
+    import geopandas as gpd
+    from shapely.geometry import Polygon
+
+    rng = np.random.default_rng(seed)
+    theta = np.linspace(0, 2 * np.pi, n_vertices, endpoint=False)
+    r = 1.0 + 0.05 * np.sin(25 * theta) + rng.normal(0.0, 0.01, n_vertices)
+    x, y = 20.0 * r * np.cos(theta), 2.0 + 15.0 * r * np.sin(theta)
+
+    return gpd.GeoSeries([Polygon(zip(x, y))])
+
+
+@pytest.fixture
+def profiled(benchmark):
+    """Times a function with pytest-benchmark and records the peak
+    memory allocated by a single call in the benchmark's extra_info,
+    so that it is stored along with the timings.
+    """
+
+    def run(func, *args, rounds=3, setup=None, **kwargs):
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info["peak_memory_mb"] = peak / 1e6
+
+        return benchmark.pedantic(
+            func, args, kwargs, setup=setup, rounds=rounds, iterations=1
+        )
+
+    return run
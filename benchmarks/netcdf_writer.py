@@ -0,0 +1,76 @@
+"""
+Compares the default xarray NetCDF4 encoding with climpyrical's
+write_netcdf on a synthetic grid the size of the 10x CanRCM4 grids.
+usage:
+python benchmarks/netcdf_writer.py [-s scale] [-w window] [-d digits]
+
+Reports file size, write time and the time taken to read random
+spatial windows of window x window cells back from each file.
+"""
+
+from climpyrical.data import gen_dataset, write_netcdf
+
+import os
+import time
+import tempfile
+import click
+import numpy as np
+import xarray as xr
+
+
+def synthetic_dataset(scale):
+    # the native CanRCM4 grid is 130 x 155, the 10x grid is extended north
+    ny, nx = 130 * scale + 210, 155 * scale
+    rlat = np.linspace(-28.6, 37.4, ny)
+    rlon = np.linspace(-33.88, 33.88, nx)
+    xx, yy = np.meshgrid(rlon, rlat)
+
+    field = 2.0 + np.sin(xx / 5.0) * np.cos(yy / 7.0)
+    field += np.random.default_rng(0).normal(0.0, 0.01, field.shape)
+    # mimic the ocean and the masked arctic
+    field[(xx ** 2 / 900.0 + yy ** 2 / 700.0) > 1.0] = np.nan
+
+    return gen_dataset("dv", field, rlat, rlon, yy + 40.0, xx + 260.0, "kPa")
+
+
+def time_windowed_reads(path, window, n_reads=50):
+    rng = np.random.default_rng(1)
+    with xr.open_dataset(path) as ds:
+        ny, nx = ds.dv.shape
+        t0 = time.perf_counter()
+        for _ in range(n_reads):
+            i = rng.integers(0, ny - window)
+            j = rng.integers(0, nx - window)
+            ds.dv[i : i + window, j : j + window].values
+        return (time.perf_counter() - t0) / n_reads
+
+
+@click.command()
+@click.option("-s", "--scale", default=10, help="Grid refinement factor")
+@click.option("-w", "--window", default=30, help="Chunk and read window size")
+@click.option("-d", "--digits", default=4, help="Significant digits to keep")
+def benchmark(scale, window, digits):
+    ds = synthetic_dataset(scale)
+    writers = {
+        "default": lambda path: ds.to_netcdf(path, mode="w"),
+        "write_netcdf": lambda path: write_netcdf(ds, path, window=window),
+        f"write_netcdf ({digits} digits)": lambda path: write_netcdf(
+            ds, path, window=window, significant_digits=digits
+        ),
+    }
+
+    print(f"Grid shape {ds.dv.shape}, window {window}")
+    print(f"{'writer':<30}{'size (MB)':>12}{'write (s)':>12}{'read (ms)':>12}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for i, (name, writer) in enumerate(writers.items()):
+            path = os.path.join(tmpdir, f"{i}.nc")
+            t0 = time.perf_counter()
+            writer(path)
+            write_time = time.perf_counter() - t0
+            size = os.path.getsize(path) / 1e6
+            read_time = time_windowed_reads(path, window) * 1e3
+            print(f"{name:<30}{size:>12.2f}{write_time:>12.2f}{read_time:>12.2f}")
+
+
+if __name__ == "__main__":
+    benchmark()
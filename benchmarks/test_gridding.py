@@ -0,0 +1,49 @@
+from climpyrical.gridding import regrid_ensemble, rot2reg, _REMAP_CACHE
+from climpyrical.data import interpolate_dataset
+from conftest import GRID_SCALES, synthetic_grid
+
+import pytest
+import numpy as np
+
+
+@pytest.mark.parametrize("scale", GRID_SCALES)
+def test_regrid_ensemble(profiled, scale):
+    ds = synthetic_grid(1)
+    ds10 = profiled(regrid_ensemble, ds, "dv", scale, copy=True)
+    assert ds10.dv.shape == (130 * scale, 155 * scale)
+
+
+@pytest.mark.parametrize("scale", GRID_SCALES)
+@pytest.mark.parametrize("method", ["nearest", "bilinear"])
+def test_rot2reg(profiled, scale, method):
+    # remapping matrices are cached, clear them to time a cold start
+    ds = synthetic_grid(scale)
+    profiled(rot2reg, ds, method=method, setup=_REMAP_CACHE.clear, rounds=1)
+
+
+def valid_points(ds, valid=True):
+    rrlon, rrlat = np.meshgrid(ds.rlon.values, ds.rlat.values)
+    mask = ~np.isnan(ds.dv.values) if valid else np.isnan(ds.dv.values)
+    return np.stack([rrlon[mask], rrlat[mask]]).T, ds.dv.values[mask]
+
+
+@pytest.mark.parametrize("scale", GRID_SCALES)
+def test_interpolate_dataset_linear(profiled, scale):
+    # downscale the native grid as in preprocess_model
+    points, values = valid_points(synthetic_grid(1))
+    target_points, _ = valid_points(synthetic_grid(scale))
+    result = profiled(
+        interpolate_dataset, points, values, target_points, "linear", rounds=1
+    )
+    assert result.size == target_points.shape[0]
+
+
+@pytest.mark.parametrize("scale", GRID_SCALES)
+def test_interpolate_dataset_nearest(profiled, scale):
+    # fill the missing cells of a refined grid as in preprocess_model
+    points, values = valid_points(synthetic_grid(scale))
+    target_points, _ = valid_points(synthetic_grid(scale), valid=False)
+    result = profiled(
+        interpolate_dataset, points, values, target_points, "nearest", rounds=1
+    )
+    assert result.size == target_points.shape[0]
@@ -0,0 +1,34 @@
+from climpyrical.mask import gen_raster_mask_from_vector
+from conftest import GRID_SCALES, synthetic_grid, synthetic_polygon
+
+import pytest
+import numpy as np
+
+
+@pytest.mark.parametrize("scale", GRID_SCALES)
+@pytest.mark.parametrize("simplify", [False, True])
+def test_gen_raster_mask_from_vector(profiled, scale, simplify):
+    ds = synthetic_grid(scale)
+    p = synthetic_polygon()
+    mask = profiled(
+        gen_raster_mask_from_vector,
+        ds.rlon.values,
+        ds.rlat.values,
+        p,
+        progress_bar=False,
+        simplify=simplify,
+        rounds=1,
+    )
+    assert mask.shape == ds.dv.shape
+    assert mask.any()
+
+
+@pytest.mark.parametrize("scale", [1, 5])
+def test_gen_raster_mask_from_vector_simplify_matches(scale):
+    ds = synthetic_grid(scale)
+    p = synthetic_polygon()
+    args = ds.rlon.values, ds.rlat.values, p, False
+    np.testing.assert_array_equal(
+        gen_raster_mask_from_vector(*args, simplify=True),
+        gen_raster_mask_from_vector(*args),
+    )
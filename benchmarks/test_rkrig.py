@@ -0,0 +1,36 @@
+from climpyrical.rkrig import rkrig_py, rkrig_r, rkrig_sparse
+from conftest import GRID_SCALES, STATION_COUNTS, synthetic_grid, synthetic_stations
+
+import pytest
+import numpy as np
+
+
+@pytest.mark.parametrize("tiling", ["station", "kmeans", "quadtree"])
+@pytest.mark.parametrize("n", STATION_COUNTS)
+def test_rkrig_r(profiled, n, tiling):
+    # the moving window reconstruction needs R and fields
+    pytest.importorskip("rpy2")
+    ds = synthetic_grid(1)
+    df = synthetic_stations(n)
+    field = profiled(rkrig_r, df, 30, ds, "dv (kPa)", tiling=tiling, rounds=1)
+    assert field.shape == ds.dv.shape
+
+
+@pytest.mark.parametrize("scale", GRID_SCALES)
+@pytest.mark.parametrize("n", STATION_COUNTS)
+def test_rkrig_sparse(profiled, scale, n):
+    ds = synthetic_grid(scale)
+    df = synthetic_stations(n)
+    field = profiled(rkrig_sparse, df, ds)
+    assert field.shape == ds.dv.shape
+
+
+@pytest.mark.parametrize("masked", [False, True])
+@pytest.mark.parametrize("n", STATION_COUNTS)
+def test_rkrig_py(profiled, n, masked):
+    pytest.importorskip("pykrige")
+    ds = synthetic_grid(1)
+    df = synthetic_stations(n)
+    mask = ~np.isnan(ds.dv.values) if masked else None
+    field = profiled(rkrig_py, df, "dv (kPa)", 30, ds, mask=mask)
+    assert field.shape == ds.dv.shape
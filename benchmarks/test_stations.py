@@ -0,0 +1,14 @@
+from climpyrical.cmd.find_matched_model_vals import add_model_values
+from conftest import GRID_SCALES, STATION_COUNTS, synthetic_grid, synthetic_stations
+
+import pytest
+import numpy as np
+
+
+@pytest.mark.parametrize("scale", GRID_SCALES)
+@pytest.mark.parametrize("n", STATION_COUNTS)
+def test_add_model_values(profiled, scale, n):
+    ds = synthetic_grid(scale)
+    df = synthetic_stations(n)
+    df_new = profiled(add_model_values, ds=ds, df=df, log_level="WARNING")
+    assert not np.any(np.isnan(df_new.model_values))
@@ -14,6 +14,8 @@ from climpyrical.gridding import (
     find_nearest_index_value,
     transform_coords,
 )
+from climpyrical.stations import normalise_columns, read_stations
+from climpyrical import profiling
 
 import click
 import logging
@@ -26,6 +28,42 @@ import pandas as pd
 warnings.filterwarnings("ignore")
 
 
+@profiling.profiled
+def match_station_cells(df, rlon, rlat):
+    """Rotates station coordinates if needed and finds the grid cell
+    each station falls in. Matching only depends on the grid, so
+    the result can be shared by every model on the same grid.
+    Args:
+        df (pandas.DataFrame): stations with lat and lon, or rlat and rlon
+        rlon, rlat (np.ndarray): rotated pole grid coordinates
+    Returns:
+        df_new (pandas.DataFrame): df with normalised column names,
+            rlat, rlon and the matched irlat and irlon indices
+    """
+    df = normalise_columns(df)
+
+    keys = ["lat", "lon"]
+    contains_keys = [key not in df.columns for key in keys]
+    if np.any(contains_keys):
+        raise KeyError(f"Dataframe must contain {keys}")
+
+    rkeys = ["rlat", "rlon"]
+    contains_rkeys = [key not in df.columns for key in rkeys]
+    if np.any(contains_rkeys):
+        logging.info(
+            "rlat or rlon not detected in input file."
+            "converting assumes WGS84 coords to rotated pole"
+        )
+        nx, ny = transform_coords(df.lon.values, df.lat.values)
+        df = df.assign(rlat=ny, rlon=nx)
+
+    logging.info("Matching coordinates now")
+    ix, iy = find_element_wise_nearest_pos(rlon, rlat, df.rlon.values, df.rlat.values)
+
+    return df.assign(irlat=iy, irlon=ix)
+
+
+@profiling.profiled
 def add_model_values(
     model_path=None,
     ds=None,
@@ -33,6 +71,7 @@ def add_model_values(
     df=None,
     model_dv="model_values",
     log_level="INFO",
+    matched=False,
 ):
     """Locates the model value that's spatially closest to a station
     Args:
@@ -42,6 +81,8 @@ def add_model_values(
         out_path (str): directory of output csv file name. must include
             extension
         log_level (str): Default INFO
+        matched (bool): whether df already contains irlat and irlon
+            from match_station_cells on the model grid. Default False
     Returns:
         Creates a .csv file with corresponding model values.
     """
@@ -62,9 +103,6 @@ def add_model_values(
     (dv,) = ds.data_vars
     unit = ds[dv].attrs["units"]
 
-    rlon, rlat = np.meshgrid(ds.rlon, ds.rlat)
-    # mean = ds[dv].values
-
     accepted_units = ["kPa", "Pa", "degC", "mm", "unitless", "%"]
 
     logging.info(f"Detect units: {unit}")
@@ -73,79 +111,112 @@ def add_model_values(
             f"{unit} not recognized from list of accepted units: {accepted_units}"
         )
 
-    # if unit == "degC":
-    #     kelvin = 273.15  # K
-    #     logging.info("Temperature field detected. Converting to Kelvin.")
-    #     mean += kelvin
-    #     ds[dv].attrs["units"] = "K"
-
     if stations_path is not None:
-        if stations_path.endswith(".csv"):
-            df = pd.read_csv(stations_path)
-        else:
-            df = pd.read_excel(stations_path)
+        df = read_stations(stations_path)
 
     if stations_path is None and df is None:
         raise ValueError("Must provide either stations_path or pandas.Dataframe")
 
-    if "longitude" in df.columns:
-        df = df.rename(columns={"longitude": "lon"})
-    if "Lon" in df.columns:
-        df = df.rename(columns={"Lon": "lon"})
-    if "Lat" in df.columns:
-        df = df.rename(columns={"Lat": "lat"})
-    if "long" in df.columns:
-        df = df.rename(columns={"long": "lon"})
-    if "latitude" in df.columns:
-        df = df.rename(columns={"latitude": "lat"})
-    if "name" in df.columns:
-        df = df.rename(columns={"name": "station_name"})
-    if "Name" in df.columns:
-        df = df.rename(columns={"Name": "station_name"})
-    if "prov" in df.columns:
-        df = df.rename(columns={"prov": "province"})
-    if "elev" in df.columns:
-        df = df.rename(columns={"elev": "elev (m)"})
-    if "elevation (m)" in df.columns:
-        df = df.rename(columns={"elevation (m)": "elev (m)"})
-
-    keys = ["lat", "lon"]
-    contains_keys = [key not in df.columns for key in keys]
-    if np.any(contains_keys):
-        raise KeyError(f"Dataframe must contain {keys}")
-
-    rkeys = ["rlat", "rlon"]
-    contains_rkeys = [key not in df.columns for key in rkeys]
-    if np.any(contains_rkeys):
-        logging.info(
-            "rlat or rlon not detected in input file."
-            "converting assumes WGS84 coords to rotated pole"
-        )
-        nx, ny = transform_coords(df.lon.values, df.lat.values)
-        df = df.assign(rlat=ny, rlon=nx)
-
-    logging.info("Matching coordinates now")
-    ix, iy = find_element_wise_nearest_pos(
-        ds.rlon.values, ds.rlat.values, df.rlon.values, df.rlat.values
-    )
+    if matched:
+        ikeys = ["irlat", "irlon"]
+        if np.any([key not in df.columns for key in ikeys]):
+            raise KeyError(f"Dataframe must contain {ikeys} if matched")
+    else:
+        df = match_station_cells(df, ds.rlon.values, ds.rlat.values)
 
     logging.info(
         "Locating corresponding model values"
         "Interpolating to nearest if matched model value is NaN"
     )
     model_vals = find_nearest_index_value(
-        ds.rlon.values, ds.rlat.values, ix, iy, ds[dv].values
+        ds.rlon.values,
+        ds.rlat.values,
+        df.irlon.values,
+        df.irlat.values,
+        ds[dv].values,
     )
 
     if np.any(np.isnan(model_vals)):
         raise ValueError("NaN detected as matching output. Critical error.")
 
-    df_new = df.assign(irlat=iy, irlon=ix)
+    df_new = df.copy()
     df_new[model_dv] = model_vals
 
     return df_new
 
 
+@profiling.profiled
+def aggregate_stations(df, nx, first_columns=["station_name", "province"]):
+    """Aggregates stations that fall in the same grid cell. Numeric
+    columns are averaged, ignoring NaN, and first_columns keep the
+    value of the first station in the cell. Stations are sorted by a
+    flat cell id, irlat * nx + irlon, and every numeric column is
+    reduced at once.
+    Args:
+        df (pandas.DataFrame): stations with irlat and irlon, e.g. from
+            add_model_values
+        nx (int): number of columns (rlon) of the grid
+        first_columns (list): non-numeric columns to keep, if present.
+            Other non-numeric columns are dropped
+    Returns:
+        df_cells (pandas.DataFrame): one row per grid cell, sorted by
+            irlat and irlon, with the columns of df in their order
+            followed by n_stations, the number of stations in the cell
+    Raises:
+        KeyError: if df has no irlat or irlon
+        ValueError: if irlon is outside the grid
+    """
+    ikeys = ["irlat", "irlon"]
+    if np.any([key not in df.columns for key in ikeys]):
+        raise KeyError(f"Dataframe must contain {ikeys}")
+
+    irlat, irlon = df.irlat.values.astype(int), df.irlon.values.astype(int)
+    if np.any((irlon < 0) | (irlon >= nx)):
+        raise ValueError(f"irlon must be in [0, {nx})")
+
+    numeric = [
+        key
+        for key in df.columns
+        if key not in ikeys and np.issubdtype(df[key].dtype, np.number)
+    ]
+    first = [key for key in df.columns if key in first_columns and key not in numeric]
+    dtypes = {
+        key: df[key].dtype if df[key].dtype.kind == "f" else np.dtype(float)
+        for key in numeric
+    }
+    order = ikeys + [key for key in df.columns if key in numeric + first]
+
+    if df.shape[0] == 0:
+        # reduceat needs at least one station
+        df_cells = df[order].astype(dict(dtypes, irlat=int, irlon=int))
+        return df_cells.assign(n_stations=np.zeros(0, dtype=int))
+
+    cell = irlat * nx + irlon
+    ordered = np.argsort(cell, kind="stable")
+    sorted_cell = cell[ordered]
+    starts = np.flatnonzero(np.r_[True, sorted_cell[1:] != sorted_cell[:-1]])
+    cells = sorted_cell[starts]
+    n_stations = np.diff(np.r_[starts, cell.size])
+
+    values = df[numeric].values.astype(float)[ordered]
+    valid = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(valid, values, 0.0), starts, axis=0)
+    counts = np.add.reduceat(valid, starts, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+
+    columns = {"irlat": cells // nx, "irlon": cells % nx}
+    for j, key in enumerate(numeric):
+        columns[key] = means[:, j].astype(dtypes[key])
+    for key in first:
+        columns[key] = df[key].values[ordered[starts]]
+
+    profiling.count("stations_collapsed", int(df.shape[0] - cells.size))
+    logging.info(f"{df.shape[0]} stations in {cells.size} grid cells")
+
+    return pd.DataFrame(columns)[order].assign(n_stations=n_stations)
+
+
 @click.command()
 @click.option("-m", "--model-path", help="Input CanRCM4 file", required=True)
 @click.option("-s", "--stations-path", help="Input csv file to match", required=True)
@@ -158,6 +229,7 @@ def add_model_values(
     help="Output csv file with matched vals",
     required=True,
 )
+@click.option("-p", "--profile-path", help="Optional .json or .csv profile report")
 @click.option(
     "-l",
     "--log-level",
@@ -165,13 +237,20 @@ def add_model_values(
     type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]),
     default="INFO",
 )
-def write_to_file(model_path, stations_path, out_path, model_dv, log_level):
+def write_to_file(
+    model_path, stations_path, out_path, model_dv, profile_path, log_level
+):
+    if profile_path is not None:
+        profiling.enable()
     df = add_model_values(
         model_path=model_path,
         stations_path=stations_path,
         model_dv=model_dv,
-        log_level=log_level)
+        log_level=log_level,
+    )
     df.to_csv(out_path)
+    if profile_path is not None:
+        profiling.write_report(profile_path, model_path=model_path)
 
 
 if __name__ == "__main__":
@@ -8,8 +8,9 @@ downscales from 50 km to  5 km and fills in missing land values
 using external masks.
 """
 
-from climpyrical.data import read_data, gen_dataset, interpolate_dataset
+from climpyrical.data import read_data, gen_dataset, interpolate_dataset, write_netcdf
 from climpyrical.gridding import regrid_ensemble, extend_north
+from climpyrical import profiling
 
 import click
 from pkg_resources import resource_filename
@@ -22,70 +23,69 @@ import numpy as np
 warnings.filterwarnings("ignore")
 
 
-@click.command()
-@click.option("-i", "--in-path", help="Input CanRCM4 file", required=True)
-@click.option("-o", "--out-path", help="Output file", required=True)
-@click.option("-m", "--fill-glaciers", help="Refill glacier points", default=True)
-@click.option(
-    "-l",
-    "--log-level",
-    help="Logging level",
-    type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]),
-    default="INFO",
-)
-def downscale_and_fill(in_path, out_path, fill_glaciers, log_level):
-    """Takes a CanRCM4 model at the native resolution and
-    downscales from 50 km to  5 km and fills in missing
-    land values using external masks.
+@profiling.profiled
+def load_preprocess_masks(
+    canada_mask_path=resource_filename("climpyrical", "data/masks/canada_mask_rp.nc"),
+    north_mask_path=resource_filename(
+        "climpyrical", "data/masks/canada_mask_north_rp.nc"
+    ),
+    land_mask_path=resource_filename(
+        "climpyrical", "data/masks/land_mask_CanRCM4_sftlf.nc"
+    ),
+    glacier_mask_path=resource_filename("climpyrical", "data/masks/glacier_mask.nc"),
+):
+    """Loads the masks used by preprocess_model. The masks only depend
+    on the CanRCM4 grid, so they can be loaded once and shared by every
+    model on that grid.
+    Args:
+        canada_mask_path, north_mask_path (str): paths to the target
+            resolution Canada and northern (UAA) masks
+        land_mask_path, glacier_mask_path (str): paths to the native
+            resolution land and glacier masks
+    Returns:
+        masks (dict): boolean arrays keyed by "land" (regridded to the
+            target resolution), "land_og", "glacier", "canada" and
+            "north"
+    """
+    logging.info("Load and regrid file to target resolution")
+    mask = read_data(land_mask_path)
+    mask = regrid_ensemble(mask, "sftlf", 10, copy=True)
 
+    logging.info("Load original reoslution mask for reference")
+    return {
+        "land": mask["sftlf"].values >= 1.0,
+        "land_og": read_data(land_mask_path)["sftlf"].values != 0.0,
+        "glacier": read_data(glacier_mask_path)["mask"].values != 0.0,
+        "canada": read_data(canada_mask_path)["mask"].values,
+        "north": read_data(north_mask_path)["mask"].values,
+    }
+
+
+@profiling.profiled
+def preprocess_model(ds, fill_glaciers=True, masks=None):
+    """Downscales a CanRCM4 model dataset from 50 km to 5 km and fills
+    in missing land values using external masks.
     Args:
-        in_path, out_path (strings): directories of NetCDF4 file
-            input and output. Must give filename, too with extension
-            .nc. Overwites files with same name in same directory.
+        ds (xarray.Dataset): CanRCM4 model at native resolution
         fill_glaciers (bool): whether to fill spurious glacier
             points with preprocessed mask. Default is True.
-        log_level (str): Default INFO
+        masks (dict, optional): output of load_preprocess_masks.
+            Loaded from the default mask paths if None
     Returns:
-        Creates a NetCDF4 file at out_path at target resolution
+        ds_processed (xarray.Dataset): dataset at target resolution
     """
-    logging.basicConfig(level=log_level)
+    if masks is None:
+        masks = load_preprocess_masks()
 
-    ds = read_data(in_path)
     (dv,) = ds.data_vars
     unit = ds[dv].attrs["units"]
 
     rlon, rlat = np.meshgrid(ds.rlon, ds.rlat)
-    mean = ds[dv].values
+    mean = ds[dv].values.copy()
 
-    accepted_units = ["kPa", "Pa", "degC", "mm", "unitless", "%"]
-
-    logging.info(f"Detect units: {unit}")
-    if unit not in accepted_units:
-        warnings.warn(
-            f"{unit} not recognized from list of accepted units: {accepted_units}"
-        )
-
-    if unit == "degC":
-        kelvin = 273.15  # K
-        logging.info("Temperature field detected. Converting to Kelvin.")
-        mean += kelvin
-        ds[dv].attrs["units"] = "K"
-
-    # if other units need converting in the future, use pint
-
-    path_mask = resource_filename("climpyrical", "data/mask/land_mask_CanRCM4_sftlf.nc")
-
-    path_glacier_mask = resource_filename("climpyrical", "data/mask/glacier_mask.nc")
-
-    logging.info("Load and regrid file to target resolution")
-    mask = read_data(path_mask)
-    mask = regrid_ensemble(mask, "sftlf", 10, copy=True)
-    mask = mask["sftlf"] >= 1.0
-
-    logging.info("Load original reoslution mask for reference")
-    mask_og = read_data(path_mask)["sftlf"].values != 0.0
-
-    glaciermask = read_data(path_glacier_mask)["mask"].values != 0.0
+    mask = masks["land"]
+    mask_og = masks["land_og"]
+    glaciermask = masks["glacier"]
 
     logging.info(
         "Insert NaN values into glacier points to fill"
@@ -104,14 +104,13 @@ def downscale_and_fill(in_path, out_path, fill_glaciers, log_level):
         points, target_values, target_points, "linear"
     )
 
-    ds = gen_dataset(dv, mean, ds.rlat, ds.rlon, ds.lat, ds.lon, unit)
-
     logging.info("Remove water cells at original resolution")
-    ds[dv].values[~mask_og] = np.nan
-    nanmask = ~np.isnan(ds[dv].values)
+    mean[~mask_og] = np.nan
+    ds_filled = gen_dataset(dv, mean, ds.rlat, ds.rlon, ds.lat, ds.lon, unit)
+    nanmask = ~np.isnan(mean)
 
     logging.info("Copying and downscaling dataset 10x")
-    ds10 = regrid_ensemble(ds, dv, 10, copy=True)
+    ds10 = regrid_ensemble(ds_filled, dv, 10, copy=True)
     ds10[dv].values[~mask] = np.nan
     nrlon, nrlat = np.meshgrid(ds10.rlon, ds10.rlat)
     nanmask10 = ~np.isnan(ds10[dv].values)
@@ -119,21 +118,16 @@ def downscale_and_fill(in_path, out_path, fill_glaciers, log_level):
     logging.info("Interpolating full remaining grid")
     points = np.stack([rlon[nanmask], rlat[nanmask]]).T
     target_points = np.stack([nrlon[nanmask10], nrlat[nanmask10]]).T
-    values = ds[dv].values[nanmask]
+    values = mean[nanmask]
     ds10[dv].values[nanmask10] = interpolate_dataset(
         points, values, target_points, "linear"
     )
 
     logging.info("Add northern domain to model")
     ds10 = extend_north(ds10, dv, 210, fill_val=np.nan)
-
     nanmask10 = ~np.isnan(ds10[dv].values)
 
-    canada_mask_path = resource_filename("climpyrical", "/tests/data/canada_mask_rp.nc")
-
-    with read_data(canada_mask_path) as ds_canada:
-        ca_mask = extend_north(ds_canada, "mask", 210, fill_val=np.nan)
-        ca_mask = ds_canada["mask"].values
+    ca_mask = masks["canada"]
 
     # select NaN values within new mask
     ca_mask_or = ~np.logical_or(~ca_mask, nanmask10)
@@ -153,19 +147,91 @@ def downscale_and_fill(in_path, out_path, fill_glaciers, log_level):
     )
 
     logging.info("Remove the processed northern region.")
-    uaa_mask_path = resource_filename(
-        "climpyrical", "tests/data/canada_mask_north_rp.nc"
-    )
-    uaa_mask = read_data(uaa_mask_path)["mask"]
+    uaa_mask = masks["north"]
     temp_field[uaa_mask] = np.nan
 
     ds_processed = gen_dataset(
         dv, temp_field, ds10.rlat, ds10.rlon, ds10.lat, ds10.lon, unit
     )
 
+    # Populate new processed dataset with attributes from the original
+    if ds.attrs:
+        all_keys = set(ds_processed.variables).union(set(ds_processed.dims))
+        for key in all_keys:
+            ds_processed[key].attrs = ds[key].attrs
+        attr_dict = ds.attrs
+        attr_dict["Climpyrical"] = (
+            "CanRCM4 Reconstruction contains"
+            "hybrid station and model data using"
+            "Climpyrical (https://github.com/pacificclimate/climpyrical)"
+        )
+
+        ds_processed.attrs = attr_dict
+
+    return ds_processed
+
+
+@click.command()
+@click.option("-i", "--in-path", help="Input CanRCM4 file", required=True)
+@click.option("-o", "--out-path", help="Output file", required=True)
+@click.option("-m", "--fill-glaciers", help="Refill glacier points", default=True)
+@click.option("-p", "--profile-path", help="Optional .json or .csv profile report")
+@click.option(
+    "-l",
+    "--log-level",
+    help="Logging level",
+    type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]),
+    default="INFO",
+)
+def downscale_and_fill(in_path, out_path, fill_glaciers, profile_path, log_level):
+    """Takes a CanRCM4 model at the native resolution and
+    downscales from 50 km to  5 km and fills in missing
+    land values using external masks.
+
+    Args:
+        in_path, out_path (strings): directories of NetCDF4 file
+            input and output. Must give filename, too with extension
+            .nc. Overwites files with same name in same directory.
+        fill_glaciers (bool): whether to fill spurious glacier
+            points with preprocessed mask. Default is True.
+        profile_path (str, optional): records the time and memory
+            spent in each stage and writes a report here
+        log_level (str): Default INFO
+    Returns:
+        Creates a NetCDF4 file at out_path at target resolution
+    """
+    logging.basicConfig(level=log_level)
+    if profile_path is not None:
+        profiling.enable()
+
+    ds = read_data(in_path)
+    (dv,) = ds.data_vars
+    unit = ds[dv].attrs["units"]
+
+    accepted_units = ["kPa", "Pa", "degC", "mm", "unitless", "%"]
+
+    logging.info(f"Detect units: {unit}")
+    if unit not in accepted_units:
+        warnings.warn(
+            f"{unit} not recognized from list of accepted units: {accepted_units}"
+        )
+
+    if unit == "degC":
+        kelvin = 273.15  # K
+        logging.info("Temperature field detected. Converting to Kelvin.")
+        ds[dv].values += kelvin
+        ds[dv].attrs["units"] = "K"
+
+    # if other units need converting in the future, use pint
+
+    ds_processed = preprocess_model(ds, fill_glaciers)
+
     logging.info("Dataset generated and writing to file.")
 
-    ds_processed.to_netcdf(out_path, "w")
+    write_netcdf(ds_processed, out_path)
+
+    if profile_path is not None:
+        profiling.write_report(profile_path, in_path=in_path, out_path=out_path)
 
     logging.info("Completed!")
 
@@ -1,6 +1,7 @@
 import sys
-from climpyrical.data import read_data
+from climpyrical.data import read_data, write_netcdf
 from climpyrical.gridding import rot2reg
+from climpyrical import profiling
 import warnings
 
 warnings.filterwarnings("ignore")
@@ -8,11 +9,23 @@ warnings.filterwarnings("ignore")
 """
 quick usage of climpyrical.rot2reg
 usage:
-python rot2reg input.nc output.nc
+python rot2reg input.nc output.nc [method] [cache_dir] [profile_path]
+
+method is one of nearest (default), bilinear or conservative.
+Remapping matrices for bilinear and conservative are stored in
+cache_dir, if provided, and reused for inputs on the same grid.
+A .json or .csv report of the time spent in each stage is written
+to profile_path if provided.
 """
 
 IN_PATH = sys.argv[1]
 OUT_PATH = sys.argv[2]
+METHOD = sys.argv[3] if len(sys.argv) > 3 else "nearest"
+CACHE_DIR = sys.argv[4] if len(sys.argv) > 4 else None
+PROFILE_PATH = sys.argv[5] if len(sys.argv) > 5 else None
+
+if PROFILE_PATH is not None:
+    profiling.enable()
 
 ds = read_data(IN_PATH)
 
@@ -33,6 +46,9 @@ rotated_proj = {
     "no_defs": True,
 }
 
-reg_ds = rot2reg(ds)
+reg_ds = rot2reg(ds, method=METHOD, cache_dir=CACHE_DIR)
+
+write_netcdf(reg_ds, OUT_PATH)
 
-reg_ds.to_netcdf(OUT_PATH)
+if PROFILE_PATH is not None:
+    profiling.write_report(PROFILE_PATH, in_path=IN_PATH, method=METHOD)
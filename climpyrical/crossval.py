@@ -0,0 +1,511 @@
+"""
+quick usage of climpyrical crossval.py
+usage:
+python -m climpyrical.crossval -c config.yml -d RL50 -k 10 -s n=20 -s n=30
+
+Cross-validates the moving window reconstruction (MWOrK). Stations
+are split into folds and each fold is held out in turn: the ratios
+are rescaled and kriged from the remaining stations and the
+reconstruction is compared with the held out stations at their grid
+cells. Only the windows whose bounds contain a held out cell are
+kriged, so a fold costs a small part of a full reconstruction. Every
+setting is evaluated on a fold in the same process, sharing the
+neighbour query, the window plans of settings that differ only in
+blend, and each distinct window kriged. Folds are run across a
+multiprocessing pool.
+"""
+
+from climpyrical.gridding import scale_model_obs
+from climpyrical.profiling import profiled, count
+from climpyrical.rkrig import (
+    check_df,
+    station_neighbours,
+    plan_windows,
+    window_bbox,
+    krig_at_field,
+    taper_weights,
+)
+
+from multiprocessing import Pool
+import click
+import logging
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# columns of the table returned by cross_validate, followed by the
+# parameters of each setting
+CV_COLUMNS = [
+    "setting",
+    "fold",
+    "station",
+    "irlat",
+    "irlon",
+    "lat",
+    "lon",
+    "observed",
+    "predicted",
+    "error",
+    "n_windows",
+]
+
+# parameters of rkrig_r that choose the windows, with their defaults
+WINDOW_DEFAULTS = {"n": 30, "min_size": 30, "tiling": "station", "buffer": 0.5}
+
+# parameters of rkrig_r that can be compared
+SETTING_KEYS = list(WINDOW_DEFAULTS) + ["blend"]
+
+# stations, model, station_dv, settings and rules used by _cv_fold in
+# each process
+_CV = {}
+
+
+def make_folds(n_stations: int, k: int = None, seed: int = 0):
+    """Assigns stations to k folds of (nearly) equal size at random.
+    Args:
+        n_stations (int): number of stations
+        k (int, optional): number of folds. Leave-one-out if None or
+            at least n_stations
+        seed (int): random seed
+    Returns:
+        folds (np.ndarray): fold of each station, numbered from 0
+    Raises:
+        ValueError: if k is less than 2
+    """
+    if k is None or k >= n_stations:
+        return np.arange(n_stations)
+    if k < 2:
+        raise ValueError("Cross-validation needs at least 2 folds.")
+
+    order = np.random.RandomState(seed).permutation(n_stations)
+    folds = np.empty(n_stations, dtype=int)
+    folds[order] = np.arange(n_stations) % k
+
+    return folds
+
+
+@profiled
+def predict_cells(
+    df: pd.DataFrame,
+    ds,
+    station_dv: str,
+    irlat,
+    irlon,
+    n: int = 30,
+    min_size: int = 30,
+    blend: str = "mean",
+    tiling: str = "station",
+    buffer: float = 0.5,
+    rules: list = None,
+    plan: dict = None,
+    cache: dict = None,
+):
+    """Kriges the ratio field of rkrig_r at a few grid cells. The
+    windows are planned exactly as in rkrig_r, but only those whose
+    bounds contain one of the cells are kriged and blended.
+    Args:
+        df (pandas.DataFrame): stations with lat, lon, rlat, rlon
+            and ratio
+        ds (xarray.Dataset): model
+        station_dv (str): station design value column
+        irlat, irlon (np.ndarray): row and column of each cell
+        n, min_size, blend, tiling, buffer, rules: as in rkrig_r
+        plan (dict, optional): windows from plan_windows for the same
+            stations, replacing n, min_size, tiling, buffer and rules
+        cache (dict, optional): kriged values at the cells of each
+            window already kriged from the same stations, updated in
+            place. Windows with the same stations are kriged once
+    Returns:
+        ratio (np.ndarray): kriged ratio at each cell, NaN where no
+            window covers it
+        n_windows (np.ndarray): number of windows covering each cell
+    Raises:
+        ValueError: if blend is not mean or taper
+    """
+    from rpy2.rinterface_lib.embedded import RRuntimeError
+
+    check_df(df, ["lat", "lon", "rlat", "rlon", "ratio"])
+    if blend not in ["mean", "taper"]:
+        raise ValueError("Blend must be mean or taper.")
+
+    irlat, irlon = np.asarray(irlat), np.asarray(irlon)
+    xyr = df[["rlon", "rlat", "ratio"]].values
+    if plan is None:
+        plan = plan_windows(df, n, ds, station_dv, min_size, tiling, buffer, rules)
+    if cache is None:
+        cache = {}
+
+    total = np.zeros(irlat.size)
+    weights = np.zeros(irlat.size)
+    n_windows = np.zeros(irlat.size, dtype=int)
+
+    for i, ind in enumerate(plan["windows"]):
+        lw, u, l, r = window_bbox(ds, xyr[ind, :2])
+        inside = (irlat >= lw) & (irlat < u) & (irlon >= l) & (irlon < r)
+        if not np.any(inside):
+            continue
+
+        # the fitted surface does not depend on the order of stations
+        key = np.sort(ind).tobytes()
+        if key in cache:
+            count("windows_reused")
+        else:
+            try:
+                cache[key] = krig_at_field(ds, xyr[ind])[irlat, irlon].astype(float)
+                count("windows_kriged")
+            except RRuntimeError as e:
+                cache[key] = None
+                count("r_errors_skipped")
+                warnings.warn(
+                    f"Kriging the window of station {plan['stations'][i]}: {e}"
+                )
+        if cache[key] is None:
+            continue
+
+        rows, cols = irlat[inside], irlon[inside]
+        values = cache[key][inside]
+        weight = np.ones(values.size)
+        if blend == "taper":
+            weight = taper_weights(
+                ds.rlon.values[l:r], ds.rlat.values[lw:u], plan["centres"][i]
+            )[rows - lw, cols - l]
+
+        valid = ~np.isnan(values)
+        cells = np.flatnonzero(inside)[valid]
+        total[cells] += weight[valid] * values[valid]
+        weights[cells] += weight[valid]
+        n_windows[cells] += 1
+
+    with np.errstate(invalid="ignore"):
+        return total / weights, n_windows
+
+
+def _init_cv(df, ds, station_dv, settings, rules):
+    _CV.update(df=df, ds=ds, station_dv=station_dv, settings=settings, rules=rules)
+
+
+def _cv_fold(job):
+    """Holds out the stations test and returns their rows of the
+    cross-validation table for every setting."""
+    from climpyrical.pipeline import is_temperature, KELVIN
+
+    fold, test = job
+    df, ds, station_dv = _CV["df"], _CV["ds"], _CV["station_dv"]
+    settings, rules = _CV["settings"], _CV["rules"]
+    (dv,) = ds.data_vars
+
+    train, held_out = df.drop(index=df.index[test]), df.iloc[test]
+
+    # ratios are calculated in K for temperature fields, as in
+    # process_stations and reconstruct
+    offset = KELVIN if is_temperature(ds, station_dv) else 0.0
+    ratio, best_tol = scale_model_obs(
+        train.model_values.values + offset, train[station_dv].values + offset
+    )
+
+    train = train.assign(ratio=ratio)
+    irlat, irlon = held_out.irlat.values, held_out.irlon.values
+    model = ds[dv].values[irlat, irlon] + offset
+    observed = held_out[station_dv].values
+
+    # shared by every setting of the fold
+    largest = max(
+        [params.get("n", WINDOW_DEFAULTS["n"]) for params in settings]
+        + [rule["n"] for rule in rules or []]
+    )
+    neighbours = station_neighbours(train, max(largest, 100))
+    plans, cache = {}, {}
+
+    tables = []
+    for params in settings:
+        window = {key: params.get(key, value) for key, value in WINDOW_DEFAULTS.items()}
+        plan_key = tuple(window.values())
+        if plan_key not in plans:
+            plans[plan_key] = plan_windows(
+                train,
+                ds=ds,
+                station_dv=station_dv,
+                rules=rules,
+                neighbours=neighbours,
+                **window,
+            )
+
+        ratio_pred, n_windows = predict_cells(
+            train,
+            ds,
+            station_dv,
+            irlat,
+            irlon,
+            blend=params.get("blend", "mean"),
+            plan=plans[plan_key],
+            cache=cache,
+        )
+        predicted = ratio_pred * model / best_tol - offset
+
+        rows = pd.DataFrame(
+            {
+                "setting": setting_label(params),
+                "fold": fold,
+                "station": held_out.index,
+                "irlat": irlat,
+                "irlon": irlon,
+                "lat": held_out.lat.values,
+                "lon": held_out.lon.values,
+                "observed": observed,
+                "predicted": predicted,
+                "error": predicted - observed,
+                "n_windows": n_windows,
+            }
+        )
+        tables.append(rows.assign(**params))
+
+    return pd.concat(tables, ignore_index=True)
+
+
+def check_settings(settings: list) -> None:
+    """Checks that every setting only sets parameters in SETTING_KEYS
+    Args:
+        settings (list of dict): keyword arguments of rkrig_r
+    Raises:
+        ValueError: if a setting has another parameter
+    """
+    for params in settings:
+        unknown = set(params) - set(SETTING_KEYS)
+        if unknown:
+            raise ValueError(
+                f"Settings can only compare {SETTING_KEYS}, not {sorted(unknown)}"
+            )
+
+
+def run_folds(jobs: list, func, n_jobs: int, initargs: tuple) -> list:
+    """Maps func over jobs, across a pool of n_jobs processes if more
+    than one. The stations, model, station_dv, settings and rules in
+    initargs are sent to each process once.
+    Args:
+        jobs (list): arguments of each call
+        func (callable): module level function of one job reading
+            the cross-validation state
+        n_jobs (int): number of worker processes
+        initargs (tuple): df, ds, station_dv, settings and rules
+    Returns:
+        results (list): result of each job, in order
+    """
+    if n_jobs > 1 and len(jobs) > 1:
+        with Pool(min(n_jobs, len(jobs)), initializer=_init_cv, initargs=initargs) as p:
+            results = p.map(func, jobs, chunksize=1)
+    else:
+        _init_cv(*initargs)
+        results = [func(job) for job in jobs]
+    _CV.clear()
+
+    return results
+
+
+def fold_jobs(n_stations: int, k: int = None, seed: int = 0) -> list:
+    """Jobs of _cv_fold, the fold number and held out stations of
+    each fold from make_folds"""
+    folds = make_folds(n_stations, k, seed)
+    return [(fold, np.flatnonzero(folds == fold)) for fold in np.unique(folds)]
+
+
+def collect_folds(results: list, settings: list) -> pd.DataFrame:
+    """Concatenates the tables of each fold with the rows of each
+    setting together, in the order of settings"""
+    df_cv = pd.concat(results, ignore_index=True)
+    order = {setting_label(params): i for i, params in enumerate(settings)}
+
+    return df_cv.iloc[
+        np.argsort(df_cv.setting.map(order).values, kind="stable")
+    ].reset_index(drop=True)
+
+
+def setting_label(params: dict) -> str:
+    """Labels a setting by its parameters, e.g. "n=20,min_size=30"
+    Args:
+        params (dict): keyword arguments of rkrig_r
+    Returns:
+        label (str)
+    """
+    return ",".join(f"{key}={value}" for key, value in params.items()) or "default"
+
+
+@profiled
+def cross_validate(
+    df: pd.DataFrame,
+    ds,
+    station_dv: str,
+    k: int = 10,
+    settings: list = None,
+    n_jobs: int = 1,
+    seed: int = 0,
+    name: str = None,
+    rules: list = None,
+) -> pd.DataFrame:
+    """Cross-validates the moving window reconstruction of a design
+    value for one or more settings of rkrig_r. The same folds are
+    used for every setting, and each fold evaluates every setting in
+    one process so that windows they have in common are kriged once.
+    Args:
+        df (pandas.DataFrame): processed stations from
+            process_stations, with irlat, irlon and model_values
+        ds (xarray.Dataset): preprocessed model
+        station_dv (str): station design value column
+        k (int): number of folds, leave-one-out if None
+        settings (list of dict, optional): keyword arguments of
+            rkrig_r to compare, i.e. n, min_size, blend, tiling and
+            buffer. Defaults to rkrig_r's defaults
+        n_jobs (int): number of worker processes
+        seed (int): random seed of the folds
+        name (str, optional): design value name added as a "dv"
+            column
+        rules (list, optional): initial window sizes, see
+            initial_window_sizes
+    Returns:
+        df_cv (pandas.DataFrame): one row per held out station and
+            setting, with CV_COLUMNS followed by the setting's
+            parameters
+    Raises:
+        ValueError: if a setting has a parameter not in SETTING_KEYS
+    """
+    check_df(
+        df, ["lat", "lon", "rlat", "rlon", "irlat", "irlon", "model_values", station_dv]
+    )
+    if settings is None:
+        settings = [{}]
+    check_settings(settings)
+
+    jobs = fold_jobs(df.shape[0], k, seed)
+    results = run_folds(jobs, _cv_fold, n_jobs, (df, ds, station_dv, settings, rules))
+
+    df_cv = collect_folds(results, settings)
+    if name is not None:
+        df_cv.insert(0, "dv", name)
+
+    return df_cv
+
+
+def error_table(df_cv: pd.DataFrame) -> pd.DataFrame:
+    """Summarises a cross-validation table per design value and
+    setting.
+    Args:
+        df_cv (pandas.DataFrame): table from cross_validate
+    Returns:
+        df_errors (pandas.DataFrame): one row per design value and
+            setting with the number of held out stations, the fraction
+            covered by a window, and the bias, mean absolute error,
+            root mean squared error and largest absolute error
+    """
+    by = [key for key in ["dv", "setting"] if key in df_cv.columns]
+
+    def stats(group):
+        error = group.error.dropna()
+        return pd.Series(
+            {
+                "stations": group.shape[0],
+                "coverage": error.size / group.shape[0],
+                "bias": error.mean(),
+                "mae": error.abs().mean(),
+                "rmse": np.sqrt((error**2).mean()),
+                "max_abs_error": error.abs().max(),
+            }
+        )
+
+    df_errors = df_cv.groupby(by, sort=False).apply(stats).reset_index()
+    return df_errors.astype({"stations": int})
+
+
+def parse_setting(setting: str) -> dict:
+    """Parses a setting such as "n=20,blend=taper" into keyword
+    arguments of rkrig_r.
+    Args:
+        setting (str): comma separated key=value pairs
+    Returns:
+        params (dict)
+    Raises:
+        ValueError: if a pair has no "="
+    """
+    import yaml
+
+    params = {}
+    for pair in filter(None, setting.split(",")):
+        if "=" not in pair:
+            raise ValueError(f"Setting {pair} must be of the form key=value")
+        key, value = pair.split("=", 1)
+        params[key.strip()] = yaml.safe_load(value)
+
+    return params
+
+
+@click.command()
+@click.option("-c", "--config-path", help="Pipeline YAML config", required=True)
+@click.option(
+    "-d",
+    "--dv",
+    "names",
+    help="Design value to cross-validate. May be repeated. Defaults to all",
+    multiple=True,
+)
+@click.option("-k", "--folds", help="Number of folds, 0 for leave-one-out", default=10)
+@click.option(
+    "-s",
+    "--setting",
+    "settings",
+    help="Setting of rkrig_r to compare, e.g. n=20,min_size=30. May be repeated",
+    multiple=True,
+)
+@click.option("-n", "--n-jobs", help="Number of worker processes", default=1)
+@click.option("-o", "--output-path", help="Optional csv file of every prediction")
+@click.option("-e", "--errors-path", help="Optional csv file of the error table")
+@click.option(
+    "-l",
+    "--log-level",
+    help="Logging level",
+    type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]),
+    default="INFO",
+)
+def main(
+    config_path, names, folds, settings, n_jobs, output_path, errors_path, log_level
+):
+    from climpyrical.pipeline import load_config, stage_io, DSOLD_MAX
+    from climpyrical.data import read_data
+
+    logging.basicConfig(level=log_level)
+    config = load_config(config_path)
+    settings = [parse_setting(setting) for setting in settings] or None
+
+    tables = []
+    for name in names or config["dvs"]:
+        station_dv = config["dvs"][name]["station_dv"]
+        model_path, stations_path = stage_io("MWOrK", name, config)[0][:2]
+        ds = read_data(model_path)
+        df = pd.read_csv(stations_path)
+
+        # the moving windows only reconstruct the south
+        df = df[df.rlat <= DSOLD_MAX].reset_index(drop=True)
+        logging.info(f"Cross-validating {name} with {df.shape[0]} stations")
+        tables.append(
+            cross_validate(
+                df,
+                ds,
+                station_dv,
+                folds or None,
+                settings,
+                n_jobs,
+                name=name,
+                rules=config["dvs"][name].get("window_rules"),
+            )
+        )
+
+    df_cv = pd.concat(tables, ignore_index=True)
+    df_errors = error_table(df_cv)
+    click.echo(df_errors.round(4).to_string(index=False))
+
+    if output_path is not None:
+        df_cv.to_csv(output_path, index=False)
+    if errors_path is not None:
+        df_errors.to_csv(errors_path, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
+from climpyrical.profiling import profiled
+
+import os
+import json
 import xarray as xr
 import numpy as np
 from nptyping import NDArray
 from typing import Any, Union
-from scipy.interpolate import LinearNDInterpolator, NearestNDInterpolator
 
 
 def check_valid_keys(all_keys: list, required_keys: list) -> bool:
@@ -26,18 +29,17 @@ def check_valid_keys(all_keys: list, required_keys: list) -> bool:
     return True
 
 
-def check_valid_data(ds: xr.Dataset) -> bool:
-    """A function to test that the data loaded is valid and expected.
+def check_valid_coords(ds: xr.Dataset) -> bool:
+    """A function to test that the rotated coordinate axes are valid.
+    Only the coordinate variables are read, so this is cheap even for
+    large lazily loaded datasets.
     Args:
         ds (xarray.DataSet): ensemble with all relevant data
-        design_value_name (str): name of design value exactly as appears
-            in the NetCDF4 file
     Returns:
         bool: True of passed, raises error if not.
     Raises:
-        ValueError if loaded data is unexpected or invalid
+        ValueError if coordinates are unexpected or invalid
     """
-
     if ("rlat" in set(ds.variables).union(set(ds.dims))) or (
         "rlon" in set(ds.variables).union(set(ds.dims))
     ):
@@ -48,7 +50,63 @@ def check_valid_data(ds: xr.Dataset) -> bool:
         ):
             raise ValueError("Coordinate axis are not monotonically increasing")
 
-    if bool(np.all(ds.to_array().isnull()).values):
+    return True
+
+
+def has_valid_values(da: xr.DataArray, rows: int = 256) -> bool:
+    """Checks whether an array contains at least one value that is
+    not NaN. The array is scanned chunk by chunk (or in blocks of rows
+    for in-memory arrays) and the scan stops at the first valid value,
+    so only as much data as necessary is read.
+    Args:
+        da (xarray.DataArray): array to scan
+        rows (int): number of rows per block for arrays that are
+            not dask backed
+    Returns:
+        bool: True if any value is not NaN
+    """
+    if da.size == 0:
+        return False
+    if not np.issubdtype(da.dtype, np.floating):
+        return True
+
+    if da.chunks is not None:
+        for block in da.data.to_delayed().ravel():
+            if np.any(~np.isnan(block.compute())):
+                return True
+        return False
+
+    if da.ndim == 0:
+        return bool(~np.isnan(da.values))
+
+    # lazily indexed arrays only read the rows that are selected
+    for start in range(0, da.shape[0], rows):
+        block = da.isel({da.dims[0]: slice(start, start + rows)}).values
+        if np.any(~np.isnan(block)):
+            return True
+
+    return False
+
+
+def check_valid_data(ds: xr.Dataset, lazy: bool = False) -> bool:
+    """A function to test that the data loaded is valid and expected.
+    Args:
+        ds (xarray.DataSet): ensemble with all relevant data
+        lazy (bool): False, whether to check for valid values with
+            a short-circuiting chunked scan instead of loading all
+            variables
+    Returns:
+        bool: True of passed, raises error if not.
+    Raises:
+        ValueError if loaded data is unexpected or invalid
+    """
+
+    check_valid_coords(ds)
+
+    if lazy:
+        if not any(has_valid_values(ds[key]) for key in ds.data_vars):
+            raise ValueError("All values are NaN. Check input.")
+    elif bool(np.all(ds.to_array().isnull()).values):
         raise ValueError("All values are NaN. Check input.")
 
     return True
@@ -56,11 +114,11 @@ def check_valid_data(ds: xr.Dataset) -> bool:
 
 def gen_dataset(
     dv: str,
-    field: Union[NDArray[(Any, Any), Any], NDArray[(Any, Any, Any), Any]],
-    rlat: NDArray[(Any,), float],
-    rlon: NDArray[(Any,), float],
-    lat: NDArray[(Any, Any), float],
-    lon: NDArray[(Any, Any), float],
+    field: "Union[NDArray[(Any, Any), Any], NDArray[(Any, Any, Any), Any]]",
+    rlat: "NDArray[(Any,), float]",
+    rlon: "NDArray[(Any,), float]",
+    lat: "NDArray[(Any, Any), float]",
+    lon: "NDArray[(Any, Any), float]",
     unit: str = "",
 ) -> xr.Dataset:
     """Generates standard climpyrical xarray Dataset.
@@ -93,13 +151,35 @@ def gen_dataset(
     return ds
 
 
+def ancillary_variables(ds: xr.Dataset) -> set:
+    """Finds the variables that describe another variable, listed
+    in its CF "ancillary_variables" attribute, such as the variance
+    written alongside a reconstruction.
+    Args:
+        ds (xarray Dataset): dataset
+    Returns:
+        names (set): names of the ancillary variables in ds
+    """
+    names = set()
+    for key in ds.data_vars:
+        names.update(ds[key].attrs.get("ancillary_variables", "").split())
+
+    return names & set(ds.data_vars)
+
+
+@profiled
 def read_data(
-    data_path: str, required_keys: list = ["rlat", "rlon", "lat", "lon"]
+    data_path: str,
+    required_keys: list = ["rlat", "rlon", "lat", "lon"],
+    lazy: bool = False,
+    chunks: Union[dict, str] = "auto",
 ) -> xr.Dataset:
     """Load NetCDF4 file. Default checks are for CanRCM4 model keys.
 
     Note that 'rlat', 'lat', 'lon', 'rlon' are all required in addition
     to a single data variable that contains a field of interest.
+    Intermediate stores written with write_store are also accepted
+    and loaded with read_store.
     -----------------------------------------------------------------
     Args:
         data_path (Str): path to folder
@@ -107,6 +187,11 @@ def read_data(
         required_keys (list, optional): list of required keys in netCDF4
             file. Default requirements are only that it contains
             rotated lat and rotated lon coords called rlon and rlat
+        lazy (bool): False, whether to open the file with dask chunks
+            and return a dask-backed dataset. Validation then reads
+            only the coordinate axes and as many chunks as needed to
+            find a valid value.
+        chunks (dict or str): dask chunks to use if lazy is True
     Returns:
         ds (xarray Dataset): dataset of netCDF4 file
     Raises:
@@ -116,60 +201,346 @@ def read_data(
         TypeError if path provided is invalid
     """
 
+    if is_store(data_path):
+        return read_store(data_path, required_keys)
+
     if not data_path.endswith(".nc"):
         raise TypeError("climpyrical requires a NetCDF4 file with extension .nc")
 
+    if lazy:
+        # the file must stay open for the dask-backed result
+        ds = xr.open_dataset(data_path, chunks=chunks)
+        return standardize_dataset(ds, required_keys, lazy=True)
+
     with xr.open_dataset(data_path) as ds:
-        all_keys = set(ds.variables).union(set(ds.dims))
-
-        check_valid_keys(all_keys, required_keys)
-        check_valid_data(ds)
-
-        # keys with size > 2 are good, otherwise
-        # are superfluous (time, time_bnds, rotated_pole, etc)
-        extra_keys = [key for key in all_keys if ds[key].size <= 2]
-
-        # check how many data variables with
-        # size > 2 are remaining. If more than one
-        # raise error as we can't distinguish from
-        # the intended variable.
-        dv = set(ds.data_vars) - set(extra_keys)
-        if len(dv) != 1:
-            raise KeyError(
-                "Too many data variables detected."
-                f"Found {dv}, please remove the"
-                "field that is not of interest."
-            )
-        else:
-            (dv,) = dv
+        return standardize_dataset(ds, required_keys)
 
-        # drop an extra dimension if it snuck in
-        dvfield = ds[dv].squeeze(drop=True)
 
+def standardize_dataset(
+    ds: xr.Dataset,
+    required_keys: list = ["rlat", "rlon", "lat", "lon"],
+    lazy: bool = False,
+) -> xr.Dataset:
+    """Validates an opened dataset and converts it to the standard
+    climpyrical Dataset containing a single design value field.
+    Args:
+        ds (xarray Dataset): opened dataset
+        required_keys (list, optional): list of required keys
+        lazy (bool): False, whether to keep the data dask backed
+            and validate it without loading it
+    Returns:
+        ds (xarray Dataset): standard climpyrical dataset
+    Raises:
+        ValueError: if file contains unexpected or invalid data
+        KeyError if dataset is missing required keys
+    """
+    all_keys = set(ds.variables).union(set(ds.dims))
+
+    check_valid_keys(all_keys, required_keys)
+    check_valid_data(ds, lazy=lazy)
+
+    # keys with size > 2 are good, otherwise
+    # are superfluous (time, time_bnds, rotated_pole, etc)
+    extra_keys = [key for key in all_keys if ds[key].size <= 2]
+
+    # check how many data variables with
+    # size > 2 are remaining. If more than one
+    # raise error as we can't distinguish from
+    # the intended variable. Ancillary variables,
+    # e.g. the variance of a reconstruction, are
+    # never the intended variable.
+    dv = set(ds.data_vars) - set(extra_keys) - ancillary_variables(ds)
+    if len(dv) != 1:
+        raise KeyError(
+            "Too many data variables detected."
+            f"Found {dv}, please remove the"
+            "field that is not of interest."
+        )
+    else:
+        (dv,) = dv
+
+    # drop an extra dimension if it snuck in
+    dvfield = ds[dv].squeeze(drop=True)
+
+    if lazy:
+        # pass the underlying dask arrays so nothing is loaded
+        ds_new = gen_dataset(
+            dv, dvfield.data, ds.rlat.values, ds.rlon.values, ds.lat.data, ds.lon.data
+        )
+    else:
         ds_new = gen_dataset(dv, dvfield, ds.rlat, ds.rlon, ds.lat, ds.lon)
 
-        if ds.attrs:
-            all_keys = set(ds_new.variables).union(set(ds_new.dims))
-            for key in all_keys:
-                ds_new[key].attrs = ds[key].attrs
-            attr_dict = ds.attrs
-            attr_dict["Climpyrical"] = (
-                "CanRCM4 Reconstruction contains"
-                "hybrid station and model data using"
-                "Climpyrical (https://github.com/pacificclimate/climpyrical)"
-            )
+    if ds.attrs:
+        all_keys = set(ds_new.variables).union(set(ds_new.dims))
+        for key in all_keys:
+            ds_new[key].attrs = ds[key].attrs
+        attr_dict = ds.attrs
+        attr_dict["Climpyrical"] = (
+            "CanRCM4 Reconstruction contains"
+            "hybrid station and model data using"
+            "Climpyrical (https://github.com/pacificclimate/climpyrical)"
+        )
+
+        ds_new.attrs = attr_dict
+
+    return ds_new
+
+
+# name of the metadata file describing an intermediate store
+STORE_METADATA = "climpyrical_store.json"
+
+
+def _to_json(value):
+    # convert numpy attribute values to json serializable types
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def is_store(path: str) -> bool:
+    """Checks whether a path is an intermediate store written by
+    write_store.
+    Args:
+        path (str): path to check
+    Returns:
+        bool: True if path is an npy or zarr intermediate store
+    """
+    return os.path.isfile(os.path.join(path, STORE_METADATA)) or (
+        path.rstrip("/").endswith(".zarr") and os.path.isdir(path)
+    )
+
+
+@profiled
+def write_store(ds: xr.Dataset, path: str, fmt: str = "npy") -> None:
+    """Writes a climpyrical dataset to an intermediate store for fast
+    exchange between pipeline stages. The npy format stores every field,
+    mask and coordinate as an uncompressed .npy file that can be memory
+    mapped, so processes reading the same store share it through the
+    page cache. The zarr format writes an uncompressed zarr store.
+    NetCDF remains the format for published results.
+    Args:
+        ds (xarray Dataset): dataset to store
+        path (str): directory to write the store to. Zarr stores must
+            end with .zarr
+        fmt (str): 'npy' or 'zarr'
+    Raises:
+        ValueError: if fmt is not recognized
+    """
+    if fmt == "zarr":
+        if not path.rstrip("/").endswith(".zarr"):
+            raise ValueError("Zarr stores must have extension .zarr")
+        encoding = {key: {"compressor": None} for key in ds.variables}
+        ds.to_zarr(path, mode="w", encoding=encoding)
+        return
+
+    if fmt != "npy":
+        raise ValueError("Format must be npy or zarr.")
+
+    os.makedirs(path, exist_ok=True)
+
+    variables = {}
+    for i, key in enumerate(ds.variables):
+        filename = f"{i}.npy"
+        np.save(os.path.join(path, filename), np.asarray(ds[key].values))
+        variables[key] = {
+            "file": filename,
+            "dims": list(ds[key].dims),
+            "coord": key in ds.coords,
+            "attrs": {k: _to_json(v) for k, v in ds[key].attrs.items()},
+        }
+
+    metadata = {
+        "format": "npy",
+        "variables": variables,
+        "attrs": {k: _to_json(v) for k, v in ds.attrs.items()},
+    }
+
+    # metadata is written last so that partial stores are not detected
+    with open(os.path.join(path, STORE_METADATA), "w") as f:
+        json.dump(metadata, f)
+
+
+@profiled
+def read_store(
+    path: str,
+    required_keys: list = ["rlat", "rlon", "lat", "lon"],
+    mmap: bool = True,
+) -> xr.Dataset:
+    """Loads an intermediate store written by write_store with the same
+    checks as read_data. Arrays in npy stores are memory mapped copy-on-write
+    unless mmap is False, so processes share pages until they modify them,
+    and zarr stores are returned dask backed. No data is copied until it
+    is used.
+    Args:
+        path (str): directory of the store
+        required_keys (list, optional): list of required keys
+        mmap (bool): True, whether to memory map npy arrays
+    Returns:
+        ds (xarray Dataset): standard climpyrical dataset
+    Raises:
+        FileNotFoundError: if path is not an intermediate store
+        ValueError: if store contains unexpected or invalid data
+        KeyError if store is missing required keys
+    """
+    if not is_store(path):
+        raise FileNotFoundError(f"No climpyrical store found at {path}")
+
+    if not os.path.isfile(os.path.join(path, STORE_METADATA)):
+        return standardize_dataset(xr.open_zarr(path), required_keys, lazy=True)
+
+    with open(os.path.join(path, STORE_METADATA)) as f:
+        metadata = json.load(f)
+
+    mmap_mode = "c" if mmap else None
+
+    data_vars, coords = {}, {}
+    for key, meta in metadata["variables"].items():
+        values = np.load(os.path.join(path, meta["file"]), mmap_mode=mmap_mode)
+        variable = xr.Variable(meta["dims"], values, attrs=meta["attrs"])
+        if meta["coord"]:
+            coords[key] = variable
+        else:
+            data_vars[key] = variable
+
+    ds = xr.Dataset(data_vars, coords=coords, attrs=metadata["attrs"])
+
+    return standardize_dataset(ds, required_keys, lazy=True)
+
+
+def round_significant_digits(
+    values: "NDArray[(Any, ...), float]", significant_digits: int
+) -> "NDArray[(Any, ...), float]":
+    """Quantises floating point values to a number of significant decimal
+    digits by rounding the trailing mantissa bits to zero. The result has
+    the same dtype as values, but compresses far better with zlib and
+    shuffle. NaN and infinite values are left untouched.
+    Args:
+        values (np.ndarray): floating point array
+        significant_digits (int): number of significant decimal
+            digits to keep
+    Returns:
+        (np.ndarray): quantised copy of values
+    """
+    if not isinstance(significant_digits, int) or significant_digits < 1:
+        raise ValueError("significant_digits must be a positive integer.")
+
+    values = np.array(values, copy=True)
+    if not np.issubdtype(values.dtype, np.floating):
+        raise TypeError("Only floating point values can be quantised.")
+
+    nmant = np.finfo(values.dtype).nmant
+    keepbits = int(np.ceil(significant_digits * np.log2(10)))
+    if keepbits >= nmant:
+        return values
+
+    uint = np.dtype(f"uint{values.dtype.itemsize * 8}").type
+    drop = nmant - keepbits
+    half = uint(1 << (drop - 1))
+    keep = ~uint((1 << drop) - 1)
+
+    finite = np.isfinite(values)
+    bits = values.view(uint)
+    bits[finite] = (bits[finite] + half) & keep
+
+    return values
+
+
+def netcdf_encoding(
+    ds: xr.Dataset,
+    window: int = 30,
+    complevel: int = 4,
+    dtype: str = "float32",
+) -> dict:
+    """Generates a NetCDF4 encoding for a climpyrical dataset. Variables
+    with two or more dimensions are chunked in tiles of window cells so
+    that spatial windows can be read without decompressing whole rows,
+    and every variable is compressed with zlib and shuffle. Floating
+    point fields and the 2D lat/lon are stored with dtype.
+    Args:
+        ds (xarray Dataset): dataset to encode
+        window (int): chunk size in grid cells along each axis, ideally
+            the kriging window size
+        complevel (int): zlib compression level from 1 to 9
+        dtype (str or None): dtype for floating point fields and lat/lon.
+            None keeps the dtype of the dataset
+    Returns:
+        encoding (dict): encoding for xarray.Dataset.to_netcdf
+    """
+    if not isinstance(window, int) or window < 1:
+        raise ValueError("window must be a positive integer.")
+
+    encoding = {}
+    for key in ds.variables:
+        da = ds[key]
+        if key in ds.dims:
+            # index coordinates keep full precision for grid matching
+            continue
+
+        enc = {"zlib": True, "complevel": complevel, "shuffle": True}
+        if da.ndim >= 2:
+            enc["chunksizes"] = tuple(min(window, size) for size in da.shape)
+        if np.issubdtype(da.dtype, np.floating):
+            enc["_FillValue"] = np.nan
+            if dtype is not None:
+                enc["dtype"] = dtype
+
+        encoding[key] = enc
+
+    return encoding
+
+
+@profiled
+def write_netcdf(
+    ds: xr.Dataset,
+    path: str,
+    window: int = 30,
+    complevel: int = 4,
+    significant_digits: int = None,
+    dtype: str = "float32",
+) -> None:
+    """Writes a climpyrical dataset to a chunked and compressed NetCDF4 file.
+    This should be used by every stage that writes NetCDF4 output.
+    Args:
+        ds (xarray Dataset): dataset to write
+        path (str): output file with extension .nc. Overwrites files
+            with the same name.
+        window (int): chunk size in grid cells along each axis, ideally
+            the kriging window size
+        complevel (int): zlib compression level from 1 to 9
+        significant_digits (int, optional): number of significant digits
+            to quantise floating point data variables to before writing
+        dtype (str or None): dtype for floating point fields and lat/lon.
+            None keeps the dtype of the dataset
+    Raises:
+        TypeError if path provided is invalid
+    """
+    if not path.endswith(".nc"):
+        raise TypeError("climpyrical requires a NetCDF4 file with extension .nc")
 
-            ds_new.attrs = attr_dict
+    if significant_digits is not None:
+        ds = ds.copy()
+        for key in ds.data_vars:
+            if np.issubdtype(ds[key].dtype, np.floating):
+                values = ds[key].values
+                if dtype is not None:
+                    values = values.astype(dtype)
+                ds[key].values = round_significant_digits(
+                    values, significant_digits
+                )
 
-        return ds_new
+    encoding = netcdf_encoding(ds, window, complevel, dtype)
+    ds.to_netcdf(path, mode="w", format="NETCDF4", encoding=encoding)
 
 
+@profiled
 def interpolate_dataset(
-    points: NDArray[(2, Any), float],
-    values: NDArray[(Any, Any), float],
-    target_points: NDArray[(2, Any), float],
+    points: "NDArray[(2, Any), float]",
+    values: "NDArray[(Any, Any), float]",
+    target_points: "NDArray[(2, Any), float]",
     method: str,
-) -> NDArray[(Any,), float]:
+) -> "NDArray[(Any,), float]":
 
     """Generates standard climpyrical xarray Dataset.
     ------------------------------
@@ -188,6 +559,8 @@ def interpolate_dataset(
     if method != "linear" and method != "nearest":
         raise ValueError("Method must be linear or nearest.")
 
+    from scipy.interpolate import LinearNDInterpolator, NearestNDInterpolator
+
     method_dict = {
         "linear": LinearNDInterpolator(points, values),
         "nearest": NearestNDInterpolator(points, values),
@@ -1,18 +1,23 @@
 from climpyrical.data import gen_dataset, check_valid_keys
+from climpyrical.profiling import profiled
 
+import os
+import json
+import hashlib
 import warnings
 import numpy as np
 import xarray as xr
-from scipy.interpolate import NearestNDInterpolator
-from pyproj import Transformer, Proj
 from nptyping import NDArray
-from typing import Any, Tuple
+from typing import TYPE_CHECKING, Any, Tuple
+
+if TYPE_CHECKING:
+    from scipy import sparse
 
 
 def scale_model_obs(
-    model_vals: NDArray[(Any, Any), float],
-    station_vals: NDArray[(Any,), float],
-) -> Tuple[NDArray[(Any,), float], float]:
+    model_vals: "NDArray[(Any, Any), float]",
+    station_vals: "NDArray[(Any,), float]",
+) -> "Tuple[NDArray[(Any,), float], float]":
     """Returns the ratio of station values to scaled model values.
     scaled model values are scaled by a factor that minimizes the
     mean difference of the station values and model values at
@@ -132,6 +137,7 @@ def check_input_coords(x, y, ds):
     close_range(y, ds, "rlat")
 
 
+@profiled
 def regrid_ensemble(
     ds: xr.Dataset,
     dv: str,
@@ -216,6 +222,7 @@ def regrid_ensemble(
     return regridded_ds
 
 
+@profiled
 def extend_north(
     ds: xr.Dataset, dv: str, amount: int, fill_val: float = np.nan
 ) -> xr.Dataset:
@@ -279,8 +286,8 @@ def extend_north(
 
 
 def flatten_coords(
-    x: NDArray[(Any,), float], y: NDArray[(Any,), float]
-) -> Tuple[NDArray[(Any,), float], NDArray[(Any,), float]]:
+    x: "NDArray[(Any,), float]", y: "NDArray[(Any,), float]"
+) -> "Tuple[NDArray[(Any,), float], NDArray[(Any,), float]]":
     """Takes the rlat and rlon 1D arrays from the
     NetCDF files for each ensemble member, and creates
     an ordered pairing of each grid cell coordinate in
@@ -340,6 +347,7 @@ def check_transform_coords_inputs(x, y, source_crs, target_crs):
         )
 
 
+@profiled
 def transform_coords(
     x,
     y,
@@ -378,6 +386,8 @@ def transform_coords(
                     in WGS84
     """
     check_transform_coords_inputs(x, y, source_crs, target_crs)
+    from pyproj import Transformer, Proj
+
     p_source = Proj(source_crs)
     p_target = Proj(target_crs)
     t = Transformer.from_proj(p_source, p_target)
@@ -449,6 +459,35 @@ def find_nearest_index(data, val):
     return best_ind
 
 
+def find_nearest_indices(data, vals):
+    """Vectorised find_nearest_index: finds the index of the closest
+    value in a monotonically increasing array for every value in
+    vals at once. Values halfway between two elements of data go to
+    the lower index, whereas find_nearest_index may return either.
+    Args:
+        data (np.ndarray): monotonically increasing array of column or row
+            coordinates
+        vals (np.ndarray): locations in x (rlon) or y (rlat) coords
+    Returns:
+        ind (np.ndarray): integer index in data of the closest data
+            value to each of vals
+    Raises:
+        TypeError:
+                If data is not an array
+        ValueError:
+                If data is not monotonically increasing
+                If size is not greater than 1
+    """
+    check_find_nearest_index_inputs(data, 0.0)
+    vals = np.asarray(vals, dtype=float)
+
+    right = np.clip(np.searchsorted(data, vals), 1, data.size - 1)
+    left = right - 1
+    closer_left = np.abs(vals - data[left]) <= np.abs(data[right] - vals)
+
+    return np.where(closer_left, left, right)
+
+
 def check_find_element_wise_nearest_pos_inputs(x, y, x_obs, y_obs):
     """Checks the inputs for find_element_wise_nearest_pos()
     Args:
@@ -475,6 +514,7 @@ def check_find_element_wise_nearest_pos_inputs(x, y, x_obs, y_obs):
         )
 
 
+@profiled
 def find_element_wise_nearest_pos(x, y, x_obs, y_obs):
     """Finds the nearest positions in x and y for each value in
     x_obs and y_obs. x and y should be the rlon and rlat arrays,
@@ -548,6 +588,7 @@ def check_find_nearest_value_inputs(x, y, x_i, y_i, field):
         )
 
 
+@profiled
 def find_nearest_index_value(x, y, x_i, y_i, field):
     """Finds the nearest model value to a station location in the CanRCM4
     grid space
@@ -596,6 +637,8 @@ def find_nearest_index_value(x, y, x_i, y_i, field):
 
         # create interpolation function for every point
         # except the locations of the NaN values
+        from scipy.interpolate import NearestNDInterpolator
+
         f = NearestNDInterpolator(pairs[mask.flatten()], field[mask])
 
         # get the rlon and rlat locations of the NaN values
@@ -616,6 +659,297 @@ def find_nearest_index_value(x, y, x_i, y_i, field):
     return final
 
 
+# remapping matrices already built in this process, keyed
+# by remap_key() so that DVs on the same grid pair share them
+_REMAP_CACHE = {}
+
+
+def cell_edges(x: "NDArray[(Any,), float]") -> "NDArray[(Any,), float]":
+    """Calculates the cell edges of a monotonically increasing
+    array of cell centres. The outermost edges are placed half
+    a cell beyond the first and last centres.
+    Args:
+        x (np.ndarray): monotonically increasing cell centres
+    Returns:
+        edges (np.ndarray): array of size x.size + 1 containing
+            the cell edges
+    """
+    check_ndims(x, 1)
+    if x.size < 2:
+        raise ValueError("Array size must be greater than 1")
+
+    mid = (x[1:] + x[:-1]) / 2.0
+    first = x[0] - (mid[0] - x[0])
+    last = x[-1] + (x[-1] - mid[-1])
+
+    return np.concatenate([[first], mid, [last]])
+
+
+def remap_key(
+    rlon: "NDArray[(Any,), float]",
+    rlat: "NDArray[(Any,), float]",
+    xlon: "NDArray[(Any,), float]",
+    ylat: "NDArray[(Any,), float]",
+    method: str,
+    target_crs: dict,
+    source_crs: dict,
+    n_sub: int = 4,
+) -> str:
+    """Generates a unique key for a remapping matrix between a rotated
+    source grid and a regular target grid. The key depends only on the
+    grid pair and remapping parameters so that it can be reused across
+    design values that share the same grids.
+    Args:
+        rlon, rlat (np.ndarray): rotated coordinates of the source grid
+        xlon, ylat (np.ndarray): regular coordinates of the target grid
+        method (str): remapping method
+        target_crs, source_crs (dict): proj4 dictionaries as in rot2reg
+        n_sub (int): number of sub-samples per target cell axis used
+            by the conservative method
+    Returns:
+        key (str): hexadecimal digest identifying the grid pair
+    """
+    h = hashlib.sha1()
+    for arr in [rlon, rlat, xlon, ylat]:
+        h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+    h.update(method.encode("utf-8"))
+    h.update(json.dumps([target_crs, source_crs], sort_keys=True).encode("utf-8"))
+    if method == "conservative":
+        h.update(str(n_sub).encode("utf-8"))
+
+    return h.hexdigest()
+
+
+def bilinear_remap_matrix(
+    rlon: "NDArray[(Any,), float]",
+    rlat: "NDArray[(Any,), float]",
+    xr_rot: "NDArray[(Any,), float]",
+    yr_rot: "NDArray[(Any,), float]",
+) -> "sparse.csr_matrix":
+    """Builds a sparse bilinear interpolation matrix from a rectilinear
+    grid in rotated coordinates to arbitrary target points given in the
+    same rotated coordinates. Target points outside of the source grid
+    have no weights.
+    Args:
+        rlon, rlat (np.ndarray): rotated coordinates of the source grid
+        xr_rot, yr_rot (np.ndarray): rotated coordinates of each target
+            point
+    Returns:
+        W (scipy.sparse.csr_matrix): matrix of shape
+            (number of target points, rlat.size * rlon.size)
+    """
+    from scipy import sparse
+
+    nx, ny = rlon.size, rlat.size
+
+    ix = np.clip(np.searchsorted(rlon, xr_rot) - 1, 0, nx - 2)
+    iy = np.clip(np.searchsorted(rlat, yr_rot) - 1, 0, ny - 2)
+
+    tx = (xr_rot - rlon[ix]) / (rlon[ix + 1] - rlon[ix])
+    ty = (yr_rot - rlat[iy]) / (rlat[iy + 1] - rlat[iy])
+
+    inside = (tx >= 0.0) & (tx <= 1.0) & (ty >= 0.0) & (ty <= 1.0)
+    rows = np.flatnonzero(inside)
+    ix, iy, tx, ty = ix[inside], iy[inside], tx[inside], ty[inside]
+
+    # four corners of the source cell surrounding each target point
+    cols = np.concatenate(
+        [iy * nx + ix, iy * nx + ix + 1, (iy + 1) * nx + ix, (iy + 1) * nx + ix + 1]
+    )
+    weights = np.concatenate(
+        [(1 - tx) * (1 - ty), tx * (1 - ty), (1 - tx) * ty, tx * ty]
+    )
+
+    W = sparse.coo_matrix(
+        (weights, (np.tile(rows, 4), cols)), shape=(xr_rot.size, nx * ny)
+    )
+
+    return W.tocsr()
+
+
+def conservative_remap_matrix(
+    rlon: "NDArray[(Any,), float]",
+    rlat: "NDArray[(Any,), float]",
+    xlon: "NDArray[(Any,), float]",
+    ylat: "NDArray[(Any,), float]",
+    target_crs: dict,
+    source_crs: dict,
+    n_sub: int = 4,
+) -> "sparse.csr_matrix":
+    """Builds a sparse first-order conservative remapping matrix from a
+    rectilinear rotated pole grid to a regular lat/lon grid. The overlap
+    of each target cell with the source cells is estimated by dividing
+    the target cell into n_sub x n_sub sub-cells, weighting each by its
+    spherical area, and locating each sub-cell centre in the source grid.
+    Weights converge to the exact overlap fractions as n_sub grows.
+    Args:
+        rlon, rlat (np.ndarray): rotated coordinates of the source grid
+        xlon, ylat (np.ndarray): regular coordinates of the target grid
+        target_crs, source_crs (dict): proj4 dictionaries as in rot2reg
+        n_sub (int): number of sub-samples per target cell axis
+    Returns:
+        W (scipy.sparse.csr_matrix): matrix of shape
+            (ylat.size * xlon.size, rlat.size * rlon.size)
+    """
+    if not isinstance(n_sub, int) or n_sub < 1:
+        raise ValueError("n_sub must be a positive integer.")
+
+    from scipy import sparse
+
+    nx, ny = rlon.size, rlat.size
+    rlon_edges, rlat_edges = cell_edges(rlon), cell_edges(rlat)
+    xlon_edges, ylat_edges = cell_edges(xlon), cell_edges(ylat)
+
+    # relative position of each sub-cell centre within its target cell
+    frac = (np.arange(n_sub) + 0.5) / n_sub
+
+    rows, cols, weights = [], [], []
+    # process one target row at a time to bound memory on large grids
+    for j in range(ylat.size):
+        sub_lat = ylat_edges[j] + frac * (ylat_edges[j + 1] - ylat_edges[j])
+        sub_lon = (
+            xlon_edges[:-1, None]
+            + frac[None, :] * np.diff(xlon_edges)[:, None]
+        ).flatten()
+
+        xx, yy = flatten_coords(sub_lon, sub_lat)
+        xr_rot, yr_rot = transform_coords(
+            xx, yy, source_crs=source_crs, target_crs=target_crs
+        )
+        xr_rot, yr_rot = np.asarray(xr_rot), np.asarray(yr_rot)
+
+        # spherical area element of each sub-cell
+        area = np.cos(np.deg2rad(yy))
+
+        ix = np.searchsorted(rlon_edges, xr_rot) - 1
+        iy = np.searchsorted(rlat_edges, yr_rot) - 1
+        inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+
+        # sub-cells are ordered by target column within each sub row
+        target = j * xlon.size + np.tile(
+            np.repeat(np.arange(xlon.size), n_sub), n_sub
+        )
+        total = np.bincount(
+            target - j * xlon.size, weights=area, minlength=xlon.size
+        )
+
+        rows.append(target[inside])
+        cols.append(iy[inside] * nx + ix[inside])
+        weights.append(area[inside] / total[target[inside] - j * xlon.size])
+
+    # duplicate entries from sub-cells in the same source cell are summed
+    W = sparse.coo_matrix(
+        (np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(ylat.size * xlon.size, nx * ny),
+    )
+
+    return W.tocsr()
+
+
+@profiled
+def remap_matrix(
+    ds: xr.Dataset,
+    xlon: "NDArray[(Any,), float]",
+    ylat: "NDArray[(Any,), float]",
+    method: str,
+    target_crs: dict,
+    source_crs: dict,
+    cache_dir: str = None,
+    n_sub: int = 4,
+) -> "sparse.csr_matrix":
+    """Returns the sparse remapping matrix from the rotated grid in ds
+    to the regular grid defined by xlon and ylat. Matrices are built once
+    per grid pair, kept in memory, and optionally stored in cache_dir as
+    .npz files so that other runs and design values can reuse them.
+    Args:
+        ds (xarray.core.dataset.Dataset): dataset defining the source grid
+        xlon, ylat (np.ndarray): regular coordinates of the target grid
+        method (str): 'bilinear' or 'conservative'
+        target_crs, source_crs (dict): proj4 dictionaries as in rot2reg
+        cache_dir (str, optional): directory to store matrices in
+        n_sub (int): number of sub-samples per target cell axis used
+            by the conservative method
+    Returns:
+        W (scipy.sparse.csr_matrix): remapping matrix
+    Raises:
+        ValueError: if method is not recognized
+    """
+    if method != "bilinear" and method != "conservative":
+        raise ValueError("Method must be bilinear or conservative.")
+
+    from scipy import sparse
+
+    rlon, rlat = ds.rlon.values, ds.rlat.values
+    key = remap_key(rlon, rlat, xlon, ylat, method, target_crs, source_crs, n_sub)
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, f"remap_{method}_{key}.npz")
+
+    if key in _REMAP_CACHE:
+        W = _REMAP_CACHE[key]
+    elif path is not None and os.path.exists(path):
+        W = sparse.load_npz(path).tocsr()
+    elif method == "bilinear":
+        xx, yy = flatten_coords(xlon, ylat)
+        xr_rot, yr_rot = transform_coords(
+            xx, yy, source_crs=source_crs, target_crs=target_crs
+        )
+        W = bilinear_remap_matrix(
+            rlon, rlat, np.asarray(xr_rot), np.asarray(yr_rot)
+        )
+    else:
+        W = conservative_remap_matrix(
+            rlon, rlat, xlon, ylat, target_crs, source_crs, n_sub
+        )
+
+    # also written when the matrix was already in memory, so that a
+    # cache_dir passed after the first call is still filled
+    if path is not None and not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # written under a temporary name so that processes reading the
+        # same file never see a partial matrix
+        temporary = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary, "wb") as f:
+                sparse.save_npz(f, W)
+            os.replace(temporary, path)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    _REMAP_CACHE[key] = W
+
+    return W
+
+
+def apply_remap(
+    W: "sparse.csr_matrix", field: "NDArray[(Any, Any), float]"
+) -> "NDArray[(Any,), float]":
+    """Applies a remapping matrix to a field as a sparse matrix product.
+    NaN values in the source field are excluded and the weights of
+    the remaining source cells are renormalized. Target cells with
+    no valid source cells are NaN.
+    Args:
+        W (scipy.sparse.csr_matrix): remapping matrix
+        field (np.ndarray): 2D source field
+    Returns:
+        (np.ndarray): flattened remapped field
+    """
+    values = np.asarray(field, dtype=np.float64).ravel()
+    valid = ~np.isnan(values)
+
+    numerator = W @ np.where(valid, values, 0.0)
+    denominator = W @ valid.astype(np.float64)
+
+    result = np.full(numerator.shape, np.nan)
+    nonzero = denominator > 0.0
+    result[nonzero] = numerator[nonzero] / denominator[nonzero]
+
+    return result
+
+
+@profiled
 def rot2reg(
     ds: xr.Dataset,
     target_crs: dict = {
@@ -633,11 +967,15 @@ def rot2reg(
         "datum": "WGS84",
         "no_defs": True,
     },
+    method: str = "nearest",
+    cache_dir: str = None,
 ) -> xr.Dataset:
     """Transform a CanRCM4 field from rotated coordinates
-    to regular coordinates or another projection. This
+    to regular coordinates or another projection. The default
     transformation implicitly calculates nearest neighbours
-    and does not employ any other interpolation. Projected
+    and does not employ any other interpolation. The bilinear and
+    conservative methods apply a precomputed sparse remapping matrix
+    that is built once per grid pair and reused. Projected
     coordinates are same shape and size of input rlon and rlat
     coordinates
     Args:
@@ -645,9 +983,15 @@ def rot2reg(
             checking consistency with ensemble
         target_crs (dict): proj4 dictionary defining target projection
         source_crs (dict): proj4 dictionary defining source projection
+        method (str): 'nearest', 'bilinear' or 'conservative'
+        cache_dir (str, optional): directory to store remapping
+            matrices in for reuse between runs
     Returns:
         newds (xarray.core.dataset.Dataset): dataset in new projection
     """
+    if method not in ["nearest", "bilinear", "conservative"]:
+        raise ValueError("Method must be nearest, bilinear or conservative.")
+
     dvmax = np.argmax([ds[key].size for key in list(ds.data_vars)])
     dv = list(ds.data_vars)[dvmax]
 
@@ -661,6 +1005,20 @@ def rot2reg(
     xlon = np.linspace(ds.lon.min(), ds.lon.max(), ds.rlon.size)
     ylat = np.linspace(ds.lat.min(), ds.lat.max(), ds.rlat.size)
 
+    if method != "nearest":
+        if len(shape_of_field) != 2:
+            raise ValueError("Dimenion of data not 2.")
+
+        W = remap_matrix(
+            ds, xlon, ylat, method, target_crs, source_crs, cache_dir
+        )
+        newfield = apply_remap(W, ds[dv].values).reshape(shape_of_field)
+
+        return xr.Dataset(
+            {dv: (["lat", "lon"], newfield)},
+            coords={"lon": ("lon", xlon), "lat": ("lat", ylat)},
+        )
+
     xx, yy = flatten_coords(xlon, ylat)
 
     # convert regular grid axis to rotated (non regular) arrays
@@ -1,18 +1,25 @@
 from climpyrical.gridding import find_nearest_index, flatten_coords
+from climpyrical.profiling import profiled
+import os
+import json
+import hashlib
+import weakref
 import warnings
-from typing import Union, Any, Tuple
+from typing import TYPE_CHECKING, Union, Any, Tuple
 from nptyping import NDArray
 import numpy as np
 from shapely.geometry import Polygon, MultiPolygon
+from shapely import wkb
 
-from tqdm import tqdm
-import geopandas as gpd
+if TYPE_CHECKING:
+    # geopandas is slow to import and only needed once polygons are used
+    import geopandas as gpd
 
 # ignore this. The change quoted leads to CRS errror
 warnings.filterwarnings("ignore", category=FutureWarning, module="pyproj")
 
 
-def check_polygon_validity(p: Union[gpd.GeoSeries, gpd.GeoDataFrame]) -> bool:
+def check_polygon_validity(p: Union["gpd.GeoSeries", "gpd.GeoDataFrame"]) -> bool:
     """Checks that the polygon provided is valid
     Args:
         p: polygon of type geopandas.GeoSeries
@@ -29,7 +36,7 @@ def check_polygon_validity(p: Union[gpd.GeoSeries, gpd.GeoDataFrame]) -> bool:
 
 
 def check_polygon_before_projection(
-    p: Union[gpd.GeoSeries, gpd.GeoDataFrame]
+    p: Union["gpd.GeoSeries", "gpd.GeoDataFrame"]
 ) -> bool:
     """Raises an warning if polygon provided does not
     contain the expected WGS84 projection, but does not stop
@@ -71,8 +78,82 @@ def check_polygon_before_projection(
     return True
 
 
+def geometry_cache_key(
+    p: Union["gpd.GeoSeries", "gpd.GeoDataFrame"], crs: Union[dict, str]
+) -> str:
+    """Generates a key identifying a set of geometries and the
+    crs they are projected to. The key hashes the WKB of every
+    geometry together with the source and target crs.
+    Args:
+        p: polygon of type geopandas.GeoSeries
+        crs (dict): target proj4 dictionary
+    Returns:
+        key (str): hexadecimal digest
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps([str(p.crs), crs], sort_keys=True).encode("utf-8"))
+    for geometry in p.geometry:
+        h.update(geometry.wkb)
+
+    return h.hexdigest()
+
+
+def write_geometry_cache(path: str, p: "gpd.GeoSeries") -> None:
+    """Stores geometries as concatenated WKB in an uncompressed .npz
+    file together with their offsets. Only numeric arrays are stored so
+    that the file is read without unpickling anything.
+    The file is written under a temporary name first, so that processes
+    reading the same cache never see a partial file.
+    Args:
+        path (str): .npz file to write
+        p (geopandas.GeoSeries object): geometries to store
+    """
+    blobs = [geometry.wkb for geometry in p]
+    offsets = np.concatenate([[0], np.cumsum([len(b) for b in blobs])])
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        # a file object, as np.savez adds .npz to names without it
+        with open(temporary, "wb") as f:
+            np.savez(
+                f,
+                wkb=np.frombuffer(b"".join(blobs), dtype=np.uint8),
+                offsets=offsets.astype(np.int64),
+            )
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def read_geometry_cache(
+    path: str, crs: Union[dict, str], index=None
+) -> "gpd.GeoSeries":
+    """Loads geometries stored with write_geometry_cache.
+    Args:
+        path (str): .npz file to read
+        crs (dict): crs of the stored geometries
+        index (optional): index of the geometries. Defaults to a
+            range index
+    Returns:
+        (geopandas.GeoSeries object): stored geometries
+    """
+    import geopandas as gpd
+
+    with np.load(path, allow_pickle=False) as f:
+        buffer = f["wkb"].tobytes()
+        offsets = f["offsets"]
+
+    geometries = [
+        wkb.loads(buffer[start:stop])
+        for start, stop in zip(offsets[:-1], offsets[1:])
+    ]
+
+    return gpd.GeoSeries(geometries, index=index, crs=crs)
+
+
+@profiled
 def rotate_shapefile(
-    p: Union[gpd.GeoSeries, gpd.GeoDataFrame],
+    p: Union["gpd.GeoSeries", "gpd.GeoDataFrame"],
     crs: dict = {
         "proj": "ob_tran",
         "o_proj": "longlat",
@@ -82,49 +163,137 @@ def rotate_shapefile(
         "to_meter": 0.0174532925199,
         "no_defs": True,
     },
-) -> gpd.GeoSeries:
+    cache_dir: str = None,
+) -> "gpd.GeoSeries":
     """Rotates a shapefile to a new crs defined by a proj4 dictionary.
-    Uses geopandas crs functions.
+    Uses geopandas crs functions. If cache_dir is provided, the rotated
+    geometries are stored there keyed by the geometries and crs, and
+    later calls with the same input return the stored result instead
+    of re-projecting.
     Args:
         p (geopandas.GeoSeries object): polygons of Canada
         crs (dict): proj4 dictionary
+        cache_dir (str, optional): directory to store rotated
+            geometries in
     Returns:
         target (geopandas.GeoSeries object): geographic polygons
             in new projection
     """
     # this checks polygon can be rotated
     check_polygon_validity(p)
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(
+            cache_dir, f"rotated_{geometry_cache_key(p, crs)}.npz"
+        )
+        if os.path.exists(path):
+            import geopandas as gpd
+
+            geometries = read_geometry_cache(path, crs, p.index)
+            if isinstance(p, gpd.GeoDataFrame):
+                return p.set_geometry(geometries.values, crs=crs)
+            return geometries
+
     check_polygon_before_projection(p)
 
     target = p.to_crs(crs)
 
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_geometry_cache(path, target.geometry)
+
     return target
 
 
-def stratify_coords(
-    canada: Union[gpd.GeoSeries, gpd.GeoDataFrame],
-) -> Tuple[NDArray[(Any,), np.float], NDArray[(Any,), np.float]]:
-    """Convert polygons to X and Y pairs.
+# flattened coordinate buffers already computed for a GeoSeries,
+# keyed by id() and validated against a weak reference to it and the
+# geometry objects it held. Geometries are immutable, so any edit to the
+# GeoSeries replaces at least one of them
+_STRATIFY_CACHE = {}
+
+
+def _polygon_exteriors(canada):
+    # yield the exterior ring of every polygon in a GeoSeries
+    for geometry in canada:
+        if isinstance(geometry, MultiPolygon):
+            for p in geometry.geoms:
+                yield p.exterior
+        else:
+            yield geometry.exterior
+
+
+@profiled
+def stratify_coords_buffers(
+    canada: Union["gpd.GeoSeries", "gpd.GeoDataFrame"], cache: bool = True
+) -> Tuple["NDArray[(Any,), float]", "NDArray[(Any,), float]", "NDArray[(Any,), int]"]:
+    """Convert polygons to contiguous X and Y coordinate buffers.
+    Each exterior ring is followed by a NaN separator so that the
+    buffers can be plotted directly as one line collection.
+
+    Cached buffers are shared by every caller and are read-only, so
+    copy them before editing, or use stratify_coords. The cache is
+    checked against the geometries the GeoSeries holds, so it is
+    refreshed once any of them is replaced.
     Args:
         canada (geopandas.GeoSeries object): polygons of Canada
+        cache (bool): True, whether to reuse the buffers computed
+            for the same GeoSeries object
     Returns:
-        X, Y (numpy.ndarrays): Ordered pairs of coordinates of
-            each polygon
+        X, Y (numpy.ndarrays): read-only float64 coordinates of each
+            exterior ring separated by NaN
+        offsets (numpy.ndarray): read-only start index of each exterior
+            ring in X and Y, with a final entry equal to the length of
+            X and Y. Each part of a MultiPolygon has its own ring
     """
     check_polygon_validity(canada)
 
-    pts = []
-    for poly in canada:
-        if isinstance(poly, MultiPolygon):
-            for p in poly:
-                pts.extend(p.exterior.coords)
-                pts.append([None, None])
-        else:
-            pts.extend(poly.exterior.coords)
-            pts.append([None, None])
+    key = id(canada)
+    geometries = list(canada)
+    known = cache and key in _STRATIFY_CACHE and _STRATIFY_CACHE[key][0]() is canada
+    if known:
+        _, cached_geometries, buffers = _STRATIFY_CACHE[key]
+        if len(cached_geometries) == len(geometries) and all(
+            a is b for a, b in zip(cached_geometries, geometries)
+        ):
+            return buffers
+
+    rings = [np.asarray(ring.coords)[:, :2] for ring in _polygon_exteriors(canada)]
+
+    # each ring is followed by a single NaN separator row
+    sizes = np.array([ring.shape[0] + 1 for ring in rings], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+
+    xy = np.full((offsets[-1], 2), np.nan, dtype=np.float64)
+    for start, ring in zip(offsets[:-1], rings):
+        xy[start : start + ring.shape[0]] = ring
 
-    X, Y = zip(*pts)
-    return np.array(X), np.array(Y)
+    buffers = (xy[:, 0], xy[:, 1], offsets)
+    for buffer in (xy,) + buffers:
+        buffer.setflags(write=False)
+
+    if cache:
+        if not known:
+            # once per GeoSeries, entries are only replaced afterwards
+            weakref.finalize(canada, _STRATIFY_CACHE.pop, key, None)
+        _STRATIFY_CACHE[key] = (weakref.ref(canada), geometries, buffers)
+
+    return buffers
+
+
+def stratify_coords(
+    canada: Union["gpd.GeoSeries", "gpd.GeoDataFrame"],
+) -> "Tuple[NDArray[(Any,), float], NDArray[(Any,), float]]":
+    """Convert polygons to X and Y pairs.
+    Args:
+        canada (geopandas.GeoSeries object): polygons of Canada
+    Returns:
+        X, Y (numpy.ndarrays): Ordered pairs of coordinates of
+            each polygon separated by NaN
+    """
+    X, Y, offsets = stratify_coords_buffers(canada)
+    # copies, so that callers never edit the shared cached buffers
+    return X.copy(), Y.copy()
 
 
 def make_box(x: float, y: float, dx: float, dy: float) -> Polygon:
@@ -149,12 +318,45 @@ def make_box(x: float, y: float, dx: float, dy: float) -> Polygon:
     return Polygon([p1, p2, p3, p4])
 
 
+@profiled
+def simplify_polygons(
+    p: Union["gpd.GeoSeries", "gpd.GeoDataFrame"],
+    dx: float,
+    dy: float,
+    factor: float = 0.25,
+) -> "gpd.GeoSeries":
+    """Simplifies polygons to a tolerance tied to the target grid spacing.
+    Vertices closer together than a fraction of a grid cell cannot be
+    resolved by the target grid, so they are removed with a topology
+    preserving simplification. The simplified polygons are suitable for
+    plotting with stratify_coords and for gen_raster_mask_from_vector.
+    Args:
+        p (geopandas.GeoSeries object): polygons of Canada
+        dx, dy (float, float): grid cell size of the target grid
+        factor (float): fraction of the smallest grid cell size to
+            use as the simplification tolerance
+    Returns:
+        (geopandas.GeoSeries object): simplified polygons
+    """
+    check_polygon_validity(p)
+
+    if not 0.0 < factor <= 1.0:
+        raise ValueError("factor must be within (0, 1].")
+
+    tolerance = factor * min(abs(dx), abs(dy))
+
+    return p.geometry.simplify(tolerance, preserve_topology=True)
+
+
+@profiled
 def gen_raster_mask_from_vector(
-    x: NDArray[(Any,), np.float],
-    y: NDArray[(Any,), np.float],
-    p: Union[gpd.GeoSeries, gpd.GeoDataFrame],
+    x: "NDArray[(Any,), np.float]",
+    y: "NDArray[(Any,), np.float]",
+    p: Union["gpd.GeoSeries", "gpd.GeoDataFrame"],
     progress_bar: bool = True,
-) -> NDArray[(Any, Any), Any]:
+    simplify: bool = False,
+    factor: float = 0.25,
+) -> "NDArray[(Any, Any), Any]":
     """Determines if points are contained within polygons of Canada
     Args:
         x, y (np.ndarray): Arrays containing the rlon and rlat of CanRCM4
@@ -163,6 +365,14 @@ def gen_raster_mask_from_vector(
         progress_bar (bool): True, whether to display a tqdm progress bar. This
             operation can take a long time depending on the target resolution and
             the grid size/complexity of polygons provided.
+        simplify (bool): False, whether to test grid cells against polygons
+            simplified to the grid spacing. Cells away from the simplified
+            boundary are decided at once from their centres, and only cells
+            within the simplification tolerance of it are tested against the
+            full resolution polygons, so the result is identical to the full
+            resolution mask.
+        factor (float): fraction of the smallest grid cell size to use as
+            the simplification tolerance if simplify is True
     Returns:
         mask (np.ndarray): boolean 2D grid mask of CanRCM4 raster clipped
             based on polygon boundaries
@@ -190,21 +400,54 @@ def gen_raster_mask_from_vector(
             Does polygon overlap with coordinates provided?"
         )
 
-    # track whether or not grid cell is within polygon here
-    contained = []
+    contained = np.zeros(xy.shape[0], dtype=bool)
+    todo = np.arange(xy.shape[0])
 
-    if progress_bar:
-        with tqdm(total=len(xy), position=0, leave=True) as pbar:
-            for xcoord, ycoord in xy:
-                pbar.update()
-                contained.append(
-                    np.any(p.intersects(make_box(xcoord, ycoord, dx, dy)))
-                )
-    else:
-        for xcoord, ycoord in xy:
-            contained.append(
-                np.any(p.intersects(make_box(xcoord, ycoord, dx, dy)))
+    if simplify:
+        from shapely.prepared import prep
+
+        tolerance = factor * min(2.0 * dx, 2.0 * dy)
+        p_simple = simplify_polygons(p, 2.0 * dx, 2.0 * dy, factor)
+        x_clip, y_clip = x[icx1:icx2], y[icy1:icy2]
+
+        # cells away from the simplified boundary lie wholly inside or
+        # outside of it, so their centres decide them all at once
+        contained = _centres_inside(x_clip, y_clip, p_simple).ravel()
+
+        # the full resolution boundary lies within the tolerance of
+        # the simplified boundary, so only cells near it can differ.
+        # These are tested one by one against prepared full resolution
+        # polygons, skipping those whose bounds miss the cell
+        near = _near_lines(
+            x_clip, y_clip, p_simple.boundary, dx + tolerance, dy + tolerance
+        )
+        todo = np.flatnonzero(near)
+        full = [prep(geometry) for geometry in p.geometry]
+        bounds = p.bounds.values
+
+        def is_contained(xcoord, ycoord):
+            box = make_box(xcoord, ycoord, dx, dy)
+            overlaps = (
+                (bounds[:, 0] <= xcoord + dx)
+                & (bounds[:, 2] >= xcoord - dx)
+                & (bounds[:, 1] <= ycoord + dy)
+                & (bounds[:, 3] >= ycoord - dy)
             )
+            return any(full[i].intersects(box) for i in np.flatnonzero(overlaps))
+
+    else:
+
+        def is_contained(xcoord, ycoord):
+            return np.any(p.intersects(make_box(xcoord, ycoord, dx, dy)))
+
+    # track whether or not grid cell is within polygon here
+    if progress_bar:
+        from tqdm import tqdm
+
+        todo = tqdm(todo, position=0, leave=True)
+
+    for i in todo:
+        contained[i] = is_contained(*xy[i])
 
     # convert back to original target size and shape
     contained = np.array(contained).reshape((icy2 - icy1, icx2 - icx1))
@@ -214,6 +457,110 @@ def gen_raster_mask_from_vector(
     return mask == 1
 
 
+def _polygon_rings(geometry):
+    # yield the coordinates of every exterior and interior ring
+    for polygon in getattr(geometry, "geoms", [geometry]):
+        if polygon.is_empty:
+            continue
+        yield np.asarray(polygon.exterior.coords)[:, :2]
+        for interior in polygon.interiors:
+            yield np.asarray(interior.coords)[:, :2]
+
+
+def _centres_inside(
+    x: "NDArray[(Any,), float]",
+    y: "NDArray[(Any,), float]",
+    p: "gpd.GeoSeries",
+) -> "NDArray[(Any, Any), bool]":
+    """Whether the centre of each grid cell lies inside any polygon,
+    from the even-odd rule along each row of cells. Centres on a
+    boundary may go either way.
+    Args:
+        x, y (np.ndarray): coordinates of the cell centres
+        p (geopandas.GeoSeries object): polygons
+    Returns:
+        inside (np.ndarray): boolean array with shape (y.size, x.size)
+    """
+    inside = np.zeros((y.size, x.size), dtype=bool)
+    for geometry in p:
+        rings = list(_polygon_rings(geometry))
+        if not rings:
+            continue
+        x0 = np.concatenate([ring[:-1, 0] for ring in rings])
+        y0 = np.concatenate([ring[:-1, 1] for ring in rings])
+        x1 = np.concatenate([ring[1:, 0] for ring in rings])
+        y1 = np.concatenate([ring[1:, 1] for ring in rings])
+
+        for j, yj in enumerate(y):
+            crossing = (y0 > yj) != (y1 > yj)
+            if not crossing.any():
+                continue
+            xa, ya, xb, yb = x0[crossing], y0[crossing], x1[crossing], y1[crossing]
+            xc = np.sort(xa + (yj - ya) * (xb - xa) / (yb - ya))
+            # a centre is inside if an odd number of edges cross the
+            # row to its right
+            right = xc.size - np.searchsorted(xc, x, side="right")
+            inside[j] |= right % 2 == 1
+
+    return inside
+
+
+def _near_lines(
+    x: "NDArray[(Any,), float]",
+    y: "NDArray[(Any,), float]",
+    lines: "gpd.GeoSeries",
+    reach_x: float,
+    reach_y: float,
+) -> "NDArray[(Any,), bool]":
+    """Marks the cells of a regular grid whose centre is within reach_x
+    and reach_y of a line. Lines are sampled at under half a cell and
+    each sample marks the cells around it, so every such cell is marked
+    along with a few more.
+    Args:
+        x, y (np.ndarray): coordinates of the cell centres
+        lines (geopandas.GeoSeries object): (multi) line strings
+        reach_x, reach_y (float): distances from a centre in x and y
+    Returns:
+        near (np.ndarray): flattened boolean array of the cells in the
+            order of flatten_coords
+    """
+    near = np.zeros((y.size, x.size), dtype=bool)
+    step_x, step_y = np.mean(np.diff(x)), np.mean(np.diff(y))
+    spacing = 0.5 * min(abs(step_x), abs(step_y))
+    kx = int(np.ceil((reach_x + spacing) / abs(step_x))) + 1
+    ky = int(np.ceil((reach_y + spacing) / abs(step_y))) + 1
+
+    for line in lines:
+        parts = getattr(line, "geoms", [line])
+        for part in parts:
+            coords = np.asarray(part.coords)[:, :2]
+            if coords.shape[0] == 0:
+                continue
+
+            # sample every segment at no more than spacing apart
+            d = np.diff(coords, axis=0)
+            n = np.maximum(np.ceil(np.hypot(d[:, 0], d[:, 1]) / spacing), 1)
+            n = n.astype(int)
+            segment = np.repeat(np.arange(d.shape[0]), n)
+            t = (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)) / np.repeat(n, n)
+            points = np.concatenate(
+                [coords[:-1][segment] + d[segment] * t[:, np.newaxis], coords[-1:]]
+            )
+
+            ix = np.rint((points[:, 0] - x[0]) / step_x).astype(int)
+            iy = np.rint((points[:, 1] - y[0]) / step_y).astype(int)
+            keep = (ix >= -kx) & (ix < x.size + kx) & (iy >= -ky) & (iy < y.size + ky)
+            cells = np.unique(np.stack([iy[keep], ix[keep]]), axis=1)
+            for oy in range(-ky, ky + 1):
+                for ox in range(-kx, kx + 1):
+                    near[
+                        np.clip(cells[0] + oy, 0, y.size - 1),
+                        np.clip(cells[1] + ox, 0, x.size - 1),
+                    ] = True
+
+    return near.ravel()
+
+
 def to_polygons(geometries):
     # yield polygons from geometry
     for geometry in geometries:
@@ -223,13 +570,14 @@ def to_polygons(geometries):
             yield from geometry
 
 
+@profiled
 def gen_upper_archipelago_mask(
-    canada: gpd.GeoSeries,
-    x: NDArray[(Any,), float],
-    y: NDArray[(Any,), float],
+    canada: "gpd.GeoSeries",
+    x: "NDArray[(Any,), float]",
+    y: "NDArray[(Any,), float]",
     north_ext: int,
     upper_limit: float,
-) -> NDArray[(Any, Any), Any]:
+) -> "NDArray[(Any, Any), Any]":
     """Isolates the UAA and generates a raster mask containing only the UAA.
     Args:
         canada (geopandas.GeoSeries object): polygons of Canada
@@ -242,6 +590,8 @@ def gen_upper_archipelago_mask(
         X, Y (numpy.ndarrays): Ordered pairs of coordinates of
             each polygon
     """
+    import geopandas as gpd
+
     check_polygon_validity(canada)
     mask = np.zeros((y.size, x.size))
     canada_polygons = MultiPolygon(to_polygons(canada))
@@ -0,0 +1,1348 @@
+"""
+quick usage of climpyrical pipeline.py
+usage:
+python -m climpyrical.pipeline -c config.yml
+
+Runs the full reconstruction pipeline described by a YAML config
+(see notebooks/interactive/config_example.yml) in a single Python
+process per worker. Each stage is a plain function, intermediate
+objects are handed from one stage to the next in memory, stages
+whose outputs are newer than their inputs and were made with the same
+settings are skipped and design
+values are scheduled across a multiprocessing pool. Inputs shared by
+several design values (station files, masks and the target grid) are
+processed once and fanned out to the design values that use them.
+"""
+
+from climpyrical.data import (
+    read_data,
+    gen_dataset,
+    interpolate_dataset,
+    write_netcdf,
+    ancillary_variables,
+)
+from climpyrical.gridding import scale_model_obs
+from climpyrical.cmd.preprocess_model import load_preprocess_masks, preprocess_model
+from climpyrical.cmd.find_matched_model_vals import (
+    add_model_values,
+    aggregate_stations,
+    match_station_cells,
+)
+from climpyrical.stations import normalise_columns, read_stations, read_table
+from climpyrical import profiling
+
+from pkg_resources import resource_filename
+from multiprocessing import Pool
+from functools import partial
+import click
+import hashlib
+import json
+import logging
+import os
+import time
+import warnings
+
+import yaml
+import numpy as np
+import pandas as pd
+
+# Stages in the order they run. Names match the notebooks they replace
+# so existing configs listing "<stage>.ipynb" keep working.
+STAGES = [
+    "preprocess_model",
+    "stations",
+    "MWOrK",
+    "plots",
+    "nbcc_locations",
+    "combine_tables",
+]
+
+# names used for stages in older configs
+STAGE_ALIASES = {"nbcc_stations": "nbcc_locations"}
+
+# keys of each design value's config entry, and of config["paths"],
+# that a stage's outputs depend on
+STAGE_PARAMS = {
+    "preprocess_model": ["input_model_path", "fill_glaciers"],
+    "stations": ["station_path", "station_dv"],
+    "MWOrK": [
+        "station_dv",
+        "medians",
+        "n",
+        "blend",
+        "tiling",
+        "kriging",
+        "variance",
+        "window_rules",
+        "batch_size",
+    ],
+    "plots": ["station_dv"],
+    "nbcc_locations": ["station_dv"],
+}
+STAGE_PATHS = {
+    "preprocess_model": ["mask_path", "north_mask_path"],
+    "stations": [],
+    "MWOrK": ["mask_path", "north_mask_path", "nbcc_loc_path"],
+    "plots": [],
+    "nbcc_locations": ["nbcc_loc_path"],
+}
+
+KELVIN = 273.15  # K
+
+# Hard coded CanRCM4 upper model domain rlat
+DSOLD_MAX = 28.15999984741211
+
+PLOT_KINDS = ["reconstruction", "CanRCM4_ensmean", "stations", "dist", "panel"]
+
+# Sort the combined keys into final format as they appear in the
+# original NBCC Table C2
+ORIGINAL_COLUMNS = {
+    "Location": "Location",
+    "lat": "Latitude",
+    "lon": "Longitude",
+    "Prov": "prov",
+    "2020 Elev (m)": "elevation (m)",
+}
+ORIGINAL_DVS = {
+    "TJan2.5 (degC)": "JanT2.5 (degC)",
+    "TJan1.0 (degC)": "JanT1.0 (degC)",
+    "TJul2.5 (degC)": "JulT2.5 (degC)",
+    "TwJul2.5 (degC)": "JulTw2.5 (degC)",
+    "Tmin (degC)": "Tmin (degC)",
+    "Tmax (degC)": "Tmax (degC)",
+    "HDD (degC-day)": "HDD (degC-day)",
+    "Gum-LM RL10 (mm)": "R15m10 (mm)",
+    "1day rain RL50 (mm)": "R1d50 (mm)",
+    "annual_rain (mm)": "AnnR (mm)",
+    "annual_pr (mm)": "AnnP (mm)",
+    "mean RH (%)": "RH (%)",
+    "moisture_index": "MI",
+    "DRWP-RL5 (Pa)": "DRWP5 (Pa)",
+    "SL50 (kPa)": "SL50 (kPa)",
+    "RL50 (kPa)": "RL50 (kPa)",
+    "WP10 (kPa)": "WP10 (kPa)",
+    "WP50 (kPa)": "WP50 (kPa)",
+}
+
+
+def load_config(config_path):
+    """Reads and validates a pipeline YAML config.
+    Args:
+        config_path (str): path to YAML config
+    Returns:
+        config (dict): config with "steps" normalised to stage
+            names, and "n_jobs", "root", "nbcc_correction" and
+            "profile" filled in
+    """
+    with open(config_path) as f:
+        config = yaml.safe_load(f)
+
+    for key in ["paths", "dvs"]:
+        if key not in config:
+            raise KeyError(f"Config must contain {key}")
+
+    steps = []
+    for step in config.get("steps", STAGES):
+        step = os.path.splitext(step)[0]
+        step = STAGE_ALIASES.get(step, step)
+        if step not in STAGES:
+            raise ValueError(f"Unrecognized step {step}. Must be one of {STAGES}")
+        steps.append(step)
+
+    config["steps"] = steps
+    config["n_jobs"] = config.get("n_jobs", 1)
+    config["root"] = config.get("root")
+    config["nbcc_correction"] = config.get(
+        "nbcc_correction", config.get("nbcc_mean_correction", False)
+    )
+    config["profile"] = config.get("profile", False)
+
+    return config
+
+
+def resolve_path(path, root=None):
+    """Resolves a config path relative to root, or to the climpyrical
+    package if root is None. Paths are always treated as relative, so
+    "/data/results/" and "data/results/" resolve to the same place.
+    """
+    if root is None:
+        return resource_filename("climpyrical", path)
+    return os.path.join(root, path.lstrip("/"))
+
+
+def profile_paths(name, config):
+    """Returns the .json and .csv profile reports written for a design
+    value when config["profile"] is set. Reports go to
+    paths["output_profile_path"], or next to the tables if not given.
+    """
+    paths = config["paths"]
+    directory = resolve_path(
+        paths.get("output_profile_path", paths["output_tables_path"]), config["root"]
+    )
+    return [os.path.join(directory, f"profile_{name}.{ext}") for ext in ["json", "csv"]]
+
+
+def stage_io(stage, name, config):
+    """Lists the files a stage reads and writes for a design value.
+    Args:
+        stage (str): stage name from STAGES
+        name (str): design value key in config["dvs"]
+        config (dict): pipeline config
+    Returns:
+        inputs, outputs (list of str): resolved file paths
+    """
+    paths = config["paths"]
+    root = config["root"]
+
+    if stage == "combine_tables":
+        tables = [
+            resolve_path(f"{paths['output_tables_path']}{key}_TableC2.csv", root)
+            for key in config["dvs"]
+        ]
+        combined = resolve_path(
+            f"{paths['output_tables_path']}combined_dv_tablec2.csv", root
+        )
+        return tables, [combined]
+
+    params = config["dvs"][name]
+    model = resolve_path(f"{paths['preprocessed_model_path']}{name}.nc", root)
+    stations = resolve_path(f"{paths['preprocessed_stations_path']}{name}.csv", root)
+    reconstruction = resolve_path(
+        f"{paths['output_reconstruction_path']}{name}_reconstruction.nc", root
+    )
+    masks = [
+        resolve_path(paths["mask_path"], root),
+        resolve_path(paths["north_mask_path"], root),
+    ]
+    nbcc = resolve_path(paths["nbcc_loc_path"], root)
+
+    if stage == "preprocess_model":
+        return [resolve_path(params["input_model_path"], root)] + masks, [model]
+    if stage == "stations":
+        return [resolve_path(params["station_path"], root), model], [stations]
+    if stage == "MWOrK":
+        return [model, stations, nbcc] + masks, [reconstruction]
+    if stage == "plots":
+        figures = [
+            resolve_path(f"{paths['output_figure_path']}{name}_{kind}.png", root)
+            for kind in PLOT_KINDS
+        ]
+        return [model, stations, reconstruction], figures
+    if stage == "nbcc_locations":
+        table = resolve_path(f"{paths['output_tables_path']}{name}_TableC2.csv", root)
+        return [reconstruction, nbcc], [table]
+
+    raise ValueError(f"Unrecognized stage {stage}. Must be one of {STAGES}")
+
+
+def stage_params(stage, name, config):
+    """Collects the settings a stage's outputs depend on for a design
+    value, from its config["dvs"] entry and config["paths"].
+    Args:
+        stage (str): stage name from STAGES, other than "combine_tables"
+        name (str): design value key in config["dvs"]
+        config (dict): pipeline config
+    Returns:
+        params (dict): settings by key, None for unset keys
+    """
+    dv = config["dvs"][name]
+    params = {key: dv.get(key) for key in STAGE_PARAMS[stage]}
+    params.update({key: config["paths"][key] for key in STAGE_PATHS[stage]})
+    if stage == "MWOrK":
+        params["nbcc_correction"] = config["nbcc_correction"]
+    return params
+
+
+def params_hash(params):
+    """Hashes the settings from stage_params."""
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def params_path(outputs):
+    """Returns the file holding the params_hash of a stage's outputs."""
+    return f"{outputs[0]}.params"
+
+
+def write_params(outputs, params):
+    """Records the settings a stage's outputs were made with."""
+    with open(params_path(outputs), "w") as f:
+        f.write(params_hash(params))
+
+
+def is_up_to_date(inputs, outputs, params=None):
+    """Checks whether every output exists and is newer than every
+    existing input, and, if params are given, whether the outputs were
+    made with the same settings. Stages with up to date outputs are
+    skipped. Outputs without a record of their settings, written before
+    settings were recorded, are only checked by time.
+    Args:
+        inputs, outputs (list of str): file paths
+        params (dict, optional): settings from stage_params
+    Returns:
+        bool
+    """
+    if not all(os.path.exists(path) for path in outputs):
+        return False
+
+    if params is not None and os.path.exists(params_path(outputs)):
+        with open(params_path(outputs)) as f:
+            if f.read().strip() != params_hash(params):
+                return False
+
+    in_times = [os.path.getmtime(path) for path in inputs if os.path.exists(path)]
+    if not in_times:
+        return True
+
+    return min(os.path.getmtime(path) for path in outputs) >= max(in_times)
+
+
+def plan_stages(config, names, force=False):
+    """Decides which per design value stages need to run. A stage runs
+    if it is forced, if its outputs are missing or older than its inputs,
+    if its settings changed since they were written, or if an earlier
+    stage of the same design value runs.
+    Args:
+        config (dict): pipeline config from load_config
+        names (list of str): design values to plan
+        force (bool): run every stage
+    Returns:
+        plan (dict): stages to run for each design value
+    """
+    plan = {}
+    for name in names:
+        stale = force
+        plan[name] = []
+        for stage in config["steps"]:
+            if stage == "combine_tables":
+                continue
+            stale = stale or not is_up_to_date(
+                *stage_io(stage, name, config), stage_params(stage, name, config)
+            )
+            if stale:
+                plan[name].append(stage)
+    return plan
+
+
+def shared_inputs(config, names, key):
+    """Groups design values by an input file they read.
+    Args:
+        config (dict): pipeline config from load_config
+        names (list of str): design values to group
+        key (str): key of the input path in each config["dvs"] entry
+    Returns:
+        groups (dict): resolved path -> design values reading it
+    """
+    groups = {}
+    for name in names:
+        path = resolve_path(config["dvs"][name][key], config["root"])
+        groups.setdefault(path, []).append(name)
+    return groups
+
+
+def is_temperature(ds, station_dv):
+    (dv,) = ds.data_vars
+    return ds[dv].attrs["units"] == "degC" and "degC" in station_dv
+
+
+def check_df_columns(df):
+    """Normalises the column names used across station files, see
+    climpyrical.stations.COLUMN_ALIASES"""
+    return normalise_columns(df)
+
+
+def read_nbcc_locations(nbcc_loc_path, cache=True):
+    """Reads the NBCC Table C2 locations, replacing coordinate typos in
+    the 2020 columns with the 2015 coordinates. Only the columns used
+    are kept, and the parsed workbook is cached by read_table.
+    Args:
+        nbcc_loc_path (str): path to NBCC .xlsm file
+        cache (bool): whether to use the cached table
+    Returns:
+        df_nrc_matched (pandas.DataFrame): Location, Prov,
+            2020 Elev (m), lon and lat of each NBCC location
+    """
+    coords = [
+        "2020 Elev (m)",
+        "2020 Longitude",
+        "2020 Latitude",
+        "2015 Long.",
+        "2015 Lat.",
+    ]
+    df_nrc = read_table(nbcc_loc_path, ["Location", "Prov"] + coords, cache=cache)
+    # the last row is a note, not a location
+    df_nrc = df_nrc.iloc[:-1].astype({column: "float64" for column in coords})
+
+    # fill problem values with better values from 2015
+    id_typo = df_nrc[
+        (df_nrc["2020 Longitude"] > 0) | (df_nrc["2020 Latitude"] < 40)
+    ].index
+    df_nrc.loc[id_typo, "2020 Longitude"] = df_nrc["2015 Long."].values[id_typo]
+    df_nrc.loc[id_typo, "2020 Latitude"] = df_nrc["2015 Lat."].values[id_typo]
+
+    return pd.DataFrame(
+        {
+            "Location": df_nrc.Location,
+            "Prov": df_nrc.Prov,
+            "2020 Elev (m)": df_nrc["2020 Elev (m)"],
+            "lon": df_nrc["2020 Longitude"],
+            "lat": df_nrc["2020 Latitude"],
+        }
+    )
+
+
+def prepare_station_table(station_path, grid_path, station_dvs=None):
+    """Loads a station file, normalises its columns, rotates the station
+    coordinates and matches each station to a grid cell. The result only
+    depends on the station file and the grid, so it is computed once and
+    shared by every design value read from the same file.
+    Args:
+        station_path (str): station csv file
+        grid_path (str): NetCDF file on the target grid, e.g. the mask
+        station_dvs (list, optional): design value columns to read. Every
+            column is read if None
+    Returns:
+        df (pandas.DataFrame): stations with rlat, rlon, irlat and irlon
+        grid (tuple of np.ndarray): rlon and rlat the stations were
+            matched to
+    """
+    grid = read_data(grid_path)
+    rlon, rlat = grid.rlon.values, grid.rlat.values
+
+    df = read_stations(station_path, station_dvs)
+    return match_station_cells(df, rlon, rlat), (rlon, rlat)
+
+
+def process_stations(df, ds, station_dv, matched=False):
+    """Matches stations to the preprocessed model grid, averages stations
+    sharing a grid cell and calculates the station to model ratios.
+    Args:
+        df (pandas.DataFrame): raw station table
+        ds (xarray.Dataset): preprocessed model
+        station_dv (str): station design value column
+        matched (bool): whether df already contains irlat and irlon
+            matched to the grid of ds, e.g. from prepare_station_table
+    Returns:
+        df_match (pandas.DataFrame): one row per matched grid cell, with
+            the number of stations averaged into it in n_stations
+    """
+    df = check_df_columns(df)
+
+    if np.any(np.isnan(df[["lon", "lat", "elev (m)", station_dv]].values)):
+        raise ValueError("NaN detected in station input file.")
+
+    # calculate ratios with applied correction
+    # Note the ratios are calculated in K for Temperature fields
+    temperature = is_temperature(ds, station_dv)
+    if temperature:
+        (dv,) = ds.data_vars
+        df = df.assign(**{station_dv: df[station_dv] + KELVIN})
+        ds = ds.copy(deep=True)
+        ds[dv] += KELVIN
+
+    if "RL50 (kPa)" in station_dv:
+        df = df[df[station_dv] != 0.0]
+
+    df = add_model_values(ds=ds, df=df, matched=matched)
+
+    columns = [
+        "irlat",
+        "irlon",
+        station_dv,
+        "rlat",
+        "rlon",
+        "lat",
+        "lon",
+        "elev (m)",
+        "station_name",
+        "province",
+        "model_values",
+    ]
+
+    # Province key is used for WP10 and WP50 for
+    # special treatment of Atlantic/Far NW areas
+    df_match = aggregate_stations(
+        df[[key for key in columns if key in df.columns]], ds.rlon.size
+    )
+
+    ratio, best_tol = scale_model_obs(df_match.model_values, df_match[station_dv])
+    if np.any(np.isnan(ratio)):
+        raise ValueError("NaN ratio encountered.")
+    df_match = df_match.assign(ratio=ratio)
+    logging.info(f"Scaling factor: {best_tol}")
+
+    if temperature:
+        df_match[station_dv] -= KELVIN
+        df_match.model_values -= KELVIN
+
+    if np.any(df_match["ratio"] < 0):
+        raise ValueError("Negative ratio encountered.")
+
+    return df_match
+
+
+def unique_windows(df, station_dv, n=30):
+    """Removes stations whose n nearest neighbour window is identical
+    to the window of a station earlier in the table.
+    Args:
+        df (pandas.DataFrame): stations with lat and lon
+        station_dv (str): station design value column
+        n (int): window size
+    Returns:
+        df (pandas.DataFrame): stations with unique windows
+    """
+    from sklearn.neighbors import NearestNeighbors
+
+    X_distances = np.stack([np.deg2rad(df.lat.values), np.deg2rad(df.lon.values)])
+    nbrs = NearestNeighbors(n_neighbors=n, metric="haversine").fit(X_distances.T)
+    dist, ind = nbrs.kneighbors(X_distances.T)
+
+    windows = df[["lon", "lat", station_dv]].values[ind].reshape(ind.shape[0], -1)
+    _, first = np.unique(windows, axis=0, return_index=True)
+    good_i = np.sort(first)
+
+    if good_i.size != df.shape[0]:
+        warnings.warn("There are identical windows!")
+
+    return df.iloc[good_i]
+
+
+def reconstruct(
+    ds,
+    df,
+    mask,
+    northern_mask,
+    station_dv,
+    df_nbcc=None,
+    medians={"value": "None", "action": "None"},
+    n=30,
+    blend="mean",
+    tiling="station",
+    kriging="window",
+    variance=False,
+    rules=None,
+    batch_size=1,
+    r_cores=1,
+):
+    """Builds the moving window ratio reconstruction (MWOrK) of a
+    preprocessed model from matched station ratios.
+    Args:
+        ds (xarray.Dataset): preprocessed model
+        df (pandas.DataFrame): processed stations from process_stations
+        mask, northern_mask (np.ndarray): boolean target and northern
+            (UAA) masks on the model grid
+        station_dv (str): station design value column
+        df_nbcc (pandas.DataFrame, optional): NBCC locations used to
+            apply the mean correction. No correction is applied if None
+        medians (dict): "value" and "action" ("add", "multiply" or
+            "None") of the NBCC correction
+        n (int): number of stations in each window
+        blend (str): how overlapping windows are combined, "mean" or
+            "taper". See rkrig_r
+        tiling (str): one window per "station", or per "kmeans" or
+            "quadtree" tile of stations. See rkrig_r
+        kriging (str): "window" for the moving windows of rkrig_r or
+            "sparse" to krige every station at once with rkrig_sparse
+        variance (bool): whether to add the prediction variance of the
+            reconstruction as a second variable, "<dv>_variance". It is
+            computed in the same pass as the windows, scaled by the
+            squared model field and filled like the reconstruction,
+            and is NaN where the northern fill value is used
+        rules (list, optional): initial window sizes that differ from
+            n, see initial_window_sizes. Defaults to WINDOW_RULES
+        batch_size (int): number of windows kriged in each call to R,
+            see rkrig_r. Experimental above 1
+        r_cores (int): number of processes R krigs each batch with
+    Returns:
+        ds_recon (xarray.Dataset): reconstruction
+    """
+    from climpyrical.rkrig import rkrig_r, rkrig_sparse
+
+    value, action = medians["value"], medians["action"]
+    if action not in ["add", "multiply", "None"]:
+        raise ValueError(
+            "Please provide either add or multiply or None actions in config."
+        )
+    if kriging not in ["window", "sparse"]:
+        raise ValueError("Please provide either window or sparse kriging in config.")
+    if variance and kriging != "window":
+        raise ValueError("Variance is only available with window kriging.")
+
+    (dv,) = ds.data_vars
+    units = ds[dv].attrs["units"]
+    rlon, rlat = np.meshgrid(ds.rlon, ds.rlat)
+
+    df = df.copy()
+    mean = ds[dv].values.copy()
+
+    temperature = is_temperature(ds, station_dv)
+    if temperature:
+        df[station_dv] += KELVIN
+        df["model_values"] += KELVIN
+        mean += KELVIN
+
+    df_south = unique_windows(df[df.rlat <= DSOLD_MAX], station_dv, n)
+
+    UAA_station_mean = np.nanmean(df[station_dv][df.rlat > DSOLD_MAX - 1])
+
+    ratio, best_tol = scale_model_obs(df.model_values, df[station_dv])
+
+    # apply correction
+    mean_corrected = mean / best_tol
+
+    ratio_variance = None
+    if kriging == "sparse":
+        ratio_field = rkrig_sparse(df_south, ds, mask)
+    elif variance:
+        ratio_field, ratio_variance = rkrig_r(
+            df_south,
+            n,
+            ds,
+            station_dv,
+            blend=blend,
+            tiling=tiling,
+            return_variance=True,
+            rules=rules,
+            batch_size=batch_size,
+            r_cores=r_cores,
+        )
+        ratio_variance[~mask] = np.nan
+    else:
+        ratio_field = rkrig_r(
+            df_south,
+            n,
+            ds,
+            station_dv,
+            blend=blend,
+            tiling=tiling,
+            rules=rules,
+            batch_size=batch_size,
+            r_cores=r_cores,
+        )
+    ratio_field[~mask] = np.nan
+
+    selection = ~np.isnan(
+        ds[dv]
+        .where(
+            (ds.lat > 72.0)
+            & (ds.lat < 73)
+            & (ds.lon - 360 < -75)
+            & (ds.lon - 360 > -127)
+        )
+        .values
+    )
+
+    nanmask = ~np.isnan(ratio_field)
+
+    points = np.stack([rlon[nanmask], rlat[nanmask]]).T
+    target_points = np.stack([rlon[nanmask ^ mask], rlat[nanmask ^ mask]]).T
+
+    # We treat TJul2.5 and TwJul2.5 slightly differently than the other DVs
+    # since an artefact appears in SW Yukon in the CanRCM4 models. Since
+    # stations happen to be close to coastlines for this DV, we directly
+    # fill with the nearest reconstructed value, as opposed to the ratio
+    # value for the remaining DVs
+    if station_dv in ["TJul2.5 (degC)", "TwJul2.5 (degC)"]:
+        reconstructed_field = ratio_field * mean_corrected
+        target_values = reconstructed_field[nanmask]
+        reconstructed_field[nanmask ^ mask] = interpolate_dataset(
+            points, target_values, target_points, "nearest"
+        )
+        if variance:
+            variance_field = ratio_variance * mean_corrected**2
+            variance_field[nanmask ^ mask] = interpolate_dataset(
+                points, variance_field[nanmask], target_points, "nearest"
+            )
+    else:
+        target_values = ratio_field[nanmask]
+        ratio_field[nanmask ^ mask] = interpolate_dataset(
+            points, target_values, target_points, "nearest"
+        )
+        reconstructed_field = ratio_field * mean_corrected
+        if variance:
+            ratio_variance[nanmask ^ mask] = interpolate_dataset(
+                points, ratio_variance[nanmask], target_points, "nearest"
+            )
+            variance_field = ratio_variance * mean_corrected**2
+
+    reconstructed_field_strip_mean = np.nanmean(reconstructed_field[selection])
+    combined_ratio_station_mean = np.mean(
+        [reconstructed_field_strip_mean, UAA_station_mean]
+    )
+
+    if station_dv == "Gum-LM RL10 (mm)":
+        combined_ratio_station_mean = df[station_dv].iloc[np.argmax(df.rlat.values)]
+
+    reconstructed_field[northern_mask] = combined_ratio_station_mean
+    if variance:
+        variance_field[northern_mask] = np.nan
+
+    logging.info(
+        f"Northern fill value: Reconstruction {reconstructed_field_strip_mean}, "
+        f"UAA_station_mean {UAA_station_mean}, "
+        f"Combined {combined_ratio_station_mean}"
+    )
+
+    if temperature:
+        reconstructed_field -= KELVIN
+
+    if df_nbcc is not None and (value != "None" or action != "None"):
+        ds_recon = gen_dataset(
+            dv, reconstructed_field, ds.rlat, ds.rlon, ds.lat, ds.lon, unit=units
+        )
+        dfp = add_model_values(ds=ds_recon, df=df_nbcc)
+        med_pcic = np.nanmean(dfp["model_values"])
+
+        if action == "multiply":
+            fr = med_pcic / value
+            reconstructed_field = (1 / fr) * reconstructed_field
+            if variance:
+                variance_field = variance_field / fr**2
+            logging.info(f"f: {fr}")
+        if action == "add":
+            d = med_pcic - value
+            reconstructed_field = reconstructed_field - d
+            logging.info(f"d: {d}")
+
+    ds_recon = gen_dataset(
+        dv, reconstructed_field, ds.rlat, ds.rlon, ds.lat, ds.lon, unit=units
+    )
+
+    if ds.attrs:
+        all_keys = set(ds_recon.variables).union(set(ds_recon.dims))
+        for key in all_keys:
+            ds_recon[key].attrs = ds[key].attrs
+        attr_dict = dict(ds.attrs)
+        attr_dict["Climpyrical"] = (
+            "CanRCM4 Reconstruction contains"
+            "hybrid station and model data using"
+            "Climpyrical (https://github.com/pacificclimate/climpyrical)"
+        )
+        ds_recon.attrs = attr_dict
+    else:
+        warnings.warn("No attributes detected in dataset file")
+
+    if variance:
+        name = f"{dv}_variance"
+        ds_recon[name] = (("rlat", "rlon"), variance_field)
+        ds_recon[name].attrs = {
+            "units": f"({units})^2",
+            "long_name": f"Kriging prediction variance of {dv}",
+        }
+        ds_recon[dv].attrs = {**ds_recon[dv].attrs, "ancillary_variables": name}
+
+    return ds_recon
+
+
+def nbcc_table(ds_recon, df_nbcc, station_dv):
+    """Matches the reconstruction to the NBCC Table C2 locations.
+    Args:
+        ds_recon (xarray.Dataset): reconstruction
+        df_nbcc (pandas.DataFrame): locations from read_nbcc_locations
+        station_dv (str): column name of the matched values
+    Returns:
+        df_out (pandas.DataFrame)
+    """
+    return add_model_values(ds=ds_recon, df=df_nbcc, model_dv=station_dv)
+
+
+def combine_tables(tables, dvs):
+    """Combines per design value NBCC tables into the final Table C2.
+    Args:
+        tables (list of pandas.DataFrame): output of nbcc_table for
+            each design value, in the order of dvs
+        dvs (dict): the "dvs" section of the config
+    Returns:
+        df_final_ordered (pandas.DataFrame)
+    """
+    df = tables[-1]
+    df_combined = pd.DataFrame().assign(
+        Location=df.Location, Prov=df.Prov, lon=df.lon, lat=df.lat
+    )
+    df_combined["2020 Elev (m)"] = df["2020 Elev (m)"]
+    for table, key in zip(tables, dvs.keys()):
+        df_combined[dvs[key]["station_dv"]] = table[dvs[key]["station_dv"]]
+
+    if df_combined.isnull().values.any():
+        raise ValueError("NaN detected in combined tables.")
+
+    df_final = df_combined.rename(columns=ORIGINAL_COLUMNS)
+    df_final_ordered = df_final.copy()
+
+    # populate new TableC2 values with DVs from the config
+    for key, original in ORIGINAL_DVS.items():
+        if key not in df_final.columns:
+            continue
+        df_final_ordered[original] = df_final[key]
+        if key != original:
+            df_final_ordered = df_final_ordered.drop(key, axis=1)
+
+    return df_final_ordered
+
+
+def plot_dict():
+    """Returns the colour map, log scale flag and number of decimals used
+    to plot each design value."""
+    import matplotlib
+
+    lmap = [
+        "#B544A6",
+        "#884DB2",
+        "#5856AF",
+        "#6089AC",
+        "#6AA8A2",
+        "#64AE90",
+        "#62B07A",
+        "#75B85B",
+        "#B1BF53",
+        "#C78E4B",
+    ][::-1]
+    custom_cmap = matplotlib.colors.ListedColormap(lmap)
+
+    return {
+        "RL50 (kPa)": (custom_cmap, True, 2),
+        "mean RH (%)": (custom_cmap, False, 1),
+        "HDD (degC-day)": ("RdBu", False, 0),
+        "SL50 (kPa)": (custom_cmap, False, 1),
+        "WP10 (kPa)": (custom_cmap, False, 2),
+        "WP50 (kPa)": (custom_cmap, False, 2),
+        "TJan2.5 (degC)": ("RdBu_r", False, 1),
+        "TJan1.0 (degC)": ("RdBu_r", False, 1),
+        "Tmin (degC)": ("RdBu_r", False, 1),
+        "Tmax (degC)": ("RdBu_r", False, 1),
+        "TJul2.5 (degC)": ("RdBu_r", False, 1),
+        "TwJul2.5 (degC)": ("RdBu_r", False, 1),
+        "annual_rain (mm)": (custom_cmap, True, 0),
+        "annual_pr (mm)": (custom_cmap, True, 0),
+        "DRWP-RL5 (Pa)": (custom_cmap, False, 0),
+        "1day rain RL50 (mm)": (custom_cmap, True, 0),
+        "moisture_index": (custom_cmap, False, 2),
+        "Gum-LM RL10 (mm)": (custom_cmap, True, 1),
+    }
+
+
+def plot_map(ax, ds, df, values, label, title, style, vmin, vmax, outline, aspect=None):
+    """Draws a gridded field, or station values if df is given, on the
+    rotated pole grid with a colour bar, contours and summary text.
+    """
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    colorscale, log, decimal = style
+    N = 10
+    X, Y, extent, (cxmin, cxmax, cymin, cymax) = outline
+    cmap = matplotlib.cm.get_cmap(colorscale, N)
+
+    if log:
+        ticks_lin = np.linspace(np.log10(vmin), np.log10(vmax), N + 1)
+        ticks = np.round([10**exponent for exponent in ticks_lin], decimal)
+        plotted = np.log10(values)
+        cmin, cmax = ticks_lin.min(), ticks_lin.max()
+    else:
+        ticks = np.round(np.linspace(vmin, vmax, N + 1), decimals=decimal)
+        ticks_lin = ticks
+        plotted = values
+        cmin, cmax = vmin, vmax
+
+    if df is None:
+        col1 = ax.imshow(
+            plotted,
+            origin="lower",
+            extent=extent,
+            vmin=cmin,
+            vmax=cmax,
+            cmap=cmap,
+            aspect=aspect,
+        )
+    else:
+        col1 = ax.scatter(
+            df.rlon, df.rlat, c=plotted, s=230, vmin=cmin, vmax=cmax, cmap=cmap
+        )
+
+    cbar = plt.colorbar(
+        col1,
+        ax=ax,
+        fraction=0.038,
+        pad=0.05,
+        ticks=ticks_lin,
+        spacing="proportional",
+    )
+    if decimal == 0:
+        cbar.ax.set_yticklabels([f"{x:.0f}" for x in ticks])
+    else:
+        cbar.ax.set_yticklabels([f"{x}" for x in ticks])
+    cbar.ax.tick_params(labelsize=30)
+
+    if df is None:
+        CS = ax.contour(
+            ds.rlon, ds.rlat, values, ticks, colors="black", linewidths=1, zorder=4
+        )
+        ax.clabel(CS, fontsize=18, inline=1, fmt=f"%1.{decimal}f")
+
+    fmt = ".0f" if decimal == 0 else ""
+    stats = [(35, "Min", np.nanmin), (33, "Max", np.nanmax), (31, "Mean", np.nanmean)]
+    for y, stat, func in stats:
+        ax.text(
+            10,
+            y,
+            f"{label} {stat}: {np.round(func(values), decimal):{fmt}}",
+            fontsize=25,
+        )
+
+    ax.set_title(title, fontsize=40)
+    ax.set_xlim(cxmin - 1, cxmax + 1)
+    ax.set_ylim(cymin - 1, cymax + 1)
+
+    # Hide grid lines and axes ticks
+    ax.grid(False)
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.plot(X, Y, color="black")
+
+
+def plot_distributions(ax, model, reconstruction, df, station_dv, name):
+    """Draws violin plots of the model, reconstruction and stations at
+    the station grid cells."""
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    (dv,) = reconstruction.data_vars
+    station_vals = df[station_dv].values
+    model_vals = model[dv].values[df.irlat, df.irlon].flatten()
+    recon_vals = reconstruction[dv].values[df.irlat, df.irlon].flatten()
+
+    with sns.axes_style("whitegrid"):
+        ax.xaxis.set_major_locator(plt.MaxNLocator(8))
+        vdf = pd.DataFrame(
+            {
+                station_dv: np.concatenate([model_vals, recon_vals, station_vals]),
+                "": ["CanRCM4 Mean"] * model_vals.size
+                + ["Reconstruction"] * recon_vals.size
+                + ["Stations"] * station_vals.size,
+            }
+        )
+        ax.set_title(f"{name} Distributions", fontsize=35)
+        vp = sns.violinplot(
+            ax=ax, x=station_dv, y="", data=vdf, palette=sns.color_palette("pastel")
+        )
+        vp.tick_params(labelsize=27)
+        ax.set_xlabel(ax.get_xlabel(), fontsize=27)
+
+
+def make_plots(name, station_dv, model, reconstruction, df, output_figure_path):
+    """Writes the reconstruction, CanRCM4 mean, stations, distribution and
+    panel figures for a design value to output_figure_path.
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import geopandas as gpd
+    from climpyrical.mask import stratify_coords
+
+    canada = gpd.read_file(resolve_path("data/vectors/canada_final.shp")).geometry
+
+    (dv,) = reconstruction.data_vars
+    if station_dv != "1day rain RL50 (mm)":
+        units = model[dv].attrs["units"]
+    else:
+        units = "mm"
+
+    # load coastlines, provinces
+    X, Y = stratify_coords(canada)
+    extent = [model.rlon.min(), model.rlon.max(), model.rlat.min(), model.rlat.max()]
+    bounds = (
+        canada.bounds.minx.min(),
+        canada.bounds.maxx.max(),
+        canada.bounds.miny.min(),
+        canada.bounds.maxy.max(),
+    )
+    outline = (X, Y, extent, bounds)
+
+    style = plot_dict()[station_dv]
+    vmin = np.nanmin(reconstruction[dv].values)
+    vmax = np.nanmax(reconstruction[dv].values)
+
+    maps = [
+        (reconstruction, None, reconstruction[dv].values, "Reconstruction"),
+        (model, None, model[dv].values, "CanRCM4"),
+        (reconstruction, df, df[station_dv].values, "Stations"),
+    ]
+    titles = ["Reconstruction", "CanRCM4 Mean", "Stations"]
+
+    for kind, (ds, dfs, values, label), title in zip(PLOT_KINDS, maps, titles):
+        fig, ax = plt.subplots(figsize=(25, 20 if dfs is not None else 25))
+        plot_map(
+            ax,
+            ds,
+            dfs,
+            values,
+            label,
+            f"{name} [{units}] {title}",
+            style,
+            vmin,
+            vmax,
+            outline,
+        )
+        fig.savefig(f"{output_figure_path}{name}_{kind}.png", dpi=150)
+        plt.close(fig)
+
+    fig, ax = plt.subplots(figsize=(25, 25))
+    plot_distributions(ax, model, reconstruction, df, station_dv, name)
+    fig.savefig(f"{output_figure_path}{name}_dist.png", bbox_inches="tight", dpi=150)
+    plt.close(fig)
+
+    fig, ax = plt.subplots(
+        2, 2, gridspec_kw={"height_ratios": [0.6, 0.6]}, figsize=(45, 34)
+    )
+    for axi, (ds, dfs, values, label), title in zip(
+        [ax[1, 1], ax[1, 0], ax[0, 1]], maps, titles
+    ):
+        plot_map(
+            axi,
+            ds,
+            dfs,
+            values,
+            label,
+            f"{name} [{units}] {title}",
+            style,
+            vmin,
+            vmax,
+            outline,
+            aspect="auto",
+        )
+    plot_distributions(ax[0, 0], model, reconstruction, df, station_dv, name)
+    fig.savefig(f"{output_figure_path}{name}_panel.png", bbox_inches="tight", dpi=150)
+    plt.close(fig)
+
+
+def prepare_shared(config, plan, mapper=map):
+    """Computes the artefacts shared between design values once: the
+    preprocessing masks, the target and northern masks, and one matched
+    station table per station file.
+    Args:
+        config (dict): pipeline config from load_config
+        plan (dict): output of plan_stages
+        mapper (callable): map function used to prepare the station
+            tables, e.g. multiprocessing.Pool.map
+    Returns:
+        shared (dict): artefacts for each design value in plan, to be
+            passed to run_dv
+        timings (dict): seconds spent preparing the artefacts, keyed by
+            the first stage that uses them
+    """
+    paths = config["paths"]
+    root = config["root"]
+    mask_path = resolve_path(paths["mask_path"], root)
+    north_mask_path = resolve_path(paths["north_mask_path"], root)
+
+    running = {stage for stages in plan.values() for stage in stages}
+    shared = {name: {} for name in plan}
+    timings = {}
+
+    if running & {"preprocess_model", "MWOrK"}:
+        start = time.perf_counter()
+        if "preprocess_model" in running:
+            masks = load_preprocess_masks(mask_path, north_mask_path)
+            target_masks = masks["canada"], masks["north"]
+        else:
+            masks = None
+            target_masks = (
+                read_data(mask_path)["mask"].values,
+                read_data(north_mask_path)["mask"].values,
+            )
+        for name, stages in plan.items():
+            if "preprocess_model" in stages:
+                shared[name]["preprocess_masks"] = masks
+            if "MWOrK" in stages:
+                shared[name]["masks"] = target_masks
+        stage = "preprocess_model" if masks is not None else "MWOrK"
+        timings[stage] = time.perf_counter() - start
+
+    names = [name for name, stages in plan.items() if "stations" in stages]
+    if names:
+        start = time.perf_counter()
+        groups = shared_inputs(config, names, "station_path")
+        for path, group in groups.items():
+            if len(group) > 1:
+                logging.info(f"{', '.join(group)} share stations from {path}")
+
+        jobs = [
+            (path, mask_path, [config["dvs"][name]["station_dv"] for name in group])
+            for path, group in groups.items()
+        ]
+        tables = mapper(_prepare_station_table, jobs)
+        for table, group in zip(tables, groups.values()):
+            for name in group:
+                shared[name]["station_table"] = table
+        timings["stations"] = time.perf_counter() - start
+
+    return shared, timings
+
+
+def _prepare_station_table(args):
+    return prepare_station_table(*args)
+
+
+def run_dv(name, config, force=False, stages=None, shared=None):
+    """Runs every per design value stage listed in config["steps"] for a
+    single design value. Objects produced by one stage are passed to the
+    next directly; outputs are only read back from disk for stages that
+    were skipped because they were up to date.
+    Args:
+        name (str): design value key in config["dvs"]
+        config (dict): pipeline config from load_config
+        force (bool): run stages even if their outputs are up to date
+        stages (list of str, optional): stages to run from plan_stages.
+            Planned from force and the file times if None
+        shared (dict, optional): artefacts for this design value from
+            prepare_shared. Loaded as needed if None
+    Returns:
+        timings (dict): seconds spent in each stage, None if skipped.
+            If config["profile"] is set, a detailed report of the run
+            is also written to profile_paths
+    """
+    params = config["dvs"][name]
+    paths = config["paths"]
+    root = config["root"]
+    station_dv = params["station_dv"]
+
+    if stages is None:
+        stages = plan_stages(config, [name], force)[name]
+    if shared is None:
+        shared = {}
+
+    objects = {}
+
+    def load(key, path):
+        if key not in objects:
+            if path.endswith(".nc"):
+                objects[key] = read_data(path)
+            else:
+                objects[key] = pd.read_csv(path, index_col=False)
+        return objects[key]
+
+    model_path = stage_io("preprocess_model", name, config)[1][0]
+    stations_path = stage_io("stations", name, config)[1][0]
+    recon_path = stage_io("MWOrK", name, config)[1][0]
+
+    if config["profile"]:
+        profiling.enable()
+
+    timings = {}
+    for stage in config["steps"]:
+        if stage == "combine_tables":
+            continue
+
+        if stage not in stages:
+            logging.info(f"{name}: {stage} is up to date, skipping")
+            timings[stage] = None
+            continue
+
+        logging.info(f"{name}: running {stage}")
+        outputs = stage_io(stage, name, config)[1]
+        for path in outputs:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        start = time.perf_counter()
+        with profiling.stage(stage):
+            if stage == "preprocess_model":
+                masks = shared.get("preprocess_masks")
+                if masks is None:
+                    masks = load_preprocess_masks(
+                        resolve_path(paths["mask_path"], root),
+                        resolve_path(paths["north_mask_path"], root),
+                    )
+                ds = read_data(resolve_path(params["input_model_path"], root))
+                ds = preprocess_model(ds, params["fill_glaciers"], masks)
+                write_netcdf(ds, model_path)
+                objects["model"] = ds
+
+            elif stage == "stations":
+                ds = load("model", model_path)
+                if "station_table" in shared:
+                    df, (rlon, rlat) = shared["station_table"]
+                    matched = np.array_equal(ds.rlon.values, rlon) and np.array_equal(
+                        ds.rlat.values, rlat
+                    )
+                    if not matched:
+                        warnings.warn(f"{name} is not on the shared grid, rematching")
+                        df = df.drop(columns=["irlat", "irlon"])
+                else:
+                    df = read_stations(
+                        resolve_path(params["station_path"], root), [station_dv]
+                    )
+                    matched = False
+                df = process_stations(df, ds, station_dv, matched=matched)
+                df.to_csv(stations_path, index=False)
+                objects["stations"] = df
+
+            elif stage == "MWOrK":
+                if "masks" in shared:
+                    mask, northern_mask = shared["masks"]
+                else:
+                    mask = read_data(resolve_path(paths["mask_path"], root))
+                    northern_mask = read_data(
+                        resolve_path(paths["north_mask_path"], root)
+                    )
+                    mask, northern_mask = (
+                        mask["mask"].values,
+                        northern_mask["mask"].values,
+                    )
+                df_nbcc = None
+                if config["nbcc_correction"]:
+                    df_nbcc = read_nbcc_locations(
+                        resolve_path(paths["nbcc_loc_path"], root)
+                    )
+                ds_recon = reconstruct(
+                    load("model", model_path),
+                    load("stations", stations_path),
+                    mask,
+                    northern_mask,
+                    station_dv,
+                    df_nbcc=df_nbcc,
+                    medians=params["medians"],
+                    n=params.get("n", 30),
+                    blend=params.get("blend", "mean"),
+                    tiling=params.get("tiling", "station"),
+                    kriging=params.get("kriging", "window"),
+                    variance=params.get("variance", False),
+                    rules=params.get("window_rules"),
+                    batch_size=params.get("batch_size", 1),
+                    r_cores=params.get("r_cores", 1),
+                )
+                write_netcdf(ds_recon, recon_path)
+                # later stages only use the reconstruction itself
+                objects["reconstruction"] = ds_recon.drop_vars(
+                    ancillary_variables(ds_recon)
+                )
+
+            elif stage == "plots":
+                make_plots(
+                    name,
+                    station_dv,
+                    load("model", model_path),
+                    load("reconstruction", recon_path),
+                    load("stations", stations_path),
+                    resolve_path(paths["output_figure_path"], root),
+                )
+
+            elif stage == "nbcc_locations":
+                df_nbcc = read_nbcc_locations(
+                    resolve_path(paths["nbcc_loc_path"], root)
+                )
+                df_out = nbcc_table(
+                    load("reconstruction", recon_path), df_nbcc, station_dv
+                )
+                df_out.round(3).to_csv(outputs[0], index=False)
+
+        write_params(outputs, stage_params(stage, name, config))
+        timings[stage] = time.perf_counter() - start
+        logging.info(f"{name}: {stage} finished in {timings[stage]:.1f} s")
+
+    if config["profile"]:
+        for path in profile_paths(name, config):
+            profiling.write_report(path, dv=name, stages=stages)
+        profiling.disable()
+
+    return timings
+
+
+def _run_dv(args):
+    name, config, stages, shared = args
+    return name, run_dv(name, config, stages=stages, shared=shared)
+
+
+def run_pipeline(config, names=None, n_jobs=None, force=False):
+    """Runs the pipeline for each design value across a worker pool, then
+    combines the NBCC tables once every design value has finished.
+    Artefacts shared between design values are prepared first and
+    handed to each design value's worker.
+    Args:
+        config (dict): pipeline config from load_config
+        names (list of str, optional): subset of design values to run.
+            Defaults to every key in config["dvs"]
+        n_jobs (int, optional): number of worker processes. Defaults to
+            config["n_jobs"]
+        force (bool): run stages even if their outputs are up to date
+    Returns:
+        timings (pandas.DataFrame): seconds per stage (columns) for
+            each design value (rows), NaN where a stage was skipped.
+            Time spent on shared artefacts is in the "shared" row
+    """
+    if names is None:
+        names = list(config["dvs"].keys())
+    missing = [name for name in names if name not in config["dvs"]]
+    if missing:
+        raise KeyError(f"Design values {missing} not in config")
+    if n_jobs is None:
+        n_jobs = config["n_jobs"]
+
+    plan = plan_stages(config, names, force)
+
+    def run(mapper):
+        shared, shared_timings = prepare_shared(config, plan, mapper)
+        jobs = [(name, config, plan[name], shared[name]) for name in names]
+        return list(mapper(_run_dv, jobs)), shared_timings
+
+    if n_jobs > 1 and len(names) > 1:
+        with Pool(min(n_jobs, len(names))) as p:
+            results, shared_timings = run(partial(p.map, chunksize=1))
+    else:
+        results, shared_timings = run(lambda func, jobs: list(map(func, jobs)))
+
+    timings = dict(results)
+    if shared_timings:
+        timings["shared"] = shared_timings
+
+    if "combine_tables" in config["steps"]:
+        inputs, outputs = stage_io("combine_tables", None, config)
+        if force or not is_up_to_date(inputs, outputs):
+            start = time.perf_counter()
+            tables = [pd.read_csv(path) for path in inputs]
+            df = combine_tables(tables, config["dvs"])
+            df.round(3).to_csv(outputs[0], index=False)
+            timings["combine_tables"] = {"combine_tables": time.perf_counter() - start}
+
+    return pd.DataFrame.from_dict(timings, orient="index").reindex(
+        columns=[stage for stage in STAGES if stage in config["steps"]]
+    )
+
+
+@click.command()
+@click.option("-c", "--config-path", help="Pipeline YAML config", required=True)
+@click.option(
+    "-d",
+    "--dv",
+    "names",
+    help="Design value to run. May be repeated. Defaults to all in config",
+    multiple=True,
+)
+@click.option("-n", "--n-jobs", help="Number of worker processes", type=int)
+@click.option("-f", "--force", help="Rerun up to date stages", is_flag=True)
+@click.option("-t", "--timings-path", help="Optional csv file of stage timings")
+@click.option(
+    "-p", "--profile", help="Write a profile report per design value", is_flag=True
+)
+@click.option(
+    "-l",
+    "--log-level",
+    help="Logging level",
+    type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]),
+    default="INFO",
+)
+def main(config_path, names, n_jobs, force, timings_path, profile, log_level):
+    logging.basicConfig(level=log_level)
+    config = load_config(config_path)
+    if profile:
+        config["profile"] = True
+    timings = run_pipeline(
+        config, names=list(names) or None, n_jobs=n_jobs, force=force
+    )
+    click.echo(timings.round(1).to_string())
+    if timings_path is not None:
+        timings.to_csv(timings_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Opt-in profiling of climpyrical's expensive stages.
+usage:
+    from climpyrical import profiling
+    profiling.enable()
+    ... reconstruct a design value ...
+    profiling.write_report("profile_RL50.json")
+
+Functions decorated with profiled and blocks wrapped in stage record
+their wall time, CPU time and the peak resident memory of the process
+when they finish. Stages nest, so a window kriged inside rkrig_r is
+reported as rkrig_r/window. Counters, e.g. the number of R errors
+skipped, are attributed to every stage that is running when they are
+incremented. Nothing is recorded until enable is called, and the
+disabled overhead is a single dictionary lookup.
+"""
+
+from contextlib import contextmanager
+from functools import wraps
+import json
+import os
+import sys
+import time
+
+# profiler state for this process
+_STATE = {"enabled": False, "records": [], "counters": {}, "stack": [], "t0": 0.0}
+
+
+def enable(reset_records: bool = True) -> None:
+    """Starts recording stages and counters.
+    Args:
+        reset_records (bool): discard anything previously recorded
+    """
+    if reset_records:
+        reset()
+    _STATE["enabled"] = True
+
+
+def disable() -> None:
+    """Stops recording. Records are kept until reset is called"""
+    _STATE["enabled"] = False
+
+
+def is_enabled() -> bool:
+    return _STATE["enabled"]
+
+
+def reset() -> None:
+    """Discards every record and counter"""
+    _STATE["records"] = []
+    _STATE["counters"] = {}
+    _STATE["stack"] = []
+    _STATE["t0"] = time.perf_counter()
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB, NaN where the
+    resource module is unavailable (Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return float("nan")
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return rss / 1e6 if sys.platform == "darwin" else rss / 1e3
+
+
+def count(name: str, n: int = 1) -> None:
+    """Increments a counter in the current stage and every stage
+    enclosing it.
+    Args:
+        name (str): name of counter
+        n (int): amount to increment by
+    """
+    if not _STATE["enabled"]:
+        return
+    _STATE["counters"][name] = _STATE["counters"].get(name, 0) + n
+    for frame in _STATE["stack"]:
+        frame["counters"][name] = frame["counters"].get(name, 0) + n
+
+
+@contextmanager
+def stage(name: str, **tags):
+    """Records the time and memory spent in a block of code.
+    Args:
+        name (str): name of stage
+        tags: extra values stored with the record, e.g. the
+            index of a window
+    """
+    if not _STATE["enabled"]:
+        yield
+        return
+
+    stack = _STATE["stack"]
+    frame = {"name": name, "counters": {}}
+    stack.append(frame)
+    path = "/".join(f["name"] for f in stack)
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        stack.pop()
+        record = {
+            "stage": path,
+            "depth": len(stack),
+            "start_s": start - _STATE["t0"],
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        record.update(tags)
+        record.update(frame["counters"])
+        _STATE["records"].append(record)
+
+
+def profiled(func):
+    """Decorator recording each call of func as a stage named after it"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _STATE["enabled"]:
+            return func(*args, **kwargs)
+        with stage(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def report():
+    """Returns every record as a pandas.DataFrame with one row per
+    stage call, in the order the stages finished"""
+    import pandas as pd
+
+    return pd.DataFrame(_STATE["records"])
+
+
+def summary():
+    """Returns the records aggregated per stage: number of calls,
+    total wall and CPU time, the highest peak memory and the sum of
+    each counter.
+    """
+    import pandas as pd
+
+    df = report()
+    if df.empty:
+        return pd.DataFrame(
+            columns=["stage", "calls", "wall_s", "cpu_s", "peak_rss_mb"]
+        )
+
+    agg = {"depth": "size", "wall_s": "sum", "cpu_s": "sum", "peak_rss_mb": "max"}
+    agg.update({key: "sum" for key in _STATE["counters"] if key in df.columns})
+
+    df_summary = df.groupby("stage", sort=False).agg(agg)
+    return df_summary.rename(columns={"depth": "calls"}).reset_index()
+
+
+def write_report(path: str, **meta) -> None:
+    """Writes the profile to path. A .json file contains meta, the
+    counter totals, the per stage summary and every record; a .csv
+    file contains one row per record.
+    Args:
+        path (str): output .json or .csv file
+        meta: extra values stored in the json report, e.g. the
+            design value name
+    Raises:
+        ValueError: if path is not a .json or .csv file
+    """
+    if not path.endswith(".csv") and not path.endswith(".json"):
+        raise ValueError("Profile report must be a .json or .csv file")
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if path.endswith(".csv"):
+        report().to_csv(path, index=False)
+    else:
+        content = {
+            "meta": meta,
+            "counters": dict(_STATE["counters"]),
+            "summary": json.loads(summary().to_json(orient="records")),
+            "records": json.loads(report().to_json(orient="records")),
+        }
+        with open(path, "w") as f:
+            json.dump(content, f, indent=2)
@@ -1,24 +1,49 @@
 import climpyrical.spytialProcess as sp
-from climpyrical.gridding import find_nearest_index
+from climpyrical.gridding import find_nearest_index, find_nearest_indices
+from climpyrical.profiling import profiled, stage, count
 
 from nptyping import NDArray
-from typing import Any
+from typing import Any, Tuple
 import xarray as xr
-from sklearn.neighbors import NearestNeighbors
-from pykrige.ok import OrdinaryKriging
-from tqdm import tqdm
-
-from scipy.spatial import ConvexHull
-import rpy2
 
 import numpy as np
 import pandas as pd
 
 
+import time
 import warnings
-from rpy2.rinterface import RRuntimeWarning
 
-warnings.filterwarnings("ignore", category=RRuntimeWarning)
+# columns of the window table returned by rkrig_r
+WINDOW_COLUMNS = [
+    "station",
+    "lat",
+    "lon",
+    "n_neighbours",
+    "n_core",
+    "hull_enlargements",
+    "hull_area",
+    "bbox_cells",
+    "fit_s",
+    "predict_s",
+    "se_s",
+    "wall_s",
+    "success",
+    "error",
+]
+
+# initial window sizes that differ from n, used by initial_window_sizes
+# unless rules are given. A rule applies to stations of its station_dv
+# (any if absent) with lat in [min_lat, max_lat) and, if provinces is
+# given, in one of the provinces. Later rules take precedence.
+WINDOW_RULES = [
+    {"station_dv": "RL50 (kPa)", "min_lat": 60.0, "n": 40},
+    {
+        "station_dv": ["WP10", "WP50"],
+        "provinces": ["QC", "NL", "NU"],
+        "min_lat": 52.0,
+        "n": 10,
+    },
+]
 
 
 def check_df(df, keys=["lat", "lon", "rlat", "rlon"]):
@@ -27,9 +52,15 @@ def check_df(df, keys=["lat", "lon", "rlat", "rlon"]):
         raise KeyError(f"Dataframe must contain {keys}")
 
 
+@profiled
 def krigit_north(
-    df: pd.DataFrame, station_dv: str, n: int, ds: xr.Dataset, extrap=True
-) -> NDArray[(Any, Any), float]:
+    df: pd.DataFrame,
+    station_dv: str,
+    n: int,
+    ds: xr.Dataset,
+    extrap=True,
+    compact: bool = False,
+) -> "NDArray[(Any, Any), float]":
     """Krigs an extrapolated field for N nearest stations
     to the northernmost in the dataframe provided. Output is
     in the same dimensions as the dataset provided to be
@@ -43,13 +74,33 @@ def krigit_north(
             n: number of nearest neighbors to northern
                 most stations
             ds: model xarray dataset
+            compact: whether to return only the kriged sub-grid
+                and its bounds instead of the full field
         Returns:
-            field: kriged field for the north
+            field: kriged field for the north, or if compact
+            bbox: row and column bounds (lw, u, l, r) of the surface
+            surface: kriged field within bbox
     """
 
     dataframe_keys = ["lat", "lon", "rlat", "rlon", station_dv]
     check_df(df, dataframe_keys)
 
+    bbox, surface = _krig_north_surface(df, station_dv, n, ds, extrap)
+    if compact:
+        return bbox, surface
+
+    lw, u, l, r = bbox
+    field = np.full((ds.rlat.size, ds.rlon.size), np.nan)
+    field[lw:u, l:r] = surface
+
+    return field
+
+
+def _krig_north_surface(df, station_dv, n, ds, extrap):
+    # krigs the n stations nearest to the northernmost station and
+    # returns the surface with its bounds in the grid
+    from sklearn.neighbors import NearestNeighbors
+
     df = df[["lat", "lon", "rlat", "rlon", station_dv]]
 
     regular_points = np.stack([np.deg2rad(df.lat), np.deg2rad(df.lon)]).T
@@ -62,15 +113,12 @@ def krigit_north(
     # rather than rotated coordinates, was that this particular haversine
     # implementation gives incorrect values for rotated lon and rotated lat.
     # it does give correct distances for regular lat and lon.
+    imax = np.argmax(df.rlat.values)
     nbrs = NearestNeighbors(n_neighbors=n, metric="haversine").fit(
         regular_points
     )
-    dist, ind = nbrs.kneighbors(regular_points)
-    imax = np.argmax(df.rlat.values)  # idxmax(axis=0, skipna=True)
-    temp_df = df.iloc[ind[imax]]
-
-    xmin, xmax = temp_df.rlon.min(), temp_df.rlon.max()
-    ymin, ymax = temp_df.rlat.min(), temp_df.rlat.max()
+    _, ind = nbrs.kneighbors(regular_points[[imax]])
+    temp_df = df.iloc[ind[0]]
 
     # Note that spytialProcess requires rlon and rlat. Different
     # from the form required for haversine distances from
@@ -78,13 +126,11 @@ def krigit_north(
     latlon = np.stack([temp_df.rlon, temp_df.rlat])
     stats = temp_df[station_dv]
 
-    lw, u = (
-        find_nearest_index(ds.rlat.values, ymin),
-        find_nearest_index(ds.rlat.values, ymax),
+    lw, u = find_nearest_indices(
+        ds.rlat.values, [temp_df.rlat.min(), temp_df.rlat.max()]
     )
-    l, r = (
-        find_nearest_index(ds.rlon.values, xmin),
-        find_nearest_index(ds.rlon.values, xmax),
+    l, r = find_nearest_indices(
+        ds.rlon.values, [temp_df.rlon.min(), temp_df.rlon.max()]
     )
     ylim = u - lw
     xlim = r - l
@@ -92,26 +138,30 @@ def krigit_north(
     # krig it
     z, x, y = sp.fit(latlon, stats, xlim, ylim, extrap=extrap)
 
-    field = np.ones((ds.rlat.size, ds.rlon.size))
-    field[:, :] = np.nan
-    field[lw:u, l:r] = z.T
-
-    return field
+    return (lw, u, l, r), z.T
 
 
+@profiled
 def rkrig_py(
     df: pd.DataFrame,
     station_dv: str,
     n: int,
     ds: xr.Dataset,
     exact_values: bool = False,
-) -> NDArray[(Any, Any), float]:
+    mask: "NDArray[(Any, Any), bool]" = None,
+    chunk_size: int = 50000,
+    n_jobs: int = 1,
+) -> "NDArray[(Any, Any), float]":
     """User has the option of kriging using a Python backend
     instead of using R's fields package. PyKrige has a moving
     window implementation, however, the exacts and parameterization
     is more obscured. Note that the exponentional variogram
     function for PyKrige is different from spatialProcess in R, and
     so identical results should not be expected.
+
+    The variogram is fitted once and only the cells in mask are
+    kriged, in chunks of chunk_size points that are spread across
+    n_jobs worker processes.
         Args:
             df: pandas dataframe containing the coordinates in
                 both regular and roated, as well as the station
@@ -123,32 +173,479 @@ def rkrig_py(
             ds: model xarray dataset
             exact_values: whether to reproduce the
                 exact value of inputs
+            mask: boolean mask of the cells to krige, e.g. the
+                Canada land mask. Every cell if None
+            chunk_size: number of cells kriged at once
+            n_jobs: number of worker processes
         Returns:
-            field: kriged field
+            field: kriged field, NaN outside of mask
+        Raises:
+            ValueError: if mask does not match the grid
     """
 
     dataframe_keys = ["lat", "lon", "rlat", "rlon", station_dv]
     check_df(df, dataframe_keys)
 
+    shape = (ds.rlat.size, ds.rlon.size)
+    if mask is None:
+        mask = np.ones(shape, dtype=bool)
+    if mask.shape != shape:
+        raise ValueError(f"Mask must have the shape of the grid {shape}")
+
+    from pykrige.ok import OrdinaryKriging
+
     df = df[["lat", "lon", "rlat", "rlon", station_dv]]
 
-    ok = OrdinaryKriging(
-        df.rlon,
-        df.rlat,
-        df[station_dv],
-        exact_values=exact_values,
-        variogram_function="exponential",
+    with stage("fit"):
+        ok = OrdinaryKriging(
+            df.rlon,
+            df.rlat,
+            df[station_dv],
+            exact_values=exact_values,
+            variogram_function="exponential",
+        )
+
+    rlon, rlat = np.meshgrid(ds.rlon.values, ds.rlat.values)
+    cells = np.flatnonzero(mask)
+    chunks = [
+        (rlon.flat[chunk], rlat.flat[chunk], n)
+        for chunk in np.array_split(
+            cells, max(1, int(np.ceil(cells.size / chunk_size)))
+        )
+    ]
+
+    with stage("execute"):
+        if n_jobs > 1 and len(chunks) > 1:
+            from multiprocessing import Pool
+
+            # the fitted model is sent to each worker once
+            with Pool(
+                min(n_jobs, len(chunks)), initializer=_init_pykrige, initargs=(ok,)
+            ) as p:
+                values = p.map(_krige_chunk, chunks)
+        else:
+            _init_pykrige(ok)
+            values = [_krige_chunk(chunk) for chunk in chunks]
+        _PYKRIGE.clear()
+
+    field = np.full(shape, np.nan)
+    field.flat[cells] = np.concatenate(values)
+    count("cells_kriged", cells.size)
+
+    return field
+
+
+# fitted PyKrige model used by _krige_chunk in each process
+_PYKRIGE = {}
+
+
+def _init_pykrige(ok):
+    _PYKRIGE["ok"] = ok
+
+
+def _krige_chunk(chunk):
+    """Kriges one chunk of (rlon, rlat, n_closest_points) with the
+    model set by _init_pykrige"""
+    x, y, n = chunk
+    z, _ = _PYKRIGE["ok"].execute("points", x, y, backend="C", n_closest_points=n)
+    return np.ma.filled(z, np.nan).astype(float)
+
+
+def initial_window_sizes(
+    df: pd.DataFrame, n: int, station_dv: str, rules: list = None
+) -> "NDArray[(Any,), int]":
+    """Number of nearest neighbours each station's moving window starts
+    with before it is grown by find_windows. By default (WINDOW_RULES)
+    RL50 windows north of 60N start with 40 stations and WP10 and WP50
+    windows in QC, NL and NU north of 52N start with 10.
+        Args:
+            df: pandas dataframe of stations with lat, and
+                province if available
+            n: default number of nearest neighbours
+            station_dv: name of the column containing
+                station data in df
+            rules: list of dicts with the window size "n" and any of
+                "station_dv" (a name or list of names), "min_lat",
+                "max_lat" and "provinces". Defaults to WINDOW_RULES.
+                Rules with provinces are skipped if df has no
+                province column
+        Returns:
+            sizes: initial window size of each station
+        Raises:
+            ValueError: if a rule has no "n" or an unknown key
+    """
+    if rules is None:
+        rules = WINDOW_RULES
+
+    sizes = np.full(df.shape[0], n)
+
+    for rule in rules:
+        unknown = set(rule) - {"station_dv", "min_lat", "max_lat", "provinces", "n"}
+        if "n" not in rule or unknown:
+            raise ValueError(
+                f"Window rule {rule} must have n and only station_dv, "
+                "min_lat, max_lat and provinces"
+            )
+
+        names = rule.get("station_dv", station_dv)
+        if station_dv not in np.atleast_1d(names):
+            continue
+        if "provinces" in rule and "province" not in df.columns:
+            continue
+
+        selected = (df.lat.values >= rule.get("min_lat", -np.inf)) & (
+            df.lat.values < rule.get("max_lat", np.inf)
+        )
+        if "provinces" in rule:
+            selected &= df.province.isin(rule["provinces"]).values
+        sizes[selected] = rule["n"]
+
+    return sizes
+
+
+def station_neighbours(df: pd.DataFrame, k: int) -> "NDArray[(Any, Any), int]":
+    """Indices of the k nearest stations to each station by haversine
+    distance, nearest (the station itself) first. Can be passed to
+    find_windows to share the query between several window plans of
+    the same stations.
+        Args:
+            df: pandas dataframe of stations with lat and lon
+            k: number of neighbours, at most the number of stations
+        Returns:
+            neighbours: array of shape (stations, k)
+    """
+    from sklearn.neighbors import NearestNeighbors
+
+    X_distances = np.stack([np.deg2rad(df.lat.values), np.deg2rad(df.lon.values)]).T
+    nbrs = NearestNeighbors(metric="haversine").fit(X_distances)
+
+    return nbrs.kneighbors(X_distances, n_neighbors=min(k, df.shape[0]))[1]
+
+
+@profiled
+def find_windows(
+    df: pd.DataFrame,
+    sizes: "NDArray[(Any,), int]",
+    min_area: float,
+    max_neighbours: int = 100,
+    neighbours: "NDArray[(Any, Any), int]" = None,
+) -> "Tuple[list, NDArray[(Any,), float]]":
+    """Finds the stations in each station's moving window. Each window
+    starts with sizes[i] nearest neighbours, by haversine distance, and
+    grows until the convex hull of the stations' rotated coordinates
+    reaches min_area. Neighbours are queried once for every station
+    and the smallest large enough window is binary searched in the
+    sorted neighbour list, since a hull can only grow as stations are
+    added. Windows still too small at max_neighbours are searched
+    again with twice as many neighbours.
+        Args:
+            df: pandas dataframe containing the coordinates in
+                both regular and rotated
+            sizes: initial number of neighbours in each window
+            min_area: hull size (scipy's ConvexHull.area) each
+                window must reach
+            max_neighbours: number of neighbours queried at first
+            neighbours: optional result of station_neighbours for
+                the same stations. Its columns are used instead of
+                querying while there are enough of them
+        Returns:
+            windows: list of the indices of the stations in each
+                window, nearest first
+            hull_areas: hull size of each window
+    """
+    from sklearn.neighbors import NearestNeighbors
+    from scipy.spatial import ConvexHull
+
+    check_df(df, ["lat", "lon", "rlat", "rlon"])
+
+    n_stations = df.shape[0]
+    if sizes.size != n_stations:
+        raise ValueError("Provide one window size per station")
+    if np.any(sizes > n_stations):
+        raise ValueError("Windows cannot contain more stations than provided")
+
+    X_distances = np.stack([np.deg2rad(df.lat.values), np.deg2rad(df.lon.values)]).T
+    points = df[["rlon", "rlat"]].values
+    nbrs = None
+
+    def query(todo, k):
+        nonlocal nbrs
+        if neighbours is not None and neighbours.shape[1] >= k:
+            return neighbours[todo, :k]
+        if nbrs is None:
+            nbrs = NearestNeighbors(metric="haversine").fit(X_distances)
+        return nbrs.kneighbors(X_distances[todo], n_neighbors=k)[1]
+
+    def hull_area(ind, k):
+        return ConvexHull(points=points[ind[:k]]).area
+
+    windows = [None] * n_stations
+    hull_areas = np.zeros(n_stations)
+
+    todo = np.arange(n_stations)
+    k_max = min(max(max_neighbours, sizes.max()), n_stations)
+    while todo.size > 0:
+        ind = query(todo, k_max)
+
+        remaining = []
+        for j, i in enumerate(todo):
+            k, area = sizes[i], hull_area(ind[j], sizes[i])
+            if area < min_area:
+                if k_max < n_stations and hull_area(ind[j], k_max) < min_area:
+                    remaining.append(i)
+                    continue
+
+                # smallest window in (k, k_max] that is large enough
+                lo, hi = k, k_max
+                while hi - lo > 1:
+                    mid = (lo + hi) // 2
+                    if hull_area(ind[j], mid) < min_area:
+                        lo = mid
+                    else:
+                        hi = mid
+                k, area = hi, hull_area(ind[j], hi)
+
+            windows[i], hull_areas[i] = ind[j, :k], area
+
+        todo = np.array(remaining, dtype=int)
+        k_max = min(2 * k_max, n_stations)
+
+    return windows, hull_areas
+
+
+def tile_labels(
+    points: "NDArray[(Any, 2), float]", n: int, method: str = "kmeans"
+) -> "NDArray[(Any,), int]":
+    """Partitions stations into tiles of roughly n stations each.
+    "kmeans" clusters the stations into ceil(N / n) groups and
+    "quadtree" splits the bounding box of the stations into quarters
+    until no quarter holds more than n stations, so that tiles are
+    small where stations are dense and large where they are sparse.
+        Args:
+            points: rotated lon and lat of each station
+            n: target number of stations in each tile
+            method: "kmeans" or "quadtree"
+        Returns:
+            labels: tile of each station, numbered from 0
+        Raises:
+            ValueError: if method is not kmeans or quadtree
+    """
+    if method not in ["kmeans", "quadtree"]:
+        raise ValueError("Tiling method must be kmeans or quadtree.")
+
+    n_stations = points.shape[0]
+
+    if method == "kmeans":
+        from sklearn.cluster import KMeans
+
+        k = int(np.ceil(n_stations / n))
+        return KMeans(n_clusters=k, n_init=10, random_state=0).fit_predict(points)
+
+    labels = np.zeros(n_stations, dtype=int)
+    n_tiles = 0
+    nodes = [np.arange(n_stations)]
+    while nodes:
+        ind = nodes.pop()
+        lo, hi = points[ind].min(axis=0), points[ind].max(axis=0)
+        if ind.size <= n or np.all(hi == lo):
+            labels[ind] = n_tiles
+            n_tiles += 1
+            continue
+
+        mid = (lo + hi) / 2
+        quarter = (points[ind, 0] > mid[0]) + 2 * (points[ind, 1] > mid[1])
+        nodes += [ind[quarter == q] for q in range(4) if np.any(quarter == q)]
+
+    return labels
+
+
+@profiled
+def find_tiles(
+    df: pd.DataFrame,
+    sizes: "NDArray[(Any,), int]",
+    min_area: float,
+    method: str = "kmeans",
+    buffer: float = 0.5,
+) -> "Tuple[list, list, NDArray[(Any,), float]]":
+    """Finds the stations in each tile's window. Each window contains
+    the stations of its tile (the core) and a buffer ring of the
+    stations nearest to the core, so that neighbouring windows
+    overlap and can be blended. The ring extends buffer times the
+    radius of the core beyond it, and is then grown as in find_windows
+    until the window holds the largest of its core's sizes and its
+    convex hull reaches min_area.
+        Args:
+            df: pandas dataframe containing the coordinates in
+                both regular and rotated
+            sizes: initial window size of each station, from
+                initial_window_sizes
+            min_area: hull size (scipy's ConvexHull.area) each
+                window must reach
+            method: tiling method passed to tile_labels
+            buffer: width of the buffer ring as a fraction of the
+                core's radius
+        Returns:
+            windows: list of the indices of the stations in each
+                window, core first
+            cores: list of the indices of the stations in each tile
+            hull_areas: hull size of each window
+        Raises:
+            ValueError: if sizes does not match the stations, or
+                buffer is negative
+    """
+    from scipy.spatial import ConvexHull, cKDTree
+
+    check_df(df, ["lat", "lon", "rlat", "rlon"])
+
+    n_stations = df.shape[0]
+    if sizes.size != n_stations:
+        raise ValueError("Provide one window size per station")
+    if buffer < 0:
+        raise ValueError("Buffer must be positive.")
+
+    points = df[["rlon", "rlat"]].values
+    labels = tile_labels(points, int(np.median(sizes)), method)
+
+    def hull_area(ind, k):
+        return ConvexHull(points=points[ind[:k]]).area
+
+    windows, cores, hull_areas = [], [], []
+    for label in np.unique(labels):
+        core = np.flatnonzero(labels == label)
+
+        # every station ordered by its distance to the core
+        distance, _ = cKDTree(points[core]).query(points)
+        order = np.argsort(distance, kind="stable")
+
+        radius = np.max(
+            np.linalg.norm(points[core] - points[core].mean(axis=0), axis=1)
+        )
+        k = max(
+            np.searchsorted(distance[order], buffer * radius, side="right"),
+            min(sizes[core].max(), n_stations),
+        )
+
+        if hull_area(order, k) < min_area and k < n_stations:
+            lo, hi = k, n_stations
+            if hull_area(order, hi) >= min_area:
+                while hi - lo > 1:
+                    mid = (lo + hi) // 2
+                    if hull_area(order, mid) < min_area:
+                        lo = mid
+                    else:
+                        hi = mid
+            k = hi
+
+        windows.append(order[:k])
+        cores.append(core)
+        hull_areas.append(hull_area(order, k))
+
+    return windows, cores, np.array(hull_areas)
+
+
+def plan_windows(
+    df: pd.DataFrame,
+    n: int,
+    ds: xr.Dataset,
+    station_dv: str,
+    min_size: int = 30,
+    tiling: str = "station",
+    buffer: float = 0.5,
+    rules: list = None,
+    neighbours: "NDArray[(Any, Any), int]" = None,
+) -> dict:
+    """Chooses the stations of every moving window before any of them
+    is kriged, as in rkrig_r.
+        Args:
+            df, n, ds, station_dv, min_size, tiling, buffer, rules: as
+                in rkrig_r
+            neighbours: optional result of station_neighbours, passed
+                to find_windows
+        Returns:
+            plan: dict of "windows" (indices of the stations in each
+                window), "cores" (indices of the stations each window
+                is centred on), "centres" (rotated coordinates of
+                each window's centre), "stations" (index of the
+                station each window is reported under), "hull_areas"
+                and "enlargements" (stations added to reach min_size)
+        Raises:
+            ValueError: if tiling is not station, kmeans or quadtree
+    """
+    if tiling not in ["station", "kmeans", "quadtree"]:
+        raise ValueError("Tiling must be station, kmeans or quadtree.")
+
+    dx = (np.amax(ds.rlon.values) - np.amin(ds.rlon.values)) / ds.rlon.size
+    dy = (np.amax(ds.rlat.values) - np.amin(ds.rlat.values)) / ds.rlat.size
+    dA = dx * dy
+
+    xy = df[["rlon", "rlat"]].values
+
+    sizes = initial_window_sizes(df, n, station_dv, rules)
+    if tiling == "station":
+        windows, hull_areas = find_windows(
+            df, sizes, dA * min_size ** 2, neighbours=neighbours
+        )
+        cores = [np.array([i]) for i in range(df.shape[0])]
+        centres = xy
+        stations = np.arange(df.shape[0])
+    else:
+        windows, cores, hull_areas = find_tiles(
+            df, sizes, dA * min_size ** 2, tiling, buffer
+        )
+        centres = np.array([xy[core].mean(axis=0) for core in cores])
+        stations = np.array(
+            [
+                core[np.argmin(np.linalg.norm(xy[core] - c, axis=1))]
+                for core, c in zip(cores, centres)
+            ]
+        )
+        sizes = np.array([sizes[core].max() for core in cores])
+
+    enlargements = np.maximum(np.array([ind.size for ind in windows]) - sizes, 0)
+
+    return {
+        "windows": windows,
+        "cores": cores,
+        "centres": centres,
+        "stations": stations,
+        "hull_areas": hull_areas,
+        "enlargements": enlargements,
+    }
+
+
+def window_bbox(
+    ds: xr.Dataset, xy: "NDArray[(Any, 2), float]"
+) -> "Tuple[int, int, int, int]":
+    """Row and column bounds (lw, u, l, r) of the grid cells that a
+    window of stations is kriged on, the grid[lw:u, l:r] slice
+    spanned by the stations.
+        Args:
+            ds: model xarray dataset
+            xy: rotated lon and lat of the window's stations
+        Returns:
+            lw, u, l, r: bounds of the window in the grid
+    """
+    xmin, xmax = xy[:, 0].min(), xy[:, 0].max()
+    ymin, ymax = xy[:, 1].min(), xy[:, 1].max()
+
+    lw, u = (
+        find_nearest_index(ds.rlat.values, ymin),
+        find_nearest_index(ds.rlat.values, ymax),
     )
-    z, ss = ok.execute(
-        "grid", ds.rlon.values, ds.rlat.values, backend="C", n_closest_points=n
+    l, r = (
+        find_nearest_index(ds.rlon.values, xmin),
+        find_nearest_index(ds.rlon.values, xmax),
     )
 
-    return z
+    return lw, u, l, r
 
 
 def krig_at_field(
-    ds: xr.Dataset, temp_xyr: NDArray[(Any, 4), float]
-) -> NDArray[(Any, Any), float]:
+    ds: xr.Dataset,
+    temp_xyr: "NDArray[(Any, 4), float]",
+    return_info: bool = False,
+    return_variance: bool = False,
+) -> "NDArray[(Any, Any), float]":
     """Matches the output of spytialProcess to the dataset provided
     and returns a 2D array of the krigged field with same dimensions
     as the dataset's design value field. This produces individual
@@ -158,44 +655,195 @@ def krig_at_field(
             temp_xyr: subset of station ratios
                 from which the kriging is calculated. This array
                 must contain [longitudes, latitudes, ratios]
+            return_info: whether to also return the size of the
+                window and the time R spent on it
+            return_variance: whether to also return the prediction
+                variance of the window
         Returns:
             kriged subset field
+            variance: prediction variance field with the same
+                dimensions, if return_variance
+            info: dict of the window's "bbox" (row and column
+                bounds), "bbox_cells", "fit_s" and "predict_s",
+                and "se_s" if return_variance, if return_info
     """
 
-    xmin, xmax = temp_xyr[:, 0].min(), temp_xyr[:, 0].max()
-    ymin, ymax = temp_xyr[:, 1].min(), temp_xyr[:, 1].max()
-
     latlon = temp_xyr[:, :2].T
 
     stats = temp_xyr[:, 2]
 
-    lw, u = (
-        find_nearest_index(ds.rlat.values, ymin),
-        find_nearest_index(ds.rlat.values, ymax),
-    )
-    l, r = (
-        find_nearest_index(ds.rlon.values, xmin),
-        find_nearest_index(ds.rlon.values, xmax),
-    )
+    lw, u, l, r = window_bbox(ds, temp_xyr[:, :2])
 
     ylim = u - lw
     xlim = r - l
 
-    z, x, y = sp.fit(latlon, stats, xlim, ylim, extrap=False)
+    z, x, y, *variance, timings = sp.fit(
+        latlon,
+        stats,
+        xlim,
+        ylim,
+        extrap=False,
+        return_timings=True,
+        return_variance=return_variance,
+    )
 
     final = np.ones((ds.rlat.size, ds.rlon.size), dtype=np.float16)
     final[:, :] = np.nan
     final[lw:u, l:r] = z.T
 
-    return final
+    result = (final,)
+    if return_variance:
+        # float32 so that small variances do not underflow
+        variance_field = np.full(final.shape, np.nan, dtype=np.float32)
+        variance_field[lw:u, l:r] = variance[0].T
+        result += (variance_field,)
+
+    if return_info:
+        info = dict(bbox=(lw, u, l, r), bbox_cells=xlim * ylim, **timings)
+        result += (info,)
+
+    return result if len(result) > 1 else final
+
+
+def krig_batch(
+    ds: xr.Dataset,
+    xyrs: list,
+    return_variance: bool = False,
+    cores: int = 1,
+) -> list:
+    """Krigs several windows in one call to R with sp.fit_batch. Unlike
+    krig_at_field, only the values in each window's bounding box are
+    returned, which accumulate_window accepts as well.
+        Args:
+            ds: model xarray dataset
+            xyrs: list of each window's [longitudes, latitudes, ratios]
+            return_variance: whether to also return the prediction
+                variance of each window
+            cores: number of processes R krigs the windows with
+        Returns:
+            list of one dict per window with its "field" within "bbox"
+            (as float16, like krig_at_field), "variance" if
+            return_variance, "info" as from krig_at_field and "error",
+            R's error message if kriging the window failed or None
+    """
+    bboxes = [window_bbox(ds, xyr[:, :2]) for xyr in xyrs]
+    nx = np.array([r - l for lw, u, l, r in bboxes], dtype=int)
+    ny = np.array([u - lw for lw, u, l, r in bboxes], dtype=int)
+    offsets = np.concatenate([[0], np.cumsum([xyr.shape[0] for xyr in xyrs])])
+
+    z, surface_offsets, *variance, errors, timings = sp.fit_batch(
+        np.concatenate([xyr[:, :3] for xyr in xyrs]).astype(float),
+        offsets,
+        nx,
+        ny,
+        extrap=False,
+        return_variance=return_variance,
+        cores=cores,
+    )
+
+    results = []
+    for j, bbox in enumerate(bboxes):
+        if errors[j] is not None:
+            results.append({"error": errors[j]})
+            continue
+
+        field = sp.batch_surface(z, surface_offsets, nx, ny, j)
+        result = {
+            "field": field.T.astype(np.float16),
+            "info": dict(
+                bbox=bbox,
+                bbox_cells=int(nx[j] * ny[j]),
+                **{key: value[j] for key, value in timings.items()},
+            ),
+            "error": None,
+        }
+        if return_variance:
+            # float32 so that small variances do not underflow
+            values = sp.batch_surface(variance[0], surface_offsets, nx, ny, j)
+            result["variance"] = values.T.astype(np.float32)
+        results.append(result)
+
+    return results
+
+
+def taper_weights(
+    rlon: "NDArray[(Any,), float]",
+    rlat: "NDArray[(Any,), float]",
+    centre: "NDArray[(2,), float]",
+    floor: float = 1e-3,
+) -> "NDArray[(Any, Any), float]":
+    """Weights of the grid cells in a window that fall from 1 at the
+    window's centre station to floor at the window's edges with a
+    cos^2 taper. Distances are scaled separately on each side of the
+    station so that every edge is reached, even when the station is
+    not in the middle of its window.
+        Args:
+            rlon, rlat: rotated coordinates of the window's grid
+                cells
+            centre: rotated lon and lat of the centre station
+            floor: smallest weight, so that cells only covered by
+                window edges still get a value
+        Returns:
+            weights with shape (rlat.size, rlon.size)
+    """
+
+    def scaled(axis, c):
+        d = axis - c
+        scale = np.where(d < 0, c - axis.min(), axis.max() - c)
+        return np.divide(d, scale, out=np.zeros(d.shape), where=scale > 0)
 
+    x, y = scaled(rlon, centre[0]), scaled(rlat, centre[1])
+    r = np.minimum(np.sqrt(x[np.newaxis, :] ** 2 + y[:, np.newaxis] ** 2), 1.0)
 
+    return np.maximum(np.cos(0.5 * np.pi * r) ** 2, floor)
+
+
+def accumulate_window(
+    total: "NDArray[(Any, Any), float]",
+    weights: "NDArray[(Any, Any), float]",
+    field: "NDArray[(Any, Any), float]",
+    bbox: tuple,
+    weight: "NDArray[(Any, Any), float]" = None,
+) -> None:
+    """Adds a kriged window to running weighted sums in place. Only
+    the window's bounding box is touched.
+        Args:
+            total, weights: running sums of weighted values and of
+                weights over the full grid. Cells where field is NaN
+                add to neither
+            field: kriged window from krig_at_field, or only its
+                values in bbox as from krig_batch
+            bbox: row and column bounds (lw, u, l, r) of the window
+            weight: weights of the cells in bbox, e.g. from
+                taper_weights. Every cell has weight 1 if None
+    """
+    lw, u, l, r = bbox
+    if field.shape != (u - lw, r - l):
+        field = field[lw:u, l:r]
+    values = field.astype(float)
+    if weight is None:
+        weight = np.ones(values.shape)
+
+    valid = ~np.isnan(values)
+    total[lw:u, l:r][valid] += (weight * values)[valid]
+    weights[lw:u, l:r][valid] += weight[valid]
+
+
+@profiled
 def rkrig_r(
     df: pd.DataFrame,
     n: int,
     ds: xr.Dataset,
     station_dv: str,
     min_size: int = 30,
+    return_windows: bool = False,
+    blend: str = "mean",
+    tiling: str = "station",
+    buffer: float = 0.5,
+    return_variance: bool = False,
+    rules: list = None,
+    batch_size: int = 1,
+    r_cores: int = 1,
 ):
     """Implements climpyricals moving window method.
     Args:
@@ -210,76 +858,341 @@ def rkrig_r(
             used to calculate an equivalent minimum area
             that is compared to the polygon produced by
             the perimeter of stations in a nearest neighbor set
+        return_windows: whether to also return a record of each
+            window
+        blend: how overlapping windows are combined. "mean" averages
+            every window covering a cell, "taper" weights each window
+            by taper_weights so that windows fade out towards their
+            edges instead of leaving seams
+        tiling: "station" krigs one window around every station.
+            "kmeans" and "quadtree" partition the stations into tiles
+            of about n stations with tile_labels and krig one window
+            per tile, its stations plus a buffer ring, so the number
+            of windows follows the area and density of the stations
+            rather than their number
+        buffer: width of each tile's buffer ring as a fraction of the
+            tile's radius, see find_tiles
+        return_variance: whether to also return the prediction
+            variance. The variances of overlapping windows are
+            averaged with the same weights as the field, leaving out
+            windows whose variance is NaN, which bounds the variance
+            of the blended field from above since the windows share
+            stations
+        rules: initial window sizes that differ from n, see
+            initial_window_sizes. Defaults to WINDOW_RULES
+        batch_size: number of windows kriged in each call to R with
+            krig_batch. Each window is kriged on its own with
+            krig_at_field if 1. Batches are meant to give the same field
+            while saving the conversion overhead of many small windows.
+            Experimental: values above 1 have not yet been checked
+            against R, keep the default for production runs
+        r_cores: number of processes R krigs each batch with
     Returns:
         kriged field
+        variance: prediction variance field, if return_variance
+        windows: pandas.DataFrame with one row per window, if
+            return_windows. Columns are the index, lat and lon of the
+            window's station (for tiles, the station nearest the
+            tile's centre), final number of neighbours, number of
+            stations in the tile, hull enlargements, hull area,
+            window size in cells, R fit and predict time, total time
+            (the batch's time shared between its windows if batched),
+            and whether the window succeeded, with the error if not
     """
 
+    from rpy2.rinterface_lib.embedded import RRuntimeError
+    from tqdm import tqdm
+
     dataframe_keys = ["lat", "lon", "rlat", "rlon", "ratio"]
     check_df(df, dataframe_keys)
 
-    X_distances = np.stack(
-        [np.deg2rad(df.lat.values), np.deg2rad(df.lon.values)]
-    )
-    dx = (np.amax(ds.rlon.values) - np.amin(ds.rlon.values)) / ds.rlon.size
-    dy = (np.amax(ds.rlat.values) - np.amin(ds.rlat.values)) / ds.rlat.size
-    dA = dx * dy
+    if blend not in ["mean", "taper"]:
+        raise ValueError("Blend must be mean or taper.")
 
     xyr = df[["rlon", "rlat", "ratio"]].values
 
-    # used to calculate average at end
-    field = np.zeros((ds.rlat.size, ds.rlon.size))
-    field[:, :] = np.nan
-
-    # tracks the number of summations in each grid cell
-    nancount = np.zeros(field.shape)
-
-    with tqdm(total=len(df.ratio), position=0, leave=True) as pbar:
-        for i in range(df.ratio.size):
-            nn = n
-            pbar.update()
-            if station_dv == "RL50 (kPa)" and df.iloc[i].lat >= 60.0:
-                nn = 40
-
-            if "province" in df.columns:
-                WPcond = (
-                    (station_dv == "WP10" or station_dv == "WP50")
-                    and (
-                        (df.iloc[i].province == "QC")
-                        or (df.iloc[i].province == "NL")
-                        or (df.iloc[i].province == "NU")
-                    )
-                    and (df.iloc[i].lat >= 52.0)
-                )
-                if WPcond:
-                    nn = 10
-
-            nbrs = NearestNeighbors(n_neighbors=nn, metric="haversine").fit(
-                X_distances.T
+    # choose every window before kriging any of them
+    plan = plan_windows(df, n, ds, station_dv, min_size, tiling, buffer, rules)
+    window_ind, stations = plan["windows"], plan["stations"]
+    enlargements = plan["enlargements"]
+    if np.any(enlargements):
+        warnings.warn(f"Adding stations to {np.count_nonzero(enlargements)} windows!")
+        count("hull_enlargements", int(enlargements.sum()))
+
+    # weighted sums of the windows and of their weights in each grid
+    # cell, used to calculate the (weighted) average at the end
+    total = np.zeros((ds.rlat.size, ds.rlon.size))
+    weights = np.zeros(total.shape)
+    if return_variance:
+        # summed apart from the field's weights, as a window's variance
+        # may be NaN where its field is not
+        total_variance = np.zeros(total.shape)
+        variance_weights = np.zeros(total.shape)
+
+    windows = []
+    failed = 0
+
+    def record(i):
+        return {
+            "station": stations[i],
+            "lat": df.lat.values[stations[i]],
+            "lon": df.lon.values[stations[i]],
+            "n_neighbours": window_ind[i].size,
+            "n_core": plan["cores"][i].size,
+            "hull_enlargements": enlargements[i],
+            "hull_area": plan["hull_areas"][i],
+        }
+
+    def accumulate(i, field, variance, bbox):
+        weight = None
+        if blend == "taper":
+            lw, u, l, r = bbox
+            weight = taper_weights(
+                ds.rlon.values[l:r], ds.rlat.values[lw:u], plan["centres"][i]
             )
-            dist, ind = nbrs.kneighbors(X_distances.T)
-            temp_xyr = xyr[ind[i], :]
-
-            latlon = temp_xyr[:, :2]
-
-            hull = ConvexHull(points=latlon)
-            while hull.area < dA * min_size ** 2:
-                warnings.warn("Adding stations to window!")
-                nn += 1
-                nbrs = NearestNeighbors(
-                    n_neighbors=nn, metric="haversine"
-                ).fit(X_distances.T)
-                dist, ind = nbrs.kneighbors(X_distances.T)
-
-                temp_xyr = xyr[ind[i], :]
-                latlon = temp_xyr[:, :2]
-                hull = ConvexHull(points=latlon)
-            try:
-                this_field = krig_at_field(ds, temp_xyr)
-                field = np.nansum([field, this_field], axis=0)
-                nancount[~np.isnan(this_field)] += 1
-
-            except rpy2.rinterface_lib.embedded.RRuntimeError:
-                continue
-
-        # taking this fraction computes the mean
-        return field / nancount
+        if return_variance:
+            accumulate_window(total_variance, variance_weights, variance, bbox, weight)
+        accumulate_window(total, weights, field, bbox, weight)
+
+    def fail(i, window, error, pbar):
+        nonlocal failed
+        count("r_errors_skipped")
+        warnings.warn(f"Kriging the window of station {stations[i]} failed: {error}")
+        window.update(success=False, error=str(error).strip())
+        failed += 1
+        pbar.set_postfix(failed=failed, refresh=False)
+
+    with tqdm(total=len(window_ind), position=0, leave=True) as pbar:
+        if batch_size <= 1:
+            for i in range(len(window_ind)):
+                start = time.perf_counter()
+                window = record(i)
+                with stage("window", window=i):
+                    pbar.update()
+                    temp_xyr = xyr[window_ind[i], :]
+                    try:
+                        with stage("krig"):
+                            this_field, *this_variance, info = krig_at_field(
+                                ds,
+                                temp_xyr,
+                                return_info=True,
+                                return_variance=return_variance,
+                            )
+                        with stage("accumulate"):
+                            accumulate(
+                                i,
+                                this_field,
+                                this_variance[0] if return_variance else None,
+                                info["bbox"],
+                            )
+                        count("windows_kriged")
+                        window.update(info, success=True, error=None)
+
+                    except RRuntimeError as e:
+                        fail(i, window, e, pbar)
+
+                window["wall_s"] = time.perf_counter() - start
+                windows.append(window)
+
+        else:
+            # windows are kriged batch_size at a time, in one call to R each
+            for first in range(0, len(window_ind), batch_size):
+                start = time.perf_counter()
+                batch = range(first, min(first + batch_size, len(window_ind)))
+                batch_windows = [record(i) for i in batch]
+                with stage("batch", windows=len(batch)):
+                    try:
+                        with stage("krig"):
+                            results = krig_batch(
+                                ds,
+                                [xyr[window_ind[i], :] for i in batch],
+                                return_variance=return_variance,
+                                cores=r_cores,
+                            )
+                    except RRuntimeError as e:
+                        # only errors outside of the windows' fits abort a batch
+                        results = [{"error": e}] * len(batch)
+
+                    with stage("accumulate"):
+                        for i, window, result in zip(batch, batch_windows, results):
+                            if result["error"] is not None:
+                                fail(i, window, result["error"], pbar)
+                                continue
+                            accumulate(
+                                i,
+                                result["field"],
+                                result.get("variance"),
+                                result["info"]["bbox"],
+                            )
+                            count("windows_kriged")
+                            window.update(result["info"], success=True, error=None)
+                    pbar.update(len(batch))
+
+                # R's time is per window, the wall time is shared by the batch
+                wall_s = (time.perf_counter() - start) / len(batch)
+                for window in batch_windows:
+                    window["wall_s"] = wall_s
+                windows.extend(batch_windows)
+
+    # taking this fraction computes the (weighted) mean, cells that no
+    # window covers are NaN
+    with np.errstate(invalid="ignore"):
+        field = total / weights
+        result = (field,)
+        if return_variance:
+            result += (total_variance / variance_weights,)
+
+    if return_windows:
+        result += (pd.DataFrame(windows, columns=WINDOW_COLUMNS),)
+    return result if len(result) > 1 else field
+
+
+def wendland(
+    d: "NDArray[(Any,), float]", theta: float, sill: float = 1.0
+) -> "NDArray[(Any,), float]":
+    """Wendland covariance (phi_{3,1}), which is exactly zero beyond
+    its range so that covariance matrices of many stations are
+    sparse.
+        Args:
+            d: distances
+            theta: range beyond which the covariance is zero
+            sill: covariance at zero distance
+        Returns:
+            covariance at each distance
+    """
+    h = np.minimum(d / theta, 1.0)
+    return sill * (1.0 - h) ** 4 * (4.0 * h + 1.0)
+
+
+@profiled
+def rkrig_sparse(
+    df: pd.DataFrame,
+    ds: xr.Dataset,
+    mask: "NDArray[(Any, Any), bool]" = None,
+    theta: float = None,
+    nugget: float = None,
+    k: int = 30,
+    chunk_size: int = 100000,
+    return_params: bool = False,
+):
+    """Kriges the ratio field from every station at once, as an
+    alternative to the moving windows of rkrig_r. The covariance is a
+    Wendland function of the distance in rotated coordinates with a
+    finite range, so the station covariance matrix is sparse and is
+    solved with a sparse LU decomposition, and each grid cell only
+    depends on the stations within range. A linear trend in rotated
+    coordinates is fitted by generalised least squares, as
+    spatialProcess does by default.
+
+    This is a fast approximation: theta, the sill and the nugget are
+    set by the heuristics below rather than fitted by maximum
+    likelihood as spatialProcess does, so the field only roughly
+    follows those of rkrig_r and rkrig_py. Pass theta and nugget to
+    use fitted values instead.
+
+    Cells with no station within range, like cells outside every
+    window of rkrig_r, are NaN.
+        Args:
+            df: pandas dataframe containing the rotated coordinates
+                and the ratio of each station
+            ds: model xarray dataset
+            mask: boolean mask of the cells to predict, every cell
+                if None
+            theta: range of the covariance. Defaults to the median
+                distance from a station to its k-th nearest station.
+                The sill is always the variance of the residuals of
+                an ordinary least squares trend
+            nugget: variance of station noise. Defaults to the
+                semivariance of nearest neighbouring stations,
+                bounded by half of the sill
+            k: number of neighbours used to choose theta
+            chunk_size: number of grid cells predicted at once,
+                limits memory use on fine grids
+            return_params: whether to also return the fitted
+                parameters
+        Returns:
+            kriged field
+            params: dict of theta, sill, nugget, beta (trend
+                coefficients) and nnz (stored covariances), if
+                return_params
+        Raises:
+            ValueError: if mask does not match the grid, or theta
+                or nugget are not positive
+    """
+    from scipy.sparse import coo_matrix, identity
+    from scipy.sparse.linalg import splu
+    from scipy.spatial import cKDTree
+
+    check_df(df, ["rlat", "rlon", "ratio"])
+
+    shape = (ds.rlat.size, ds.rlon.size)
+    if mask is None:
+        mask = np.ones(shape, dtype=bool)
+    if mask.shape != shape:
+        raise ValueError(f"Mask must have the shape of the grid {shape}")
+    if (theta is not None and theta <= 0) or (nugget is not None and nugget < 0):
+        raise ValueError("Theta must be positive and nugget non-negative.")
+
+    points = df[["rlon", "rlat"]].values
+    z = df.ratio.values.astype(float)
+    n_stations = z.size
+
+    def trend(xy):
+        return np.column_stack([np.ones(xy.shape[0]), xy])
+
+    tree = cKDTree(points)
+
+    with stage("fit"):
+        # ordinary least squares residuals to choose the parameters
+        F = trend(points)
+        residuals = z - F @ np.linalg.lstsq(F, z, rcond=None)[0]
+        sill = np.var(residuals)
+
+        distances, nearest = tree.query(points, k=min(k, n_stations - 1) + 1)
+        if theta is None:
+            theta = np.median(distances[:, -1])
+        if nugget is None:
+            nn_semivariance = 0.5 * np.mean((z - z[nearest[:, 1]]) ** 2)
+            nugget = np.clip(nn_semivariance, 1e-6 * sill, 0.5 * sill)
+
+        # covariance between stations within range of each other
+        D = tree.sparse_distance_matrix(tree, theta, output_type="coo_matrix")
+        off = D.row != D.col
+        K = coo_matrix(
+            (wendland(D.data[off], theta, sill), (D.row[off], D.col[off])),
+            shape=(n_stations, n_stations),
+        )
+        K = (K + (sill + nugget) * identity(n_stations)).tocsc()
+
+        lu = splu(K)
+        Ki_F, Ki_z = lu.solve(F), lu.solve(z)
+        beta = np.linalg.solve(F.T @ Ki_F, F.T @ Ki_z)
+        alpha = Ki_z - Ki_F @ beta
+
+    field = np.full(shape, np.nan)
+    rlon, rlat = np.meshgrid(ds.rlon.values, ds.rlat.values)
+    cells = np.flatnonzero(mask)
+
+    with stage("predict"):
+        for start in range(0, cells.size, chunk_size):
+            chunk = cells[start : start + chunk_size]
+            grid_points = np.column_stack([rlon.flat[chunk], rlat.flat[chunk]])
+
+            D = tree.sparse_distance_matrix(
+                cKDTree(grid_points), theta, output_type="coo_matrix"
+            )
+            k_star = coo_matrix(
+                (wendland(D.data, theta, sill), (D.row, D.col)),
+                shape=(n_stations, chunk.size),
+            ).tocsc()
+
+            covered = np.diff(k_star.indptr) > 0
+            values = trend(grid_points) @ beta + k_star.T @ alpha
+            field.flat[chunk[covered]] = values[covered]
+
+    count("stations_kriged", n_stations)
+
+    if return_params:
+        params = dict(theta=theta, sill=sill, nugget=nugget, beta=beta, nnz=K.nnz)
+        return field, params
+    return field
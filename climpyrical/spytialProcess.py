@@ -1,29 +1,57 @@
+from climpyrical.profiling import stage
 from collections import OrderedDict
 from pkg_resources import resource_string
 
 from nptyping import NDArray
 from typing import Any, Tuple
 import numpy as np
-from rpy2.robjects.packages import importr
-from rpy2.robjects import FloatVector, DataFrame
-from rpy2 import robjects
+import warnings
 
-import rpy2.robjects.packages as rpackages
+# R session state, populated on first use by _init_r
+_R = {}
 
 
-utils = rpackages.importr("utils")
-robjects.r(".libPaths(Sys.getenv('R_LIBS_USER'))")
-importr("fields")
+def _init_r():
+    """Starts R, loads fields and compiles the spatialProcess script the
+    first time it is called. Importing rpy2 starts an embedded R session,
+    so this is deferred until kriging is actually requested.
+    Returns:
+        robjects (module): rpy2.robjects
+        rfunc: compiled R function in spatial_process_r.R
+    """
+    if not _R:
+        with stage("r_init"):
+            from rpy2 import robjects
+            from rpy2.rinterface import RRuntimeWarning
+            import rpy2.robjects.packages as rpackages
+
+            warnings.filterwarnings("ignore", category=RRuntimeWarning)
+
+            rpackages.importr("utils")
+            robjects.r(".libPaths(Sys.getenv('R_LIBS_USER'))")
+            rpackages.importr("fields")
+
+            # use separate simple r-script in path below
+            rstring = resource_string(
+                "climpyrical", "tests/data/spatial_process_r.R"
+            ).decode("utf-8")
+
+            _R["robjects"] = robjects
+            _R["rfunc"] = robjects.r(rstring)
+
+    return _R["robjects"], _R["rfunc"]
 
 
 def fit(
-    latlon: NDArray[(2, Any), float],
-    z: NDArray[(Any,), float],
+    latlon: "NDArray[(2, Any), float]",
+    z: "NDArray[(Any,), float]",
     nx: int,
     ny: int,
     extrap: bool,
+    return_timings: bool = False,
+    return_variance: bool = False,
 ) -> Tuple[
-    NDArray[(Any, Any), float], NDArray[(Any,), float], NDArray[(Any,), float]
+    "NDArray[(Any, Any), float]", "NDArray[(Any,), float]", "NDArray[(Any,), float]"
 ]:
 
     """Encapsulates the functionality of R's spatialProcess into a Python
@@ -36,9 +64,18 @@ def fit(
         distance: distance metric to use (note, only 'geo' supported currently)
         variogram_model: choice of variogram model
           (note, only 'exoponential' supported)
+        return_timings: whether to also return the seconds R spent
+            fitting and predicting
+        return_variance: whether to also return the variance of the
+            prediction, from the standard errors of fields'
+            predictSurfaceSE on the same grid and fitted model
     Returns:
         z: kriged field
         x, y: locations of kriged data
+        variance: prediction variance with the shape of z, if
+            return_variance
+        timings: dict of "fit_s" and "predict_s", and "se_s" if
+            return_variance, if return_timings
 
     """
 
@@ -60,6 +97,9 @@ def fit(
             "Different number of grid coordinates than observations"
         )
 
+    robjects, rfunc = _init_r()
+    from rpy2.robjects import FloatVector, DataFrame
+
     latlon, z = latlon.tolist(), z.tolist()
 
     # convert regular numeric data
@@ -75,13 +115,8 @@ def fit(
     # convert observations
     r_z = FloatVector(z)
 
-    # use separate simple r-script in path below
-    rstring = resource_string(
-        "climpyrical", "tests/data/spatial_process_r.R"
-    ).decode("utf-8")
-
-    rfunc = robjects.r(rstring)
-    r_surface = rfunc(r_latlon, r_z, nx, ny, extrap)
+    with stage("r_fit", n_obs=len(z)):
+        r_surface = rfunc(r_latlon, r_z, nx, ny, extrap, return_variance)
 
     # extract data from R's interpolation
     surface_dict = dict(zip(r_surface.names, list(r_surface)))
@@ -92,4 +127,158 @@ def fit(
     # cov = dict(zip(surface_dict["cov"].names, list(surface_dict["cov"])))
     # cov = surface_dict["cov"]
 
-    return z, x, y
+    result = (z, x, y)
+    if return_variance:
+        se = np.array(surface_dict["se"]).reshape(nx, ny)
+        result += (se**2,)
+
+    if return_timings:
+        timings = {
+            "fit_s": surface_dict["fit_time"][0],
+            "predict_s": surface_dict["predict_time"][0],
+        }
+        if return_variance:
+            timings["se_s"] = surface_dict["se_time"][0]
+        result += (timings,)
+
+    return result
+
+
+def _init_r_batch():
+    """Compiles the batch script the first time it is called.
+    Returns:
+        robjects (module): rpy2.robjects
+        rbatch: compiled R function in spatial_process_batch_r.R
+    """
+    robjects, _ = _init_r()
+    if "rbatch" not in _R:
+        rstring = resource_string(
+            "climpyrical", "tests/data/spatial_process_batch_r.R"
+        ).decode("utf-8")
+        _R["rbatch"] = robjects.r(rstring)
+
+    return robjects, _R["rbatch"]
+
+
+def fit_batch(
+    points: "NDArray[(Any, 3), float]",
+    offsets: "NDArray[(Any,), int]",
+    nx: "NDArray[(Any,), int]",
+    ny: "NDArray[(Any,), int]",
+    extrap: bool,
+    return_variance: bool = False,
+    cores: int = 1,
+) -> Tuple:
+    """Fits and predicts several windows with spatialProcess in a single
+    call to R, so that the data is converted once for all of them
+    instead of once per window. Each window gives the same surface as
+    fit on its own observations.
+    Args:
+        points: lon, lat and observation of every window's stations,
+            window after window
+        offsets: start of each window's rows in points, followed by
+            the number of rows
+        nx, ny: number of grid cells of each window's grid in x and y
+        extrap: whether to extrapolate outside the stations' hull
+        return_variance: whether to also return the prediction
+            variance, see fit
+        cores: number of processes R forks with parallel::mclapply.
+            Windows are fitted in turn if 1
+    Returns:
+        z: every window's kriged field, flattened column by column (in
+            R's order) and packed one after the other. Window j is
+            batch_surface(z, surface_offsets, nx, ny, j)
+        surface_offsets: start of each window's field in z, followed
+            by the size of z
+        variance: prediction variance packed like z, if return_variance
+        errors: R's error message for each window, None if it succeeded.
+            The fields of failed windows are NaN
+        timings: dict of arrays of each window's "fit_s" and
+            "predict_s", and "se_s" if return_variance
+    """
+
+    if not isinstance(points, NDArray[(Any, 3), float]):
+        raise TypeError(
+            f"Incorrect grid shape, size, or dtype. Must be {NDArray[(Any, 3), float]}"
+        )
+
+    offsets, nx, ny = np.asarray(offsets), np.asarray(nx), np.asarray(ny)
+    for sizes in (offsets, nx, ny):
+        if sizes.ndim != 1 or not np.issubdtype(sizes.dtype, np.integer):
+            raise TypeError("Provide one dimensional integer offsets and grid sizes")
+
+    if nx.size != ny.size or offsets.size != nx.size + 1:
+        raise ValueError("Provide one grid size and one offset per window")
+
+    if (
+        offsets[0] != 0
+        or offsets[-1] != points.shape[0]
+        or np.any(np.diff(offsets) < 1)
+    ):
+        raise ValueError("Offsets must split the points into non empty windows")
+
+    robjects, rbatch = _init_r_batch()
+    from rpy2.robjects import FloatVector, IntVector
+
+    # a single column major matrix rather than one vector per column
+    r_points = robjects.r["matrix"](
+        FloatVector(points.ravel(order="F").tolist()), nrow=points.shape[0]
+    )
+
+    with stage("r_fit_batch", n_obs=points.shape[0], windows=nx.size):
+        r_surfaces = rbatch(
+            r_points,
+            IntVector(offsets.tolist()),
+            IntVector(nx.tolist()),
+            IntVector(ny.tolist()),
+            extrap,
+            return_variance,
+            cores,
+        )
+
+    surface_dict = dict(zip(r_surfaces.names, list(r_surfaces)))
+
+    return _unpack_batch(surface_dict, nx, ny, return_variance)
+
+
+def _unpack_batch(surface_dict, nx, ny, return_variance):
+    # converts the list returned by spatial_process_batch_r.R, as a
+    # dict of its elements, to the results of fit_batch
+    surface_offsets = np.concatenate([[0], np.cumsum(nx * ny)])
+    z = np.array(surface_dict["z"], dtype=float)
+
+    result = (z, surface_offsets)
+    if return_variance:
+        result += (np.array(surface_dict["se"], dtype=float) ** 2,)
+
+    timings = {
+        "fit_s": np.array(surface_dict["fit_time"], dtype=float),
+        "predict_s": np.array(surface_dict["predict_time"], dtype=float),
+    }
+    if return_variance:
+        timings["se_s"] = np.array(surface_dict["se_time"], dtype=float)
+
+    errors = [str(error) or None for error in surface_dict["error"]]
+    result += (errors, timings)
+
+    return result
+
+
+def batch_surface(
+    packed: "NDArray[(Any,), float]",
+    surface_offsets: "NDArray[(Any,), int]",
+    nx: "NDArray[(Any,), int]",
+    ny: "NDArray[(Any,), int]",
+    j: int,
+) -> "NDArray[(Any, Any), float]":
+    """Window j's field in the packed output of fit_batch.
+    Args:
+        packed: z or variance from fit_batch
+        surface_offsets, nx, ny: as for fit_batch
+        j: index of the window
+    Returns:
+        field with shape (nx[j], ny[j]), oriented like the z of fit
+    """
+    # R flattens each nx by ny matrix column by column
+    values = packed[surface_offsets[j] : surface_offsets[j + 1]]
+    return values.reshape((nx[j], ny[j]), order="F")
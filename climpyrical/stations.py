@@ -0,0 +1,233 @@
+"""
+Reading station and location tables.
+usage:
+    from climpyrical.stations import read_stations
+    df = read_stations("stations.csv", ["RL50 (kPa)"])
+
+Station files name the same columns in different ways, e.g. longitude,
+long or Lon. read_stations maps them to one set of names with
+COLUMN_ALIASES, reads only the columns needed with explicit dtypes,
+and caches the parsed table as a Feather file so that repeat runs skip
+parsing the CSV or Excel file. The cache is used while it is newer
+than its input and is skipped if pyarrow is not installed.
+"""
+
+from climpyrical.profiling import profiled, count
+
+import hashlib
+import json
+import logging
+import os
+import warnings
+
+import pandas as pd
+
+# alternative column names found in station files and their standard name
+COLUMN_ALIASES = {
+    "longitude": "lon",
+    "long": "lon",
+    "Lon": "lon",
+    "latitude": "lat",
+    "Lat": "lat",
+    "name": "station_name",
+    "Name": "station_name",
+    "prov": "province",
+    "elev": "elev (m)",
+    "elevation (m)": "elev (m)",
+}
+
+# dtype of each standard column. Design value columns are float64
+COLUMN_DTYPES = {
+    "lat": "float64",
+    "lon": "float64",
+    "rlat": "float64",
+    "rlon": "float64",
+    "irlat": "int64",
+    "irlon": "int64",
+    "elev (m)": "float32",
+    "station_name": "object",
+    "province": "object",
+    "model_values": "float64",
+    "ratio": "float64",
+}
+
+# standard columns read from a station file along with its design values
+STATION_COLUMNS = ["lat", "lon", "rlat", "rlon", "elev (m)", "station_name", "province"]
+
+EXCEL_EXTENSIONS = [".xls", ".xlsx", ".xlsm"]
+
+# directory of the cached tables, next to each input
+CACHE_DIR = ".climpyrical_cache"
+
+
+def normalise_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Renames the columns of a station table to their standard names
+    with COLUMN_ALIASES.
+    Args:
+        df (pandas.DataFrame): station table
+    Returns:
+        df (pandas.DataFrame): station table with standard column names
+    """
+    return df.rename(columns=COLUMN_ALIASES)
+
+
+def cache_path(path: str, options: dict, cache_dir: str = None) -> str:
+    """Path of the cached table of path read with options.
+    Args:
+        path (str): input CSV or Excel file
+        options (dict): JSON serialisable arguments the table is read
+            with, so that each way of reading a file is cached apart
+        cache_dir (str, optional): directory of the cache. Defaults to
+            CACHE_DIR next to path
+    Returns:
+        path of the .feather file
+    """
+    path = os.path.abspath(path)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(path), CACHE_DIR)
+
+    key = json.dumps([path, options], sort_keys=True, default=str)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+
+    return os.path.join(cache_dir, f"{os.path.basename(path)}.{digest}.feather")
+
+
+def _has_pyarrow() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+@profiled
+def read_table(
+    path: str,
+    usecols=None,
+    dtype: dict = None,
+    cache: bool = True,
+    cache_dir: str = None,
+    **kwargs,
+) -> pd.DataFrame:
+    """Reads a CSV or Excel file, or its cached Feather copy.
+    Args:
+        path (str): .csv, .xls, .xlsx or .xlsm file
+        usecols (list, optional): columns to read. Every column if None
+        dtype (dict, optional): dtype of columns, applied after reading
+            Excel files
+        cache (bool): whether to read and write the Feather cache
+        cache_dir (str, optional): directory of the cache, see
+            cache_path
+        kwargs: passed to pandas.read_csv or pandas.read_excel
+    Returns:
+        df (pandas.DataFrame): table with a default index
+    Raises:
+        ValueError: if path is not a CSV or Excel file
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension != ".csv" and extension not in EXCEL_EXTENSIONS:
+        raise ValueError(f"Tables must be .csv or one of {EXCEL_EXTENSIONS}")
+
+    if cache and not _has_pyarrow():
+        logging.info("pyarrow is not installed, tables are not cached")
+        cache = False
+
+    if cache:
+        options = dict(usecols=usecols, dtype=dtype, **kwargs)
+        feather_path = cache_path(path, options, cache_dir)
+        if os.path.exists(feather_path) and os.path.getmtime(
+            feather_path
+        ) >= os.path.getmtime(path):
+            count("table_cache_hits")
+            return pd.read_feather(feather_path)
+
+    if extension == ".csv":
+        df = pd.read_csv(path, usecols=usecols, dtype=dtype, **kwargs)
+    else:
+        df = pd.read_excel(path, usecols=usecols, **kwargs)
+        if dtype is not None:
+            df = df.astype({key: value for key, value in dtype.items() if key in df})
+    df = df.reset_index(drop=True)
+
+    if cache:
+        # written under a temporary name so that processes reading the
+        # same file never see a partial cache
+        temporary = f"{feather_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(feather_path), exist_ok=True)
+            df.to_feather(temporary)
+            os.replace(temporary, feather_path)
+        except (OSError, ValueError, TypeError) as e:
+            warnings.warn(f"Could not cache {path}: {e}")
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    return df
+
+
+def station_columns(columns: list, station_dvs: list = None) -> list:
+    """Columns of a station file to read: the raw names of
+    STATION_COLUMNS and of the design values.
+    Args:
+        columns (list): column names in the file
+        station_dvs (list, optional): design value columns. Every
+            column is read if None
+    Returns:
+        usecols (list): raw names of the columns to read, in file order
+    Raises:
+        KeyError: if a design value is not in the file
+    """
+    standard = [COLUMN_ALIASES.get(column, column) for column in columns]
+    if station_dvs is None:
+        return list(columns)
+
+    missing = set(station_dvs) - set(standard)
+    if missing:
+        raise KeyError(f"Station file does not contain {sorted(missing)}")
+
+    wanted = set(STATION_COLUMNS) | set(station_dvs)
+    return [raw for raw, name in zip(columns, standard) if name in wanted]
+
+
+@profiled
+def read_stations(
+    path: str,
+    station_dvs: list = None,
+    cache: bool = True,
+    cache_dir: str = None,
+) -> pd.DataFrame:
+    """Reads a station file with standard column names and dtypes.
+    Args:
+        path (str): .csv or Excel station file
+        station_dvs (list, optional): design value columns to read
+            along with STATION_COLUMNS present in the file. Every
+            column is read if None
+        cache (bool): whether to cache the parsed table, see read_table
+        cache_dir (str, optional): directory of the cache
+    Returns:
+        df (pandas.DataFrame): station table with standard column names,
+            COLUMN_DTYPES and float64 design values
+    Raises:
+        KeyError: if a design value is not in the file
+    """
+
+    def dtypes(usecols):
+        dtypes = dict(COLUMN_DTYPES, **{dv: "float64" for dv in station_dvs or []})
+        names = [COLUMN_ALIASES.get(raw, raw) for raw in usecols]
+        return {
+            raw: dtypes[name] for raw, name in zip(usecols, names) if name in dtypes
+        }
+
+    if os.path.splitext(path)[1].lower() == ".csv":
+        usecols = station_columns(list(pd.read_csv(path, nrows=0).columns), station_dvs)
+        df = read_table(
+            path, usecols, dtypes(usecols), cache=cache, cache_dir=cache_dir
+        )
+    else:
+        # the whole sheet is parsed to find its header, so Excel files
+        # are read in full and the columns selected afterwards
+        df = read_table(path, cache=cache, cache_dir=cache_dir)
+        usecols = station_columns(list(df.columns), station_dvs)
+        df = df[usecols].astype(dtypes(usecols))
+
+    return normalise_columns(df)
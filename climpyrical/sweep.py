@@ -0,0 +1,272 @@
+"""
+quick usage of climpyrical sweep.py
+usage:
+python -m climpyrical.sweep -c config.yml -d RL50 -k 10 -n 4 -r ranking.csv
+
+Sweeps the settings of the moving window reconstruction (MWOrK) over
+the grid in the sweep key of each design value in the pipeline
+config, e.g.
+    RL50:
+        ...
+        sweep:
+            n: [20, 30, 40]
+            min_size: [20, 30]
+            blend: [mean, taper]
+
+Every combination is cross-validated on the same folds with
+cross_validate, across a multiprocessing pool, and then reconstructed
+once in full to time it. The reconstructions run one at a time after
+the folds so that their times are not skewed by other jobs. The
+settings are then ranked by cross-validated error and runtime. The
+window_rules of the design value, if any, apply to every setting.
+"""
+
+from climpyrical.crossval import (
+    _CV,
+    _cv_fold,
+    check_settings,
+    collect_folds,
+    error_table,
+    fold_jobs,
+    run_folds,
+    setting_label,
+)
+from climpyrical.gridding import scale_model_obs
+from climpyrical.profiling import profiled
+
+from itertools import product
+import click
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def expand_grid(grid: dict) -> list:
+    """Every combination of the values in a grid of settings.
+    Args:
+        grid (dict): list of values, or a single value, of each
+            parameter of rkrig_r
+    Returns:
+        settings (list of dict): one setting per combination, with the
+            last parameter varying fastest
+    """
+    values = [value if isinstance(value, list) else [value] for value in grid.values()]
+    return [dict(zip(grid, combination)) for combination in product(*values)]
+
+
+def _time_setting(params):
+    """Reconstructs the ratio field from every station with the
+    setting params and returns its runtime"""
+    from climpyrical.pipeline import is_temperature, KELVIN
+    from climpyrical.rkrig import rkrig_r
+
+    df, ds, station_dv = _CV["df"], _CV["ds"], _CV["station_dv"]
+
+    offset = KELVIN if is_temperature(ds, station_dv) else 0.0
+    ratio, _ = scale_model_obs(
+        df.model_values.values + offset, df[station_dv].values + offset
+    )
+    n = params.get("n", 30)
+    others = {key: value for key, value in params.items() if key != "n"}
+
+    start = time.perf_counter()
+    _, windows = rkrig_r(
+        df.assign(ratio=ratio),
+        n,
+        ds,
+        station_dv,
+        return_windows=True,
+        rules=_CV["rules"],
+        **others,
+    )
+
+    return {
+        "setting": setting_label(params),
+        "reconstruct_s": time.perf_counter() - start,
+        "windows": windows.shape[0],
+        "failed_windows": int((~windows.success).sum()),
+    }
+
+
+def rank_settings(
+    df_errors: pd.DataFrame, df_times: pd.DataFrame = None, by: str = "rmse"
+) -> pd.DataFrame:
+    """Ranks settings by cross-validated error, breaking ties by the
+    runtime of their reconstruction.
+    Args:
+        df_errors (pandas.DataFrame): table from error_table
+        df_times (pandas.DataFrame, optional): runtime of each setting,
+            with setting (and dv) and reconstruct_s columns
+        by (str): error_table column to rank by
+    Returns:
+        df_rank (pandas.DataFrame): df_errors joined with df_times,
+            sorted by design value and rank, with a rank column
+            starting from 1 for each design value
+    Raises:
+        KeyError: if by is not a column of df_errors
+    """
+    if by not in df_errors.columns:
+        raise KeyError(f"Cannot rank by {by}, not in {list(df_errors.columns)}")
+
+    keys = [key for key in ["dv", "setting"] if key in df_errors.columns]
+    sort_by = [by]
+    df_rank = df_errors
+    if df_times is not None:
+        df_rank = df_rank.merge(df_times, on=keys, how="left")
+        sort_by.append("reconstruct_s")
+
+    groups = keys[:-1]
+    df_rank = df_rank.sort_values(groups + sort_by, kind="stable")
+    rank = df_rank.groupby(groups).cumcount() if groups else np.arange(df_rank.shape[0])
+    df_rank.insert(len(keys), "rank", np.asarray(rank) + 1)
+
+    return df_rank.reset_index(drop=True)
+
+
+@profiled
+def sweep(
+    df: pd.DataFrame,
+    ds,
+    station_dv: str,
+    grid: dict,
+    k: int = 10,
+    n_jobs: int = 1,
+    seed: int = 0,
+    timing: bool = True,
+    name: str = None,
+    rules: list = None,
+    by: str = "rmse",
+):
+    """Cross-validates and times every setting in a grid of rkrig_r
+    parameters for one design value, and ranks them.
+    Args:
+        df (pandas.DataFrame): processed stations from
+            process_stations, with irlat, irlon and model_values
+        ds (xarray.Dataset): preprocessed model
+        station_dv (str): station design value column
+        grid (dict): values of n, min_size, blend, tiling and buffer
+            to combine, see expand_grid
+        k (int): number of folds, leave-one-out if None
+        n_jobs (int): number of worker processes
+        seed (int): random seed of the folds
+        timing (bool): whether to also reconstruct the field once per
+            setting to time it. Reconstructions run one at a time in
+            this process after the folds, whatever n_jobs
+        name (str, optional): design value name added as a "dv"
+            column
+        rules (list, optional): initial window sizes, see
+            initial_window_sizes
+        by (str): error_table column to rank by
+    Returns:
+        df_cv (pandas.DataFrame): table from cross_validate
+        df_rank (pandas.DataFrame): table from rank_settings followed
+            by the parameters of each setting
+    Raises:
+        ValueError: if a setting has a parameter not in SETTING_KEYS
+    """
+    settings = expand_grid(grid)
+    check_settings(settings)
+
+    initargs = (df, ds, station_dv, settings, rules)
+    results = run_folds(fold_jobs(df.shape[0], k, seed), _cv_fold, n_jobs, initargs)
+    df_cv = collect_folds(results, settings)
+
+    df_times = None
+    if timing:
+        # alone, so that the times of settings are comparable
+        df_times = pd.DataFrame(run_folds(settings, _time_setting, 1, initargs))
+
+    if name is not None:
+        df_cv.insert(0, "dv", name)
+        if df_times is not None:
+            df_times.insert(0, "dv", name)
+
+    df_params = pd.DataFrame(settings, index=[setting_label(p) for p in settings])
+    df_rank = rank_settings(error_table(df_cv), df_times, by)
+    df_rank = df_rank.join(df_params, on="setting")
+
+    return df_cv, df_rank
+
+
+@click.command()
+@click.option("-c", "--config-path", help="Pipeline YAML config", required=True)
+@click.option(
+    "-d",
+    "--dv",
+    "names",
+    help="Design value to sweep. May be repeated. Defaults to all with a sweep grid",
+    multiple=True,
+)
+@click.option("-k", "--folds", help="Number of folds, 0 for leave-one-out", default=10)
+@click.option("-n", "--n-jobs", help="Number of worker processes", default=1)
+@click.option(
+    "--timing/--no-timing",
+    help="Whether to time a full reconstruction of each setting",
+    default=True,
+)
+@click.option("-b", "--by", help="Error to rank settings by", default="rmse")
+@click.option("-o", "--output-path", help="Optional csv file of every prediction")
+@click.option("-r", "--ranking-path", help="Optional csv file of the ranking")
+@click.option(
+    "-l",
+    "--log-level",
+    help="Logging level",
+    type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]),
+    default="INFO",
+)
+def main(
+    config_path, names, folds, n_jobs, timing, by, output_path, ranking_path, log_level
+):
+    from climpyrical.pipeline import load_config, stage_io, DSOLD_MAX
+    from climpyrical.data import read_data
+
+    logging.basicConfig(level=log_level)
+    config = load_config(config_path)
+
+    names = names or [name for name in config["dvs"] if "sweep" in config["dvs"][name]]
+    if not names:
+        raise ValueError("No design value in the config has a sweep grid.")
+
+    tables, rankings = [], []
+    for name in names:
+        params = config["dvs"][name]
+        station_dv = params["station_dv"]
+        model_path, stations_path = stage_io("MWOrK", name, config)[0][:2]
+        ds = read_data(model_path)
+        df = pd.read_csv(stations_path)
+
+        # the moving windows only reconstruct the south
+        df = df[df.rlat <= DSOLD_MAX].reset_index(drop=True)
+        grid = params.get("sweep", {})
+        logging.info(
+            f"Sweeping {len(expand_grid(grid))} settings of {name} "
+            f"with {df.shape[0]} stations"
+        )
+        df_cv, df_rank = sweep(
+            df,
+            ds,
+            station_dv,
+            grid,
+            folds or None,
+            n_jobs,
+            timing=timing,
+            name=name,
+            rules=params.get("window_rules"),
+            by=by,
+        )
+        tables.append(df_cv)
+        rankings.append(df_rank)
+
+    df_rank = pd.concat(rankings, ignore_index=True)
+    click.echo(df_rank.round(4).to_string(index=False))
+
+    if output_path is not None:
+        pd.concat(tables, ignore_index=True).to_csv(output_path, index=False)
+    if ranking_path is not None:
+        df_rank.to_csv(ranking_path, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import pytest
+import pandas as pd
+import numpy as np
+
+from climpyrical.crossval import (
+    make_folds,
+    setting_label,
+    parse_setting,
+    error_table,
+    cross_validate,
+    CV_COLUMNS,
+)
+from climpyrical.data import gen_dataset
+from climpyrical.gridding import find_element_wise_nearest_pos
+from pkg_resources import resource_filename
+
+df_ = pd.read_csv(resource_filename("climpyrical", "tests/data/sl50_short.csv"))
+
+
+@pytest.mark.parametrize(
+    "n_stations, k, error",
+    [(10, 3, None), (10, None, None), (10, 20, None), (10, 1, ValueError)],
+)
+def test_make_folds(n_stations, k, error):
+    if error is None:
+        folds = make_folds(n_stations, k)
+        sizes = np.bincount(folds)
+        assert folds.size == n_stations
+        assert sizes.max() - sizes.min() <= 1
+        assert sizes.size == (n_stations if k is None else min(k, n_stations))
+        np.testing.assert_array_equal(folds, make_folds(n_stations, k))
+    else:
+        with pytest.raises(error):
+            make_folds(n_stations, k)
+
+
+@pytest.mark.parametrize(
+    "setting, params, label, error",
+    [
+        ("n=20,blend=taper", {"n": 20, "blend": "taper"}, "n=20,blend=taper", None),
+        ("buffer=0.25", {"buffer": 0.25}, "buffer=0.25", None),
+        ("", {}, "default", None),
+        ("n20", None, None, ValueError),
+    ],
+)
+def test_parse_setting(setting, params, label, error):
+    if error is None:
+        assert parse_setting(setting) == params
+        assert setting_label(params) == label
+    else:
+        with pytest.raises(error):
+            parse_setting(setting)
+
+
+def test_error_table():
+    df_cv = pd.DataFrame(
+        {
+            "dv": "RL50",
+            "setting": ["a", "a", "a", "b", "b", "b"],
+            "error": [1.0, -1.0, np.nan, 2.0, 2.0, -2.0],
+        }
+    )
+    df_errors = error_table(df_cv).set_index("setting")
+
+    assert df_errors.loc["a", "stations"] == 3
+    np.testing.assert_allclose(df_errors.loc["a", "coverage"], 2 / 3)
+    np.testing.assert_allclose(df_errors.loc["a", "bias"], 0)
+    np.testing.assert_allclose(df_errors.loc["b", "bias"], 2 / 3)
+    np.testing.assert_allclose(df_errors.loc["b", "mae"], 2)
+    np.testing.assert_allclose(df_errors.loc["b", "rmse"], 2)
+    np.testing.assert_allclose(df_errors.loc["b", "max_abs_error"], 2)
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("k, n_jobs", [(3, 1), (3, 2), (None, 1)])
+def test_cross_validate(k, n_jobs):
+    df = df_.iloc[::25].reset_index(drop=True)
+    rlon = np.linspace(df.rlon.min() - 1, df.rlon.max() + 1, 50)
+    rlat = np.linspace(df.rlat.min() - 1, df.rlat.max() + 1, 40)
+    lon, lat = np.meshgrid(rlon, rlat)
+    ds = gen_dataset("dv", np.ones(lon.shape), rlat, rlon, lat, lon)
+
+    irlon, irlat = find_element_wise_nearest_pos(
+        rlon, rlat, df.rlon.values, df.rlat.values
+    )
+    df = df.assign(irlat=irlat, irlon=irlon, model_values=1.0)
+
+    settings = [{"n": 5, "min_size": 2}, {"n": 5, "min_size": 2, "blend": "taper"}]
+    df_cv = cross_validate(
+        df, ds, "TJan2.5 (degC)", k, settings, n_jobs=n_jobs, name="TJan2.5"
+    )
+
+    assert list(df_cv.columns[1 : len(CV_COLUMNS) + 1]) == CV_COLUMNS
+    assert df_cv.shape[0] == len(settings) * df.shape[0]
+    for _, group in df_cv.groupby("setting"):
+        assert sorted(group.station) == list(range(df.shape[0]))
+    np.testing.assert_allclose(df_cv.error, df_cv.predicted - df_cv.observed)
+
+    df_errors = error_table(df_cv)
+    assert df_errors.shape[0] == len(settings)
+    assert (df_errors.stations == df.shape[0]).all()
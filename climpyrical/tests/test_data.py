@@ -1,9 +1,15 @@
 from climpyrical.data import (
     check_valid_keys,
     check_valid_data,
+    has_valid_values,
     read_data,
     interpolate_dataset,
     gen_dataset,
+    write_store,
+    read_store,
+    round_significant_digits,
+    write_netcdf,
+    ancillary_variables,
 )
 import pytest
 from pkg_resources import resource_filename
@@ -91,6 +97,56 @@ def test_valid_data(ds, error):
             check_valid_data(ds)
 
 
+@pytest.mark.parametrize(
+    "ds,error",
+    [
+        (empty_ds, ValueError),
+        (bad_coords, ValueError),
+        (non_mono_bad_coords, ValueError),
+        (nan_ds, ValueError),
+        (nan_ds.chunk({"rlat": 3, "rlon": 3}), ValueError),
+        (
+            xr.open_dataset(
+                resource_filename("climpyrical", "tests/data/hdd.nc"),
+                chunks={},
+            ),
+            None,
+        ),
+    ],
+)
+def test_valid_data_lazy(ds, error):
+    if error is None:
+        assert check_valid_data(ds, lazy=True)
+    else:
+        with pytest.raises(error):
+            check_valid_data(ds, lazy=True)
+
+
+partial_nan = np.ones((10, 10)) * np.nan
+partial_nan[-1, -1] = 1.0
+
+
+@pytest.mark.parametrize(
+    "da,expected",
+    [
+        (nan_ds["NaN"], False),
+        (nan_ds["NaN"].chunk({"rlat": 3}), False),
+        (xr.DataArray(partial_nan, dims=["rlat", "rlon"]), True),
+        (xr.DataArray(partial_nan, dims=["rlat", "rlon"]).chunk(3), True),
+        (xr.DataArray(np.arange(4), dims=["rlon"]), True),
+    ],
+)
+def test_has_valid_values(da, expected):
+    assert has_valid_values(da, rows=3) == expected
+
+
+def test_read_data_lazy():
+    path = resource_filename("climpyrical", "tests/data/example2.nc")
+    ds = read_data(path, lazy=True, chunks={"rlat": 50, "rlon": 50})
+    assert ds["snw"].chunks is not None
+    np.testing.assert_allclose(ds["snw"].values, read_data(path)["snw"].values)
+
+
 @pytest.mark.slow
 @pytest.mark.parametrize(
     "data_path,design_value_name,keys,expected",
@@ -203,3 +259,136 @@ def test_gen_dataset(dv, field, rlat, rlon, lat, lon):
     assert lon.shape == test_field.shape
     assert len(rlat) == test_field.shape[0]
     assert len(rlon) == test_field.shape[1]
+
+
+store_ds = gen_dataset(
+    "test",
+    np.arange(4.0).reshape(2, 2),
+    np.array([0.0, 1.0]),
+    np.array([0.0, 1.0]),
+    test_field,
+    test_field,
+    "mm",
+)
+
+
+@pytest.mark.parametrize(
+    "ds, fmt, name, error",
+    [
+        (store_ds, "npy", "store", None),
+        (store_ds, "zarr", "store.zarr", None),
+        (store_ds, "zarr", "store", ValueError),
+        (store_ds, "spaghetti", "store", ValueError),
+    ],
+)
+def test_store(ds, fmt, name, error, tmpdir):
+    path = str(tmpdir.join(name))
+    if error is None:
+        write_store(ds, path, fmt)
+        for loaded in [read_store(path), read_data(path)]:
+            np.testing.assert_array_equal(loaded["test"].values, ds["test"].values)
+            np.testing.assert_array_equal(loaded.lat.values, ds.lat.values)
+    else:
+        with pytest.raises(error):
+            write_store(ds, path, fmt)
+
+
+def test_store_mmap(tmpdir):
+    path = str(tmpdir.join("store"))
+    write_store(store_ds, path)
+    loaded = read_store(path)
+    values = loaded["test"].values
+    while values is not None and not isinstance(values, np.memmap):
+        values = values.base
+    assert isinstance(values, np.memmap)
+
+    # copy-on-write maps leave the store untouched
+    loaded["test"].values[0, 0] = -1.0
+    assert read_store(path)["test"].values[0, 0] == 0.0
+
+
+def test_read_store_missing(tmpdir):
+    with pytest.raises(FileNotFoundError):
+        read_store(str(tmpdir))
+
+
+@pytest.mark.parametrize(
+    "values, digits, error",
+    [
+        (np.array([1.234567, -123.4567, 0.001234567]), 3, None),
+        (np.array([1.234567, np.nan, np.inf], dtype=np.float32), 2, None),
+        (np.array([1.234567]), 0, ValueError),
+        (np.array([1, 2, 3]), 3, TypeError),
+    ],
+)
+def test_round_significant_digits(values, digits, error):
+    if error is None:
+        result = round_significant_digits(values, digits)
+        assert result.dtype == values.dtype
+        finite = np.isfinite(values)
+        np.testing.assert_allclose(
+            result[finite], values[finite], rtol=10.0 ** (-digits)
+        )
+        np.testing.assert_array_equal(result[~finite], values[~finite])
+    else:
+        with pytest.raises(error):
+            round_significant_digits(values, digits)
+
+
+large_field = np.random.default_rng(0).normal(size=(100, 120))
+large_ds = gen_dataset(
+    "test",
+    large_field,
+    np.linspace(-10, 10, 100),
+    np.linspace(-10, 10, 120),
+    np.ones(large_field.shape),
+    np.ones(large_field.shape),
+    "mm",
+)
+
+
+@pytest.mark.parametrize(
+    "ds, window, digits, path, error",
+    [
+        (large_ds, 30, None, "test.nc", None),
+        (large_ds, 30, 3, "test.nc", None),
+        (large_ds, 30, None, "test.csv", TypeError),
+        (large_ds, 0, None, "test.nc", ValueError),
+    ],
+)
+def test_write_netcdf(ds, window, digits, path, error, tmpdir):
+    path = str(tmpdir.join(path))
+    if error is None:
+        write_netcdf(ds, path, window=window, significant_digits=digits)
+        with xr.open_dataset(path) as result:
+            assert result["test"].dtype == np.float32
+            assert result.lat.dtype == np.float32
+            assert result.rlat.dtype == ds.rlat.dtype
+            assert result["test"].encoding["chunksizes"] == (window, window)
+            assert result["test"].encoding["zlib"]
+            rtol = 1e-6 if digits is None else 10.0 ** (-digits)
+            np.testing.assert_allclose(
+                result["test"].values, ds["test"].values, rtol=rtol
+            )
+    else:
+        with pytest.raises(error):
+            write_netcdf(ds, path, window=window)
+
+
+@pytest.mark.parametrize("ancillary, error", [(True, None), (False, KeyError)])
+def test_ancillary_variables(ancillary, error, tmpdir):
+    ds = large_ds.copy()
+    ds["test_variance"] = (("rlat", "rlon"), large_field**2)
+    if ancillary:
+        ds["test"].attrs["ancillary_variables"] = "test_variance"
+        assert ancillary_variables(ds) == {"test_variance"}
+    else:
+        assert ancillary_variables(ds) == set()
+
+    path = str(tmpdir.join("test.nc"))
+    write_netcdf(ds, path)
+    if error is None:
+        assert list(read_data(path).data_vars) == ["test"]
+    else:
+        with pytest.raises(error):
+            read_data(path)
@@ -9,11 +9,15 @@ from climpyrical.gridding import (
     check_find_nearest_value_inputs,
     check_ndims,
     find_nearest_index,
+    find_nearest_indices,
     find_element_wise_nearest_pos,
     find_nearest_index_value,
     regrid_ensemble,
     extend_north,
     rot2reg,
+    cell_edges,
+    remap_matrix,
+    apply_remap,
 )
 from climpyrical.data import read_data
 import pytest
@@ -234,6 +238,24 @@ def test_find_nearest_index(data, val, expected):
     assert find_nearest_index(data, val) == expected
 
 
+@pytest.mark.parametrize(
+    "data,vals,error",
+    [
+        (np.linspace(-100, 100, 200), np.linspace(-120, 120, 57), None),
+        (np.sort(np.random.RandomState(0).normal(size=30)), [-0.5, 0.1, 3.0], None),
+        (np.linspace(100, -100, 200), [0.0], ValueError),
+        ([1.0, 2.0], [1.5], TypeError),
+    ],
+)
+def test_find_nearest_indices(data, vals, error):
+    if error is None:
+        expected = [find_nearest_index(data, float(val)) for val in vals]
+        np.testing.assert_array_equal(find_nearest_indices(data, vals), expected)
+    else:
+        with pytest.raises(error):
+            find_nearest_indices(data, vals)
+
+
 @pytest.mark.parametrize(
     "x,y,x_obs,y_obs,error",
     [
@@ -379,3 +401,47 @@ def test_rot2reg(ds, error):
     else:
         with pytest.raises(error):
             rot2reg(ds)
+
+
+@pytest.mark.parametrize(
+    "x,expected,error",
+    [
+        (np.array([0.0, 1.0, 2.0]), np.array([-0.5, 0.5, 1.5, 2.5]), None),
+        (np.array([1.0]), None, ValueError),
+    ],
+)
+def test_cell_edges(x, expected, error):
+    if error is None:
+        assert np.allclose(cell_edges(x), expected)
+    else:
+        with pytest.raises(error):
+            cell_edges(x)
+
+
+@pytest.mark.parametrize("method", ["bilinear", "conservative"])
+def test_rot2reg_remap(method, tmpdir):
+    dv = list(ds.data_vars)[0]
+
+    newds = rot2reg(ds, method=method, cache_dir=str(tmpdir))
+    assert newds[dv].values.shape == ds[dv].values.shape
+    assert not np.all(np.isnan(newds[dv].values))
+    # the matrix is stored once per grid pair and reused
+    assert len(tmpdir.listdir()) == 1
+    cached = rot2reg(ds, method=method, cache_dir=str(tmpdir))
+    np.testing.assert_allclose(newds[dv].values, cached[dv].values)
+    # a matrix already in memory is still stored in a new cache_dir
+    other = tmpdir.mkdir("other")
+    rot2reg(ds, method=method, cache_dir=str(other))
+    assert len(other.listdir()) == 1
+
+    # a constant field is reproduced exactly wherever it is defined
+    xlon = np.linspace(ds.lon.min(), ds.lon.max(), ds.rlon.size)
+    ylat = np.linspace(ds.lat.min(), ds.lat.max(), ds.rlat.size)
+    W = remap_matrix(ds, xlon, ylat, method, target_crs, source_crs)
+    result = apply_remap(W, np.ones(ds[dv].shape))
+    assert np.allclose(result[~np.isnan(result)], 1.0)
+
+
+def test_rot2reg_bad_method():
+    with pytest.raises(ValueError):
+        rot2reg(ds, method="spaghetti")
@@ -0,0 +1,52 @@
+import subprocess
+import sys
+import pytest
+
+# heavy optional dependencies that must only be imported on first use
+LAZY_MODULES = ["rpy2", "geopandas", "sklearn", "pykrige", "tqdm", "pyproj"]
+
+# budgets in microseconds, as reported by python -X importtime
+SELF_BUDGET = 500000
+TOTAL_BUDGET = 5000000
+
+
+def import_times(module):
+    """Runs python -X importtime in a fresh interpreter and returns
+    a dict of module name to (self, cumulative) import time in us"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "climpyrical.data",
+        "climpyrical.gridding",
+        "climpyrical.mask",
+        "climpyrical.rkrig",
+        "climpyrical.spytialProcess",
+        "climpyrical.pipeline",
+        "climpyrical.crossval",
+        "climpyrical.sweep",
+    ],
+)
+def test_import_time(module):
+    times = import_times(module)
+
+    imported = {name.split(".")[0] for name in times}
+    assert not imported.intersection(LAZY_MODULES)
+
+    self_us = sum(t[0] for name, t in times.items() if name.startswith("climpyrical"))
+    assert self_us < SELF_BUDGET
+    assert times[module][1] < TOTAL_BUDGET
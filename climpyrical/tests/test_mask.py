@@ -10,9 +10,15 @@ from climpyrical.mask import (
     make_box,
     gen_upper_archipelago_mask,
     stratify_coords,
+    stratify_coords_buffers,
+    simplify_polygons,
+    write_geometry_cache,
+    read_geometry_cache,
 )
+from shapely.geometry import Polygon
 from pkg_resources import resource_filename
 import numpy as np
+import os
 
 canada = gpd.read_file(
     resource_filename("climpyrical", "tests/data/canada.geojson")
@@ -88,6 +94,37 @@ def test_rotate_shapefile(p, crs, expected):
     assert rotate_shapefile(p, crs).geom_almost_equals(expected).values[0]
 
 
+@pytest.mark.parametrize(
+    "p,crs,expected", [(canada, rotated_crs, rotated_canada)]
+)
+def test_rotate_shapefile_cache(p, crs, expected, tmpdir):
+    rotated = rotate_shapefile(p, crs, cache_dir=str(tmpdir))
+    assert len(tmpdir.listdir()) == 1
+    cached = rotate_shapefile(p, crs, cache_dir=str(tmpdir))
+    assert len(tmpdir.listdir()) == 1
+    assert cached.geom_almost_equals(expected).all()
+    assert cached.geom_almost_equals(rotated).all()
+    assert cached.index.equals(p.index)
+
+
+def test_geometry_cache(tmpdir):
+    p = gpd.GeoSeries(
+        [Polygon([(0, 0), (1, 0), (1, 1)]), Polygon([(2, 2), (3, 2), (3, 3)])],
+        index=["a", "b"],
+    )
+    path = str(tmpdir.join("cache.npz"))
+    write_geometry_cache(path, p)
+    assert os.listdir(tmpdir) == ["cache.npz"]
+
+    # nothing needs unpickling, which read_geometry_cache does not allow
+    with np.load(path, allow_pickle=False) as f:
+        assert all(f[key].dtype != object for key in f.files)
+
+    cached = read_geometry_cache(path, p.crs, p.index)
+    assert cached.geom_equals(p).all()
+    assert list(cached.index) == ["a", "b"]
+
+
 mask_ds = read_data(
     resource_filename("climpyrical", "/tests/data/canada_mask_rp.nc")
 )
@@ -129,6 +166,41 @@ def test_gen_raster_mask_from_vector(x, y, p, progress_bar, error):
             gen_raster_mask_from_vector(x, y, p, progress_bar)
 
 
+@pytest.mark.parametrize(
+    "p,dx,dy,factor,error",
+    [
+        (rotated_canada, 0.44, 0.44, 0.25, None),
+        (rotated_canada, 0.44, 0.44, 1.5, ValueError),
+        (gpd.GeoSeries(), 0.44, 0.44, 0.25, ValueError),
+    ],
+)
+def test_simplify_polygons(p, dx, dy, factor, error):
+    if error is None:
+        result = simplify_polygons(p, dx, dy, factor)
+        assert result.size == p.size
+        assert result.is_valid.all()
+        assert np.sum(result.apply(lambda g: len(g.wkb))) <= np.sum(
+            p.apply(lambda g: len(g.wkb))
+        )
+    else:
+        with pytest.raises(error):
+            simplify_polygons(p, dx, dy, factor)
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize(
+    "x,y,p,factor",
+    [
+        (np.arange(-34, 34, 1.0), np.arange(-29, 40, 1.0), rotated_canada, 1.0),
+        (np.arange(-34, 34, 0.44), np.arange(-29, 40, 0.44), rotated_canada, 0.25),
+    ],
+)
+def test_gen_raster_mask_from_vector_simplify(x, y, p, factor):
+    expected = gen_raster_mask_from_vector(x, y, p, False)
+    result = gen_raster_mask_from_vector(x, y, p, False, True, factor)
+    assert np.array_equal(result, expected)
+
+
 @pytest.mark.parametrize(
     "x,y,dx,dy,error",
     [
@@ -197,3 +269,33 @@ def test_stratify_coords(p, error):
     else:
         with pytest.raises(error):
             stratify_coords(p)
+
+
+@pytest.mark.parametrize("p", [rotated_canada])
+def test_stratify_coords_buffers(p):
+    X, Y, offsets = stratify_coords_buffers(p)
+    assert X.dtype == np.float64 and Y.dtype == np.float64
+    assert offsets[-1] == X.size
+    # one NaN separator at the end of each exterior ring
+    assert np.array_equal(np.flatnonzero(np.isnan(X)), offsets[1:] - 1)
+    assert not np.any(np.isnan(np.delete(Y, offsets[1:] - 1)))
+    # the same GeoSeries returns the cached buffers
+    assert stratify_coords_buffers(p)[0] is X
+    # which are shared, so cannot be edited
+    for buffer in (X, Y, offsets):
+        with pytest.raises(ValueError):
+            buffer[0] = 0
+    # stratify_coords returns editable copies
+    X_copy, Y_copy = stratify_coords(p)
+    X_copy[0] = 0
+    assert np.array_equal(Y_copy, Y, equal_nan=True) and X[0] != 0
+
+
+def test_stratify_coords_buffers_edited():
+    p = gpd.GeoSeries(
+        [Polygon([(0, 0), (1, 0), (1, 1)]), Polygon([(2, 2), (3, 2), (3, 3)])]
+    )
+    X = stratify_coords_buffers(p)[0]
+    # an edit that keeps the size and bounds still refreshes the cache
+    p[0] = Polygon([(0, 0), (1, 0), (0, 1)])
+    assert not np.array_equal(stratify_coords_buffers(p)[0], X, equal_nan=True)
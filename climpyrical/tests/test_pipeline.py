@@ -0,0 +1,390 @@
+from climpyrical.data import gen_dataset, write_netcdf, read_data
+from climpyrical.cmd.find_matched_model_vals import aggregate_stations
+from climpyrical.pipeline import (
+    STAGES,
+    load_config,
+    stage_io,
+    is_up_to_date,
+    plan_stages,
+    stage_params,
+    write_params,
+    shared_inputs,
+    check_df_columns,
+    process_stations,
+    reconstruct,
+    unique_windows,
+    combine_tables,
+    run_pipeline,
+    profile_paths,
+)
+import pytest
+from pkg_resources import resource_filename
+import os
+import yaml
+import numpy as np
+import pandas as pd
+
+
+def write_config(tmpdir, steps):
+    config = {
+        "steps": steps,
+        "root": str(tmpdir),
+        "paths": {
+            "preprocessed_model_path": "model/",
+            "preprocessed_stations_path": "stations/",
+            "output_reconstruction_path": "netcdf/",
+            "output_tables_path": "tables/",
+            "output_figure_path": "figures/",
+            "mask_path": "mask.nc",
+            "north_mask_path": "north_mask.nc",
+            "nbcc_loc_path": "nbcc.xlsm",
+        },
+        "nbcc_mean_correction": True,
+        "dvs": {
+            name: {
+                "station_dv": f"{name} (kPa)",
+                "station_path": f"{name}.csv",
+                "input_model_path": f"{name}.nc",
+                "medians": {"value": "None", "action": "None"},
+                "fill_glaciers": True,
+            }
+            for name in ["RL50", "SL50"]
+        },
+    }
+    path = os.path.join(tmpdir, "config.yml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+@pytest.mark.parametrize(
+    "steps,expected",
+    [
+        (
+            ["preprocess_model.ipynb", "stations.ipynb"],
+            ["preprocess_model", "stations"],
+        ),
+        (["MWOrK", "nbcc_stations.ipynb"], ["MWOrK", "nbcc_locations"]),
+        (["bad_step.ipynb"], ValueError),
+    ],
+)
+def test_load_config(tmpdir, steps, expected):
+    path = write_config(tmpdir, steps)
+    if isinstance(expected, list):
+        config = load_config(path)
+        assert config["steps"] == expected
+        assert config["n_jobs"] == 1
+        assert config["nbcc_correction"]
+    else:
+        with pytest.raises(expected):
+            load_config(path)
+
+
+def test_stage_io(tmpdir):
+    config = load_config(write_config(tmpdir, STAGES))
+
+    # each stage reads what the previous stage writes
+    model = stage_io("preprocess_model", "RL50", config)[1][0]
+    stations = stage_io("stations", "RL50", config)[1][0]
+    reconstruction = stage_io("MWOrK", "RL50", config)[1][0]
+    assert model in stage_io("stations", "RL50", config)[0]
+    assert {model, stations} <= set(stage_io("MWOrK", "RL50", config)[0])
+    assert reconstruction in stage_io("nbcc_locations", "RL50", config)[0]
+
+    tables = [stage_io("nbcc_locations", name, config)[1][0] for name in config["dvs"]]
+    assert stage_io("combine_tables", None, config)[0] == tables
+
+    with pytest.raises(ValueError):
+        stage_io("bad_stage", "RL50", config)
+
+
+def test_is_up_to_date(tmpdir):
+    inputs = [os.path.join(tmpdir, "in.nc")]
+    outputs = [os.path.join(tmpdir, "out.nc")]
+    assert not is_up_to_date(inputs, outputs)
+
+    for path, mtime in [(inputs[0], 1000), (outputs[0], 2000)]:
+        open(path, "w").close()
+        os.utime(path, (mtime, mtime))
+    assert is_up_to_date(inputs, outputs)
+
+    os.utime(inputs[0], (3000, 3000))
+    assert not is_up_to_date(inputs, outputs)
+
+
+def test_run_pipeline_skips_up_to_date(tmpdir):
+    config = load_config(write_config(tmpdir, ["stations.ipynb"]))
+    for name in config["dvs"]:
+        inputs, outputs = stage_io("stations", name, config)
+        for path in inputs + outputs:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+        for path in outputs:
+            os.utime(path, (os.path.getmtime(inputs[0]) + 1,) * 2)
+
+    timings = run_pipeline(config, n_jobs=2)
+    assert list(timings.index) == list(config["dvs"])
+    assert list(timings.columns) == ["stations"]
+    assert timings.isnull().values.all()
+
+    with pytest.raises(KeyError):
+        run_pipeline(config, names=["not_a_dv"])
+
+
+def test_plan_stages(tmpdir):
+    config = load_config(write_config(tmpdir, STAGES))
+    assert plan_stages(config, ["RL50"])["RL50"] == STAGES[:-1]
+
+    # up to date stations still rerun once the model is rebuilt
+    for stage in ["preprocess_model", "stations"]:
+        inputs, outputs = stage_io(stage, "RL50", config)
+        for path in inputs + outputs:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+            os.utime(path, (1000, 1000) if path in inputs else (2000, 2000))
+    assert plan_stages(config, ["RL50"])["RL50"] == STAGES[2:-1]
+
+    model = stage_io("preprocess_model", "RL50", config)[0][0]
+    os.utime(model, (3000, 3000))
+    assert plan_stages(config, ["RL50"])["RL50"] == STAGES[:-1]
+    assert plan_stages(config, ["RL50"], force=True)["RL50"] == STAGES[:-1]
+
+
+def test_plan_stages_params(tmpdir):
+    config = load_config(write_config(tmpdir, STAGES))
+    for stage in STAGES[:-1]:
+        inputs, outputs = stage_io(stage, "RL50", config)
+        for path in inputs + outputs:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+            os.utime(path, (1000, 1000) if path in inputs else (2000, 2000))
+        write_params(outputs, stage_params(stage, "RL50", config))
+    assert plan_stages(config, ["RL50"])["RL50"] == []
+
+    # a new window size reruns the reconstruction and what follows it
+    config["dvs"]["RL50"]["n"] = 40
+    assert plan_stages(config, ["RL50"])["RL50"] == STAGES[2:-1]
+
+    del config["dvs"]["RL50"]["n"]
+    assert plan_stages(config, ["RL50"])["RL50"] == []
+
+
+def test_shared_inputs(tmpdir):
+    config = load_config(write_config(tmpdir, STAGES))
+    config["dvs"]["SL50"]["station_path"] = "RL50.csv"
+    groups = shared_inputs(config, ["RL50", "SL50"], "station_path")
+    assert list(groups.values()) == [["RL50", "SL50"]]
+
+    groups = shared_inputs(config, ["RL50", "SL50"], "input_model_path")
+    assert list(groups.values()) == [["RL50"], ["SL50"]]
+
+
+def test_run_pipeline_shared_stations(tmpdir):
+    config = load_config(write_config(tmpdir, ["stations.ipynb"]))
+
+    rlon, rlat = np.linspace(-34, 30, 200), np.linspace(-28, 30, 200)
+    lon, lat = np.meshgrid(rlon, rlat)
+    mask = gen_dataset("mask", np.ones((200, 200)), rlat, rlon, lat, lon, "1")
+    write_netcdf(mask, os.path.join(tmpdir, config["paths"]["mask_path"]))
+
+    df = pd.read_csv(resource_filename("climpyrical", "tests/data/sl50_short.csv"))
+    df = df.assign(**{"elev (m)": 10.0, "RL50 (kPa)": 0.5, "SL50 (kPa)": 2.0})
+    df.to_csv(os.path.join(tmpdir, "stations.csv"), index=False)
+
+    models = {}
+    for name in config["dvs"]:
+        config["dvs"][name]["station_path"] = "stations.csv"
+        field = np.random.uniform(1, 3, (200, 200))
+        models[name] = gen_dataset("dv", field, rlat, rlon, lat, lon, "kPa")
+        path = stage_io("preprocess_model", name, config)[1][0]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_netcdf(models[name], path)
+
+    config["profile"] = True
+    timings = run_pipeline(config, n_jobs=1)
+    assert list(timings.index) == ["RL50", "SL50", "shared"]
+    assert not timings.isnull().values.any()
+
+    for name in config["dvs"]:
+        json_path, csv_path = profile_paths(name, config)
+        assert os.path.exists(json_path)
+        stages = pd.read_csv(csv_path).stage.tolist()
+        assert "stations" in stages and "stations/add_model_values" in stages
+
+    # stations matched once give the same tables as matching each design value
+    for name, ds in models.items():
+        station_dv = config["dvs"][name]["station_dv"]
+        expected = process_stations(df, ds.astype("float32"), station_dv)
+        actual = pd.read_csv(stage_io("stations", name, config)[1][0])
+        pd.testing.assert_frame_equal(
+            actual, expected.reset_index(drop=True), check_dtype=False
+        )
+
+
+def test_check_df_columns():
+    df = pd.DataFrame(columns=["longitude", "latitude", "Name", "prov", "elev"])
+    df = check_df_columns(df)
+    assert list(df.columns) == ["lon", "lat", "station_name", "province", "elev (m)"]
+
+
+def test_process_stations():
+    rlon, rlat = np.linspace(-34, 30, 200), np.linspace(-28, 30, 200)
+    lon, lat = np.meshgrid(rlon, rlat)
+    ds = gen_dataset("tas", np.full((200, 200), -20.0), rlat, rlon, lat, lon, "degC")
+    df = pd.read_csv(resource_filename("climpyrical", "tests/data/sl50_short.csv"))
+    df = df.assign(**{"elev (m)": 10.0})
+
+    df_match = process_stations(df, ds, "TJan2.5 (degC)")
+
+    # one station per grid cell, ratios calculated in K and values
+    # returned in degC without modifying the model
+    assert not df_match.duplicated(["irlat", "irlon"]).any()
+    assert np.all(df_match.ratio > 0)
+    np.testing.assert_allclose(df_match.model_values, -20.0)
+    np.testing.assert_allclose(ds["tas"].values, -20.0)
+
+    with pytest.raises(ValueError):
+        process_stations(df.assign(lat=np.nan), ds, "TJan2.5 (degC)")
+
+
+@pytest.mark.parametrize("nx, error", [(5, None), (3, ValueError)])
+def test_aggregate_stations(nx, error):
+    df = pd.DataFrame(
+        {
+            "irlat": [2, 0, 2, 0, 1],
+            "irlon": [3, 1, 3, 1, 0],
+            "RL50 (kPa)": [1.0, 2.0, 3.0, np.nan, 5.0],
+            "elev (m)": np.array([10, 20, 30, 40, 50], dtype=np.float32),
+            "station_name": ["a", "b", "c", "d", "e"],
+            "notes": ["x", "y", "z", "w", "v"],
+        }
+    )
+    if error is None:
+        df_cells = aggregate_stations(df, nx)
+        expected = df.groupby(["irlat", "irlon"], as_index=False).agg(
+            {"RL50 (kPa)": "mean", "elev (m)": "mean", "station_name": "first"}
+        )
+        pd.testing.assert_frame_equal(df_cells.drop(columns="n_stations"), expected)
+        assert df_cells.n_stations.tolist() == [2, 1, 2]
+        assert df_cells["elev (m)"].dtype == np.float32
+    else:
+        with pytest.raises(error):
+            aggregate_stations(df, nx)
+
+
+def test_aggregate_stations_empty():
+    df = pd.DataFrame(
+        {
+            "irlat": np.array([], dtype=int),
+            "irlon": np.array([], dtype=int),
+            "RL50 (kPa)": np.array([], dtype=float),
+            "station_name": np.array([], dtype=object),
+        }
+    )
+    df_cells = aggregate_stations(df, 10)
+    assert df_cells.shape[0] == 0
+    assert list(df_cells.columns) == list(df.columns) + ["n_stations"]
+
+
+def test_reconstruct_variance(tmpdir, monkeypatch):
+    import climpyrical.rkrig
+
+    rlon, rlat = np.linspace(-34, 30, 100), np.linspace(-28, 30, 100)
+    lon, lat = np.meshgrid(rlon, rlat)
+    ds = gen_dataset("tas", np.full((100, 100), -20.0), rlat, rlon, lat, lon, "degC")
+    df = pd.read_csv(resource_filename("climpyrical", "tests/data/sl50_short.csv"))
+    df = process_stations(df.assign(**{"elev (m)": 10.0}), ds, "TJan2.5 (degC)")
+
+    def rkrig_r(df, n, ds, station_dv, return_variance=False, **kwargs):
+        # windows cover the southern half of the grid
+        field = np.full((ds.rlat.size, ds.rlon.size), np.nan)
+        field[:50] = 1.0
+        return (
+            (field, np.where(np.isnan(field), np.nan, 0.01))
+            if return_variance
+            else field
+        )
+
+    monkeypatch.setattr(climpyrical.rkrig, "rkrig_r", rkrig_r)
+
+    mask = np.ones(lon.shape, dtype=bool)
+    mask[:, :5] = False
+    northern_mask = np.zeros(lon.shape, dtype=bool)
+    northern_mask[90:] = True
+
+    ds_recon = reconstruct(ds, df, mask, northern_mask, "TJan2.5 (degC)")
+    assert list(ds_recon.data_vars) == ["tas"]
+
+    ds_recon = reconstruct(ds, df, mask, northern_mask, "TJan2.5 (degC)", variance=True)
+    variance = ds_recon["tas_variance"].values
+    assert ds_recon["tas"].attrs["ancillary_variables"] == "tas_variance"
+    assert ds_recon["tas_variance"].attrs["units"] == "(degC)^2"
+
+    # filled like the reconstruction, except for the northern fill value
+    assert np.all(np.isnan(variance[~mask]))
+    assert np.all(np.isnan(variance[northern_mask]))
+    inside = mask & ~northern_mask
+    assert np.all(variance[inside] > 0)
+    np.testing.assert_allclose(variance[inside], variance[inside].max())
+
+    # the variance is written alongside, but read_data keeps the
+    # reconstruction only
+    path = os.path.join(tmpdir, "recon.nc")
+    write_netcdf(ds_recon, path)
+    assert list(read_data(path).data_vars) == ["tas"]
+
+    with pytest.raises(ValueError):
+        reconstruct(
+            ds,
+            df,
+            mask,
+            northern_mask,
+            "TJan2.5 (degC)",
+            kriging="sparse",
+            variance=True,
+        )
+
+
+def test_unique_windows():
+    lat, lon = np.meshgrid(np.linspace(45, 55, 4), np.linspace(-120, -60, 4))
+    df = pd.DataFrame({"lat": lat.flatten(), "lon": lon.flatten(), "dv": 1.0})
+    assert unique_windows(df, "dv", 3).shape[0] == df.shape[0]
+
+    # duplicated stations have identical windows
+    df_dup = pd.concat([df, df], ignore_index=True)
+    assert unique_windows(df_dup, "dv", 1).shape[0] == df.shape[0]
+
+
+def test_combine_tables():
+    dvs = {
+        "RL50": {"station_dv": "RL50 (kPa)"},
+        "R15m10": {"station_dv": "Gum-LM RL10 (mm)"},
+    }
+    locations = pd.DataFrame(
+        {
+            "Location": ["Victoria", "Iqaluit"],
+            "Prov": ["BC", "NU"],
+            "lon": [-123.4, -68.5],
+            "lat": [48.4, 63.7],
+            "2020 Elev (m)": [20.0, 30.0],
+        }
+    )
+    tables = [
+        locations.assign(**{"RL50 (kPa)": [0.4, 0.3]}),
+        locations.assign(**{"Gum-LM RL10 (mm)": [10.0, 5.0]}),
+    ]
+    df = combine_tables(tables, dvs)
+    assert list(df.columns) == [
+        "Location",
+        "prov",
+        "Longitude",
+        "Latitude",
+        "elevation (m)",
+        "RL50 (kPa)",
+        "R15m10 (mm)",
+    ]
+    np.testing.assert_array_equal(df["R15m10 (mm)"], [10.0, 5.0])
+
+    tables[0].loc[0, "RL50 (kPa)"] = np.nan
+    with pytest.raises(ValueError):
+        combine_tables(tables, dvs)
@@ -0,0 +1,79 @@
+from climpyrical import profiling
+import pytest
+import json
+import os
+import pandas as pd
+
+
+@profiling.profiled
+def add(x, y):
+    profiling.count("additions")
+    return x + y
+
+
+def run_stages():
+    with profiling.stage("outer", dv="RL50"):
+        for i in range(3):
+            with profiling.stage("window", window=i):
+                add(i, 1)
+                if i == 2:
+                    profiling.count("errors")
+
+
+def test_disabled():
+    profiling.reset()
+    profiling.disable()
+    run_stages()
+    assert profiling.report().empty
+    assert add(1, 2) == 3
+
+
+def test_stages_and_counters():
+    profiling.enable()
+    run_stages()
+    profiling.disable()
+
+    df = profiling.report()
+    assert list(df.stage.unique()) == ["outer/window/add", "outer/window", "outer"]
+    assert df[df.stage == "outer/window"].window.tolist() == [0, 1, 2]
+    assert (df.wall_s >= 0).all() and (df.peak_rss_mb > 0).all()
+
+    # counters are attributed to every enclosing stage
+    outer = df[df.stage == "outer"].iloc[0]
+    assert outer.additions == 3 and outer.errors == 1 and outer.dv == "RL50"
+
+    df_summary = profiling.summary().set_index("stage")
+    assert df_summary.loc["outer/window", "calls"] == 3
+    assert df_summary.loc["outer/window", "errors"] == 1
+    assert df_summary.loc["outer/window/add", "additions"] == 3
+
+    # enabling again starts a new report
+    profiling.enable()
+    assert profiling.report().empty
+    profiling.disable()
+
+
+@pytest.mark.parametrize(
+    "filename,error",
+    [("profile.json", None), ("profile.csv", None), ("profile.txt", ValueError)],
+)
+def test_write_report(tmpdir, filename, error):
+    profiling.enable()
+    run_stages()
+    profiling.disable()
+
+    path = os.path.join(tmpdir, "reports", filename)
+    if error is None:
+        profiling.write_report(path, dv="RL50")
+        if filename.endswith(".json"):
+            with open(path) as f:
+                content = json.load(f)
+            assert content["meta"] == {"dv": "RL50"}
+            assert content["counters"] == {"additions": 3, "errors": 1}
+            assert len(content["records"]) == 7
+            assert len(content["summary"]) == 3
+        else:
+            assert pd.read_csv(path).shape[0] == 7
+    else:
+        with pytest.raises(error):
+            profiling.write_report(path)
@@ -4,8 +4,26 @@ import numpy as np
 from nptyping import NDArray
 from typing import Any
 
-from climpyrical.rkrig import check_df, krigit_north, rkrig_py, rkrig_r
-from climpyrical.data import read_data
+from climpyrical.rkrig import (
+    check_df,
+    krigit_north,
+    rkrig_py,
+    rkrig_r,
+    initial_window_sizes,
+    station_neighbours,
+    find_windows,
+    tile_labels,
+    find_tiles,
+    taper_weights,
+    accumulate_window,
+    wendland,
+    rkrig_sparse,
+)
+from scipy.spatial import ConvexHull
+from sklearn.neighbors import NearestNeighbors
+from climpyrical.data import read_data, gen_dataset
+import climpyrical.rkrig as rkrig
+from scipy.spatial.distance import cdist
 from pkg_resources import resource_filename
 
 df = pd.DataFrame({"x": np.ones(5), "y": np.ones(5), "z": np.ones(5)})
@@ -19,6 +37,17 @@ df_ = pd.read_csv(
 )
 
 
+def small_grid(df, nx=50, ny=40):
+    # a coarse grid one degree beyond the stations
+    rlon = np.linspace(df.rlon.min() - 1, df.rlon.max() + 1, nx)
+    rlat = np.linspace(df.rlat.min() - 1, df.rlat.max() + 1, ny)
+    lon, lat = np.meshgrid(rlon, rlat)
+    return gen_dataset("dv", np.ones(lon.shape), rlat, rlon, lat, lon)
+
+
+ds_small = small_grid(df_)
+
+
 @pytest.mark.parametrize(
     "df, keys, error",
     [
@@ -34,6 +63,205 @@ def test_check_df(df, keys, error):
             check_df(df, keys)
 
 
+@pytest.mark.parametrize(
+    "station_dv, lat, province, expected",
+    [
+        ("RL50 (kPa)", [50.0, 65.0], ["BC", "NU"], [5, 40]),
+        ("WP50", [50.0, 55.0], ["QC", "QC"], [5, 10]),
+        ("WP50", [55.0, 55.0], ["BC", "NL"], [5, 10]),
+        ("SL50 (kPa)", [50.0, 65.0], ["QC", "NU"], [5, 5]),
+    ],
+)
+def test_initial_window_sizes(station_dv, lat, province, expected):
+    df = pd.DataFrame({"lat": lat, "province": province})
+    sizes = initial_window_sizes(df, 5, station_dv)
+    np.testing.assert_array_equal(sizes, expected)
+
+
+@pytest.mark.parametrize(
+    "rules, province, expected, error",
+    [
+        ([], True, [5, 5, 5], None),
+        ([{"min_lat": 55.0, "max_lat": 65.0, "n": 8}], True, [5, 8, 5], None),
+        ([{"station_dv": "SL50 (kPa)", "n": 8}], True, [5, 5, 5], None),
+        ([{"station_dv": ["WP50", "WP50 (kPa)"], "n": 8}], True, [8, 8, 8], None),
+        (
+            [{"min_lat": 0.0, "n": 8}, {"provinces": ["NU"], "n": 2}],
+            True,
+            [8, 8, 2],
+            None,
+        ),
+        (
+            [{"min_lat": 0.0, "n": 8}, {"provinces": ["NU"], "n": 2}],
+            False,
+            [8, 8, 8],
+            None,
+        ),
+        ([{"min_lat": 60.0}], True, None, ValueError),
+        ([{"lat": 60.0, "n": 8}], True, None, ValueError),
+    ],
+)
+def test_initial_window_sizes_rules(rules, province, expected, error):
+    df = pd.DataFrame({"lat": [50.0, 60.0, 70.0]})
+    if province:
+        df["province"] = ["BC", "QC", "NU"]
+    if error is None:
+        sizes = initial_window_sizes(df, 5, "WP50 (kPa)", rules)
+        np.testing.assert_array_equal(sizes, expected)
+    else:
+        with pytest.raises(error):
+            initial_window_sizes(df, 5, "WP50 (kPa)", rules)
+
+
+def grow_windows(df, n, min_area):
+    # reference implementation adding one station at a time
+    X = np.stack([np.deg2rad(df.lat.values), np.deg2rad(df.lon.values)]).T
+    points = df[["rlon", "rlat"]].values
+    _, ind = NearestNeighbors(metric="haversine").fit(X).kneighbors(X, df.shape[0])
+    windows = []
+    for i in range(df.shape[0]):
+        k = n
+        while ConvexHull(points=points[ind[i, :k]]).area < min_area:
+            k += 1
+        windows.append(ind[i, :k])
+    return windows
+
+
+@pytest.mark.parametrize(
+    "n, min_area, max_neighbours, error",
+    [
+        (10, 0.0, 10, None),
+        (10, 10.0, 10, None),
+        (5, 60.0, 8, None),
+        (5, 1e6, 8, None),
+        (df_.shape[0], 0.0, 10, ValueError),
+    ],
+)
+def test_find_windows(n, min_area, max_neighbours, error):
+    df = df_.iloc[::3]
+    sizes = np.full(df.shape[0], n)
+    if error is None:
+        windows, hull_areas = find_windows(df, sizes, min_area, max_neighbours)
+        if min_area < 1e6:
+            expected = grow_windows(df, n, min_area)
+            for window, expected_window in zip(windows, expected):
+                np.testing.assert_array_equal(window, expected_window)
+            assert np.all(hull_areas >= min_area)
+        else:
+            # windows that can never be large enough use every station
+            assert all(window.size == df.shape[0] for window in windows)
+    else:
+        with pytest.raises(error):
+            find_windows(df, sizes, min_area, max_neighbours)
+
+
+@pytest.mark.parametrize("k", [5, 20, 200])
+def test_find_windows_neighbours(k):
+    # precomputed neighbours, too few or enough, give the same windows
+    df = df_.iloc[::3]
+    sizes = np.full(df.shape[0], 10)
+    neighbours = station_neighbours(df, k)
+    assert neighbours.shape == (df.shape[0], min(k, df.shape[0]))
+
+    windows, hull_areas = find_windows(df, sizes, 60.0, 10)
+    shared, shared_areas = find_windows(df, sizes, 60.0, 10, neighbours)
+    for window, shared_window in zip(windows, shared):
+        np.testing.assert_array_equal(window, shared_window)
+    np.testing.assert_array_equal(hull_areas, shared_areas)
+
+
+@pytest.mark.parametrize(
+    "method, n, error",
+    [
+        ("kmeans", 10, None),
+        ("quadtree", 10, None),
+        ("quadtree", 1, None),
+        ("voronoi", 10, ValueError),
+    ],
+)
+def test_tile_labels(method, n, error):
+    points = df_[["rlon", "rlat"]].values
+    if error is None:
+        labels = tile_labels(points, n, method)
+        assert labels.shape == (points.shape[0],)
+        assert np.unique(labels).size < points.shape[0] or n == 1
+        if method == "quadtree":
+            assert np.bincount(labels).max() <= n or n == 1
+    else:
+        with pytest.raises(error):
+            tile_labels(points, n, method)
+
+
+@pytest.mark.parametrize(
+    "method, n, min_area, buffer, error",
+    [
+        ("kmeans", 10, 0.0, 0.5, None),
+        ("quadtree", 10, 0.0, 0.0, None),
+        ("quadtree", 10, 60.0, 1.0, None),
+        ("kmeans", 10, 0.0, -1.0, ValueError),
+    ],
+)
+def test_find_tiles(method, n, min_area, buffer, error):
+    df = df_.iloc[::3]
+    sizes = np.full(df.shape[0], n)
+    if error is None:
+        windows, cores, hull_areas = find_tiles(df, sizes, min_area, method, buffer)
+        assert len(windows) == len(cores) == hull_areas.size < df.shape[0]
+
+        # every station is in exactly one tile, and each window starts
+        # with its tile's stations
+        all_cores = np.sort(np.concatenate(cores))
+        np.testing.assert_array_equal(all_cores, np.arange(df.shape[0]))
+        for window, core in zip(windows, cores):
+            assert set(window[: core.size]) == set(core)
+            assert window.size >= n
+        assert np.all(hull_areas >= min_area)
+    else:
+        with pytest.raises(error):
+            find_tiles(df, sizes, min_area, method, buffer)
+
+
+@pytest.mark.parametrize(
+    "rlon, rlat, centre, edges",
+    [
+        (np.linspace(0, 4, 5), np.linspace(0, 2, 3), [2.0, 1.0], "NSEW"),
+        (np.linspace(0, 4, 9), np.linspace(0, 2, 5), [3.0, 0.5], "NSEW"),
+        (np.linspace(0, 4, 5), np.linspace(0, 2, 3), [0.0, 2.0], "SE"),
+    ],
+)
+def test_taper_weights(rlon, rlat, centre, edges):
+    w = taper_weights(rlon, rlat, np.array(centre), floor=1e-3)
+    assert w.shape == (rlat.size, rlon.size)
+    assert np.all((w >= 1e-3) & (w <= 1.0))
+
+    # 1 at the centre station, the floor on the edges away from it
+    i, j = np.argmin(np.abs(rlat - centre[1])), np.argmin(np.abs(rlon - centre[0]))
+    assert np.isclose(w[i, j], 1.0)
+    sides = {"S": w[0, :], "N": w[-1, :], "W": w[:, 0], "E": w[:, -1]}
+    for edge in edges:
+        np.testing.assert_allclose(sides[edge], 1e-3)
+
+
+def test_accumulate_window():
+    total, weights = np.zeros((4, 4)), np.zeros((4, 4))
+    a = np.full((4, 4), np.nan)
+    a[0:2, 0:3] = 1.0
+    b = np.full((4, 4), np.nan)
+    b[1:3, 1:4] = 3.0
+    b[2, 3] = np.nan
+
+    accumulate_window(total, weights, a, (0, 2, 0, 3))
+    accumulate_window(total, weights, b, (1, 3, 1, 4))
+    with np.errstate(invalid="ignore"):
+        np.testing.assert_array_equal(total / weights, np.nanmean([a, b], axis=0))
+
+    # weighted
+    total, weights = np.zeros((4, 4)), np.zeros((4, 4))
+    accumulate_window(total, weights, a, (0, 2, 0, 3), np.full((2, 3), 3.0))
+    accumulate_window(total, weights, b, (1, 3, 1, 4), np.full((2, 3), 1.0))
+    assert np.isclose(total[1, 1] / weights[1, 1], (3.0 * 1.0 + 3.0) / 4.0)
+
+
 @pytest.mark.parametrize(
     "df, station_dv, n, ds",
     [
@@ -54,6 +282,51 @@ def test_krigit_north(df, station_dv, n, ds):
     assert np.sum(~np.isnan(result)) < np.sum(~np.isnan(ds["mask"].values))
 
 
+def test_krigit_north_compact(monkeypatch):
+    calls = []
+
+    def fit(latlon, z, nx, ny, extrap):
+        calls.append(latlon.shape[1])
+        return np.arange(nx * ny, dtype=float).reshape(nx, ny), None, None
+
+    monkeypatch.setattr(rkrig.sp, "fit", fit)
+
+    bbox, surface = krigit_north(df_, "TJan2.5 (degC)", 10, ds_small, compact=True)
+    field = krigit_north(df_, "TJan2.5 (degC)", 10, ds_small)
+    assert calls == [10, 10]
+
+    lw, u, l, r = bbox
+    assert field.shape == (ds_small.rlat.size, ds_small.rlon.size)
+    np.testing.assert_array_equal(field[lw:u, l:r], surface)
+    assert np.isnan(field).sum() == field.size - surface.size
+
+    # the window reaches the northernmost station
+    dy = np.diff(ds_small.rlat.values)[0]
+    assert np.abs(ds_small.rlat.values[u] - df_.rlat.max()) <= dy / 2
+
+
+def test_rkrig_r_nan_variance(monkeypatch):
+    calls = []
+
+    def fit(latlon, z, nx, ny, extrap, return_timings, return_variance):
+        # the first window has no standard errors
+        calls.append(latlon.shape[1])
+        variance = np.full((nx, ny), np.nan if len(calls) == 1 else 2.0)
+        timings = {"fit_s": 0.0, "predict_s": 0.0, "se_s": 0.0}
+        return np.ones((nx, ny)), None, None, variance, timings
+
+    monkeypatch.setattr(rkrig.sp, "fit", fit)
+
+    field, variance = rkrig_r(
+        df_.iloc[::10], 10, ds_small, "TJan2.5 (degC)", 2, return_variance=True
+    )
+    assert len(calls) > 1
+    # the window without variance does not lower the average of the others
+    covered = ~np.isnan(variance)
+    assert covered.any()
+    np.testing.assert_allclose(variance[covered], 2.0)
+
+
 @pytest.mark.slow
 @pytest.mark.parametrize(
     "df, station_dv, n, ds",
@@ -73,6 +346,33 @@ def test_rkrig_py(df, station_dv, n, ds):
     assert isinstance(result, NDArray[(Any, Any), float])
 
 
+@pytest.mark.slow
+@pytest.mark.parametrize("chunk_size, n_jobs", [(50000, 1), (300, 1), (300, 2)])
+def test_rkrig_py_mask(chunk_size, n_jobs):
+    df = df_.iloc[::5]
+    ds_small = small_grid(df)
+
+    mask = np.zeros((ds_small.rlat.size, ds_small.rlon.size), dtype=bool)
+    mask[5:35, 10:45] = True
+
+    full = rkrig_py(df, "TJan2.5 (degC)", 5, ds_small)
+    result = rkrig_py(
+        df,
+        "TJan2.5 (degC)",
+        5,
+        ds_small,
+        mask=mask,
+        chunk_size=chunk_size,
+        n_jobs=n_jobs,
+    )
+
+    assert np.all(np.isnan(result[~mask]))
+    np.testing.assert_allclose(result[mask], full[mask])
+
+    with pytest.raises(ValueError):
+        rkrig_py(df, "TJan2.5 (degC)", 5, ds_small, mask=mask[1:])
+
+
 @pytest.mark.slow
 @pytest.mark.parametrize(
     "df, n, ds, station_dv, min_size",
@@ -91,3 +391,163 @@ def test_rkrig_r(df, n, ds, station_dv, min_size):
     assert not np.allclose(result, 0.0)
 
     assert isinstance(result, NDArray[(Any, Any), float])
+
+
+@pytest.mark.slow
+def test_rkrig_r_windows():
+    df = df_.iloc[::10]
+    result, windows = rkrig_r(df, 10, ds, "TJan2.5 (degC)", 2, return_windows=True)
+
+    np.testing.assert_allclose(result, rkrig_r(df, 10, ds, "TJan2.5 (degC)", 2))
+    assert list(windows.station) == list(range(df.shape[0]))
+    assert (windows.n_neighbours >= 10).all()
+    succeeded = windows[windows.success]
+    assert (succeeded.bbox_cells > 0).all()
+    assert (succeeded[["fit_s", "predict_s", "wall_s"]] >= 0).all().all()
+
+
+@pytest.mark.slow
+def test_rkrig_r_blend():
+    df = df_.iloc[::10]
+    mean = rkrig_r(df, 10, ds, "TJan2.5 (degC)", 2, blend="mean")
+    taper = rkrig_r(df, 10, ds, "TJan2.5 (degC)", 2, blend="taper")
+
+    # the same cells are covered, and values stay within the windows' range
+    np.testing.assert_array_equal(np.isnan(mean), np.isnan(taper))
+    assert np.nanmin(taper) >= np.nanmin(mean) - 1e-6
+    assert np.nanmax(taper) <= np.nanmax(mean) + 1e-6
+
+    with pytest.raises(ValueError):
+        rkrig_r(df, 10, ds, "TJan2.5 (degC)", 2, blend="median")
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("tiling", ["kmeans", "quadtree"])
+def test_rkrig_r_tiling(tiling):
+    df = df_.iloc[::10]
+    result, windows = rkrig_r(
+        df, 10, ds, "TJan2.5 (degC)", 2, return_windows=True, tiling=tiling
+    )
+
+    assert result.shape == (ds.rlat.size, ds.rlon.size)
+    assert not np.all(np.isnan(result))
+    assert windows.shape[0] < df.shape[0]
+    assert windows.n_core.sum() == df.shape[0]
+
+    with pytest.raises(ValueError):
+        rkrig_r(df, 10, ds, "TJan2.5 (degC)", 2, tiling="hexagon")
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("batch_size, r_cores", [(4, 1), (1000, 1), (4, 2)])
+def test_rkrig_r_batch(batch_size, r_cores):
+    df = df_.iloc[::10]
+    field, variance, windows = rkrig_r(
+        df, 10, ds, "TJan2.5 (degC)", 2, return_windows=True, return_variance=True
+    )
+    field_b, variance_b, windows_b = rkrig_r(
+        df,
+        10,
+        ds,
+        "TJan2.5 (degC)",
+        2,
+        return_windows=True,
+        return_variance=True,
+        batch_size=batch_size,
+        r_cores=r_cores,
+    )
+
+    np.testing.assert_allclose(field_b, field)
+    np.testing.assert_allclose(variance_b, variance, rtol=1e-6)
+    columns = ["station", "n_neighbours", "bbox_cells", "success"]
+    pd.testing.assert_frame_equal(windows_b[columns], windows[columns])
+
+
+def sparse_reference(df, ds, theta, sill, nugget):
+    """Dense universal kriging with the same covariance as
+    rkrig_sparse"""
+    X, z = df[["rlon", "rlat"]].values, df.ratio.values
+    K = wendland(cdist(X, X), theta, sill) + nugget * np.eye(z.size)
+    F = np.column_stack([np.ones(z.size), X])
+    Ki = np.linalg.inv(K)
+    beta = np.linalg.solve(F.T @ Ki @ F, F.T @ Ki @ z)
+
+    rlon, rlat = np.meshgrid(ds.rlon.values, ds.rlat.values)
+    G = np.column_stack([rlon.ravel(), rlat.ravel()])
+    D = cdist(G, X)
+    field = np.column_stack([np.ones(G.shape[0]), G]) @ beta
+    field += wendland(D, theta, sill) @ Ki @ (z - F @ beta)
+    field[np.all(D >= theta, axis=1)] = np.nan
+    return field.reshape(rlon.shape)
+
+
+@pytest.mark.parametrize(
+    "theta, nugget, chunk_size, error",
+    [
+        (None, None, 100000, None),
+        (2.0, 0.01, 100, None),
+        (-1.0, None, 100000, ValueError),
+    ],
+)
+def test_rkrig_sparse(theta, nugget, chunk_size, error):
+    df = df_.iloc[::2]
+    ds_small = small_grid(df)
+
+    if error is None:
+        field, params = rkrig_sparse(
+            df,
+            ds_small,
+            theta=theta,
+            nugget=nugget,
+            chunk_size=chunk_size,
+            return_params=True,
+        )
+        expected = sparse_reference(
+            df, ds_small, params["theta"], params["sill"], params["nugget"]
+        )
+        np.testing.assert_allclose(field, expected, atol=1e-10)
+        assert params["nnz"] < df.shape[0] ** 2
+
+        # cells outside of the mask are not predicted
+        mask = np.zeros(field.shape, dtype=bool)
+        mask[10:20, 10:30] = True
+        masked = rkrig_sparse(df, ds_small, mask, theta=theta, nugget=nugget)
+        assert np.all(np.isnan(masked[~mask]))
+        np.testing.assert_allclose(masked[mask], field[mask])
+    else:
+        with pytest.raises(error):
+            rkrig_sparse(df, ds_small, theta=theta)
+
+
+def test_rkrig_sparse_rkrig_py():
+    # heuristic parameters rather than a fitted variogram, so the field
+    # only roughly follows the one from rkrig_py
+    df = df_.iloc[::2]
+    ds_small = small_grid(df)
+
+    field = rkrig_sparse(df, ds_small)
+    expected = rkrig_py(df, "ratio", 10, ds_small)
+
+    covered = ~np.isnan(field)
+    assert np.mean(np.abs(field - expected)[covered]) < 0.5 * df.ratio.std()
+    assert np.corrcoef(field[covered], expected[covered])[0, 1] > 0.75
+
+
+@pytest.mark.slow
+def test_rkrig_r_variance():
+    df = df_.iloc[::10]
+    field, variance, windows = rkrig_r(
+        df,
+        10,
+        ds,
+        "TJan2.5 (degC)",
+        2,
+        return_windows=True,
+        return_variance=True,
+    )
+
+    np.testing.assert_allclose(field, rkrig_r(df, 10, ds, "TJan2.5 (degC)", 2))
+    assert variance.shape == field.shape
+    assert np.all(variance[~np.isnan(variance)] >= 0)
+    assert not np.all(np.isnan(variance))
+    assert (windows[windows.success].se_s >= 0).all()
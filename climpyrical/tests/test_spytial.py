@@ -66,3 +66,85 @@ def test_shape():
     assert newz.shape == (new_N, new_N)
     assert newx.shape == (new_N,)
     assert newy.shape == (new_N,)
+
+
+def test_fit_timings():
+    z_t, x_t, y_t, timings = sp.fit(coords, z, new_N, new_N, True, return_timings=True)
+    np.testing.assert_allclose(z_t, newz)
+    assert set(timings) == {"fit_s", "predict_s"}
+    assert timings["fit_s"] >= 0 and timings["predict_s"] >= 0
+
+
+def test_fit_variance():
+    z_v, x_v, y_v, variance, timings = sp.fit(
+        coords, z, new_N, new_N, True, return_timings=True, return_variance=True
+    )
+    np.testing.assert_allclose(z_v, newz)
+    assert variance.shape == z_v.shape
+    assert np.all(variance[~np.isnan(variance)] >= 0)
+    assert set(timings) == {"fit_s", "predict_s", "se_s"}
+
+
+def test_fit_batch():
+    # the same window twice, then a smaller window of its first stations
+    # on a grid that is not square
+    points = np.column_stack([np.tile(coords.T, (2, 1)), np.tile(z, 2)])
+    points = np.concatenate([points, points[: 2 * N]])
+    offsets = np.array([0, z.size, 2 * z.size, 2 * z.size + 2 * N])
+    nx, ny = np.array([new_N, new_N, 7]), np.array([new_N, new_N, 4])
+
+    packed, surface_offsets, variance, errors, timings = sp.fit_batch(
+        points, offsets, nx, ny, True, return_variance=True
+    )
+
+    np.testing.assert_array_equal(surface_offsets, [0, 900, 1800, 1828])
+    assert variance.shape == packed.shape
+    assert errors == [None, None, None]
+    assert set(timings) == {"fit_s", "predict_s", "se_s"}
+    assert all(times.shape == (3,) for times in timings.values())
+
+    small, _, _, small_variance = sp.fit(
+        coords[:, : 2 * N], z[: 2 * N], 7, 4, True, return_variance=True
+    )
+    for j, expected in enumerate([newz, newz, small]):
+        window = sp.batch_surface(packed, surface_offsets, nx, ny, j)
+        np.testing.assert_allclose(window, expected)
+    np.testing.assert_allclose(
+        sp.batch_surface(variance, surface_offsets, nx, ny, 2), small_variance
+    )
+
+    with pytest.raises(ValueError):
+        sp.fit_batch(points, offsets[:-1], nx[:-1], ny, True)
+    with pytest.raises(ValueError):
+        sp.fit_batch(points, offsets[::-1], nx, ny, True)
+    with pytest.raises(TypeError):
+        sp.fit_batch(points[:, :2], offsets, nx, ny, True)
+
+
+def test_unpack_batch():
+    # what spatial_process_batch_r.R returns for two windows, with R's
+    # column major surfaces and different times for each window
+    nx, ny = np.array([3, 2]), np.array([2, 4])
+    surfaces = [np.arange(6.0).reshape(3, 2), 10 + np.arange(8.0).reshape(2, 4)]
+    surface_dict = {
+        "z": np.concatenate([s.ravel(order="F") for s in surfaces]),
+        "se": np.concatenate([2 * s.ravel(order="F") for s in surfaces]),
+        "fit_time": [1.0, 2.0],
+        "predict_time": [3.0, 4.0],
+        "se_time": [5.0, 6.0],
+        "error": ["", "singular matrix"],
+    }
+
+    packed, surface_offsets, variance, errors, timings = sp._unpack_batch(
+        surface_dict, nx, ny, True
+    )
+
+    for j, expected in enumerate(surfaces):
+        window = sp.batch_surface(packed, surface_offsets, nx, ny, j)
+        np.testing.assert_array_equal(window, expected)
+        window = sp.batch_surface(variance, surface_offsets, nx, ny, j)
+        np.testing.assert_array_equal(window, (2 * expected) ** 2)
+    assert errors == [None, "singular matrix"]
+    np.testing.assert_array_equal(timings["fit_s"], [1.0, 2.0])
+    np.testing.assert_array_equal(timings["predict_s"], [3.0, 4.0])
+    np.testing.assert_array_equal(timings["se_s"], [5.0, 6.0])
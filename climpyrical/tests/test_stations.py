@@ -0,0 +1,108 @@
+import pytest
+import os
+import time
+import pandas as pd
+import numpy as np
+
+from climpyrical.stations import (
+    normalise_columns,
+    station_columns,
+    cache_path,
+    read_table,
+    read_stations,
+    CACHE_DIR,
+)
+
+
+def write_stations(tmpdir):
+    df = pd.DataFrame(
+        {
+            "Name": ["A", "B", "C"],
+            "prov": ["BC", "QC", "NU"],
+            "latitude": [49.0, 50.5, 70.25],
+            "long": [-123.0, -71.5, -90.0],
+            "elevation (m)": [10, 200, 35],
+            "RL50 (kPa)": [0.1, 0.2, 0.3],
+            "SL50 (kPa)": [1, 2, 3],
+            "notes": ["x", "y", "z"],
+        }
+    )
+    path = os.path.join(tmpdir, "stations.csv")
+    df.to_csv(path, index=False)
+    return path
+
+
+def test_normalise_columns():
+    df = pd.DataFrame(columns=["Lon", "Lat", "name", "elev", "RL50 (kPa)"])
+    df = normalise_columns(df)
+    assert list(df.columns) == ["lon", "lat", "station_name", "elev (m)", "RL50 (kPa)"]
+
+
+@pytest.mark.parametrize(
+    "station_dvs, expected, error",
+    [
+        (None, ["Name", "latitude", "x", "RL50 (kPa)"], None),
+        (["RL50 (kPa)"], ["Name", "latitude", "RL50 (kPa)"], None),
+        (["SL50 (kPa)"], None, KeyError),
+    ],
+)
+def test_station_columns(station_dvs, expected, error):
+    columns = ["Name", "latitude", "x", "RL50 (kPa)"]
+    if error is None:
+        assert station_columns(columns, station_dvs) == expected
+    else:
+        with pytest.raises(error):
+            station_columns(columns, station_dvs)
+
+
+def test_read_stations(tmpdir):
+    path = write_stations(tmpdir)
+
+    df = read_stations(path, ["SL50 (kPa)"], cache=False)
+    assert list(df.columns) == [
+        "station_name",
+        "province",
+        "lat",
+        "lon",
+        "elev (m)",
+        "SL50 (kPa)",
+    ]
+    assert df["elev (m)"].dtype == np.float32
+    assert df["SL50 (kPa)"].dtype == np.float64
+    assert df.lat.dtype == np.float64
+    np.testing.assert_array_equal(df.lon, [-123.0, -71.5, -90.0])
+
+    df = read_stations(path, cache=False)
+    assert "notes" in df.columns and "RL50 (kPa)" in df.columns
+    assert not os.path.exists(os.path.join(tmpdir, CACHE_DIR))
+
+    with pytest.raises(ValueError):
+        read_table(os.path.join(tmpdir, "stations.txt"))
+
+
+def test_cache_path(tmpdir):
+    path = os.path.join(tmpdir, "stations.csv")
+    a = cache_path(path, {"usecols": ["lat"]})
+    assert os.path.dirname(a) == os.path.join(tmpdir, CACHE_DIR)
+    assert a == cache_path(path, {"usecols": ["lat"]})
+    assert a != cache_path(path, {"usecols": ["lon"]})
+    assert os.path.dirname(cache_path(path, {}, "cache")) == "cache"
+
+
+def test_read_table_cache(tmpdir):
+    pytest.importorskip("pyarrow")
+    path = write_stations(tmpdir)
+    usecols = ["latitude", "RL50 (kPa)"]
+
+    df = read_table(path, usecols, {"latitude": "float64"})
+    cached = cache_path(path, dict(usecols=usecols, dtype={"latitude": "float64"}))
+    assert os.path.exists(cached)
+    pd.testing.assert_frame_equal(
+        read_table(path, usecols, {"latitude": "float64"}), df
+    )
+
+    # a newer input is parsed again
+    time.sleep(0.01)
+    pd.DataFrame({"latitude": [1.0], "RL50 (kPa)": [2.0]}).to_csv(path, index=False)
+    os.utime(path, (os.path.getmtime(cached) + 1,) * 2)
+    assert read_table(path, usecols, {"latitude": "float64"}).shape == (1, 2)
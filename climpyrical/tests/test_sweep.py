@@ -0,0 +1,107 @@
+import pytest
+import pandas as pd
+import numpy as np
+
+from climpyrical.sweep import expand_grid, rank_settings, sweep
+import climpyrical.sweep
+from climpyrical.crossval import setting_label
+from climpyrical.data import gen_dataset
+from climpyrical.gridding import find_element_wise_nearest_pos
+from pkg_resources import resource_filename
+
+df_ = pd.read_csv(resource_filename("climpyrical", "tests/data/sl50_short.csv"))
+
+
+@pytest.mark.parametrize(
+    "grid, expected",
+    [
+        ({}, [{}]),
+        ({"n": 20}, [{"n": 20}]),
+        (
+            {"n": [20, 30], "blend": ["mean", "taper"]},
+            [
+                {"n": 20, "blend": "mean"},
+                {"n": 20, "blend": "taper"},
+                {"n": 30, "blend": "mean"},
+                {"n": 30, "blend": "taper"},
+            ],
+        ),
+    ],
+)
+def test_expand_grid(grid, expected):
+    assert expand_grid(grid) == expected
+
+
+@pytest.mark.parametrize("by, error", [("rmse", None), ("mae", None), ("r2", KeyError)])
+def test_rank_settings(by, error):
+    df_errors = pd.DataFrame(
+        {
+            "dv": ["RL50", "RL50", "RL50", "SL50", "SL50"],
+            "setting": ["a", "b", "c", "a", "b"],
+            "mae": [1.0, 1.0, 2.0, 1.0, 0.5],
+            "rmse": [2.0, 1.0, 2.0, 3.0, 1.0],
+        }
+    )
+    df_times = df_errors[["dv", "setting"]].assign(
+        reconstruct_s=[10.0, 20.0, 5.0, 1.0, 2.0]
+    )
+    if error is None:
+        df_rank = rank_settings(df_errors, df_times, by)
+        expected = {"rmse": ["b", "c", "a", "b", "a"], "mae": ["a", "b", "c", "b", "a"]}
+        assert df_rank.setting.tolist() == expected[by]
+        assert df_rank["rank"].tolist() == [1, 2, 3, 1, 2]
+        assert "reconstruct_s" in df_rank.columns
+    else:
+        with pytest.raises(error):
+            rank_settings(df_errors, df_times, by)
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("n_jobs, timing", [(1, True), (2, True), (1, False)])
+def test_sweep(n_jobs, timing):
+    df = df_.iloc[::25].reset_index(drop=True)
+    rlon = np.linspace(df.rlon.min() - 1, df.rlon.max() + 1, 50)
+    rlat = np.linspace(df.rlat.min() - 1, df.rlat.max() + 1, 40)
+    lon, lat = np.meshgrid(rlon, rlat)
+    ds = gen_dataset("dv", np.ones(lon.shape), rlat, rlon, lat, lon)
+
+    irlon, irlat = find_element_wise_nearest_pos(
+        rlon, rlat, df.rlon.values, df.rlat.values
+    )
+    df = df.assign(irlat=irlat, irlon=irlon, model_values=1.0)
+
+    grid = {"n": [5, 8], "min_size": 2, "blend": ["mean", "taper"]}
+    df_cv, df_rank = sweep(
+        df, ds, "TJan2.5 (degC)", grid, 3, n_jobs, timing=timing, name="TJan2.5"
+    )
+
+    assert df_cv.shape[0] == 4 * df.shape[0]
+    assert df_rank.shape[0] == 4
+    assert df_rank["rank"].tolist() == [1, 2, 3, 4]
+    assert df_rank.rmse.is_monotonic_increasing
+    assert ("reconstruct_s" in df_rank.columns) == timing
+    assert set(df_rank.n) == {5, 8} and set(df_rank.blend) == {"mean", "taper"}
+
+    with pytest.raises(ValueError):
+        sweep(df, ds, "TJan2.5 (degC)", {"variogram": ["exponential"]})
+
+
+def test_sweep_times_alone(monkeypatch):
+    calls = []
+
+    def run_folds(jobs, func, n_jobs, initargs):
+        calls.append((func.__name__, n_jobs))
+        if func.__name__ == "_cv_fold":
+            return [
+                pd.DataFrame({"setting": setting_label(p), "error": [1.0]})
+                for p in initargs[3]
+            ]
+        return [{"setting": setting_label(p), "reconstruct_s": 1.0} for p in jobs]
+
+    monkeypatch.setattr(climpyrical.sweep, "run_folds", run_folds)
+    df = pd.DataFrame({"station": [0, 1]})
+    _, df_rank = sweep(df, None, "dv", {"n": [20, 30]}, 2, n_jobs=4)
+
+    # the reconstructions are timed after the folds, one at a time
+    assert calls == [("_cv_fold", 4), ("_time_setting", 1)]
+    assert df_rank.reconstruct_s.tolist() == [1.0, 1.0]
@@ -33,6 +33,7 @@ setup(
         "climpyrical/mask.py",
         "climpyrical/rkrig.py",
         "climpyrical/spytialProcess.py",
+        "climpyrical/pipeline.py",
         "climpyrical/cmd/preprocess_model.py",
         "climpyrical/cmd/find_matched_model_vals.py"
     ],